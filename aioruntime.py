@@ -0,0 +1,65 @@
+import queue
+import asyncio
+import threading
+import collections
+
+from common import *
+
+class LoopQueue(object):
+    """ Command queue fed by module threads and drained by the asyncio main loop.
+    Has the put / get_nowait subset of multiprocessing.Queue the modules use.
+    Items put while no loop is bound are kept until the next bind """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.loop = None
+        self.event = None
+
+    def bind(self, loop):
+        with self.lock:
+            self.loop = loop
+            self.event = asyncio.Event()
+            if self.items:
+                self.event.set()
+
+    def unbind(self):
+        with self.lock:
+            self.loop = None
+            self.event = None
+
+    def notifyLocked(self):
+        if None == self.loop:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # Loop is closing, the next bind picks up the items
+            pass
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+            self.notifyLocked()
+
+    def wake(self):
+        """ Wakes the main loop without a command """
+        with self.lock:
+            self.notifyLocked()
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.items:
+                raise queue.Empty()
+            return self.items.popleft()
+
+    async def wait(self, timeout):
+        """ Returns when there is something to handle, a wake, or after timeout seconds """
+        if self.items:
+            return
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+colorama.init(strip=False)
@@ -0,0 +1,78 @@
+import os
+import subprocess
+
+from common import *
+
+# mpg321 wants a dummy argument after -R
+PLAYER_REMOTE_ARGS = ['-R', 'gatectl']
+
+class AudioPlayer(object):
+    """ Keeps a single mp3 player running in remote control mode and sends it
+    LOAD / STOP commands, a new LOAD preempts whatever is playing """
+    def __init__(self, player, remoteArgs=PLAYER_REMOTE_ARGS, runAsUser=None):
+        self.player = player
+        self.remoteArgs = list(remoteArgs)
+        self.runAsUser = runAsUser
+        self.child = None
+        self.process = None
+
+    def isRunning(self):
+        return None != self.process and None == self.process.poll()
+
+    def start(self):
+        cmd = [self.player] + self.remoteArgs
+        if self.runAsUser:
+            cmd = ['runuser', '-u', self.runAsUser, '--'] + cmd
+        logPrint("Starting audio player: " + colors.blue(' '.join(cmd)))
+        self.child = processes.spawn(
+                cmd,
+                'audio',
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        self.process = self.child.popen
+
+    def send(self, command):
+        for _ in range(2):
+            if not self.isRunning():
+                self.start()
+            try:
+                self.process.stdin.write(command.encode('utf8') + b'\n')
+                self.process.stdin.flush()
+                return True
+            except (BrokenPipeError, OSError):
+                logPrint(colors.yellow("Audio player is gone, restarting"))
+                self.process = None
+        return False
+
+    def play(self, fname):
+        logPrint("Playing " + colors.blue(fname))
+        return self.send('LOAD %s' % os.path.abspath(fname))
+
+    def stop(self):
+        if self.isRunning():
+            self.send('STOP')
+
+    def precache(self, fileNames):
+        """ Reads the clips once so the first play does not wait for the SD card """
+        for fname in fileNames:
+            try:
+                with open(fname, 'rb') as clip:
+                    while clip.read(1024 * 1024):
+                        pass
+            except OSError:
+                logPrint(colors.yellow("Can't precache %s" % fname))
+
+    def close(self):
+        if not self.isRunning():
+            return
+        try:
+            self.process.stdin.write(b'QUIT\n')
+            self.process.stdin.close()
+            self.process.wait(1)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            processes.kill(self.child)
+        self.child = None
+        self.process = None
+
+colorama.init(strip=False)
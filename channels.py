@@ -0,0 +1,17 @@
+# Shared by the operation log readers and the store, kept free of numpy so the gate
+# process can use it without loading the analytics
+
+# gate_access column values
+ACCESS_UNKNOWN = -1
+ACCESS_DENIED = 0
+ACCESS_GRANTED = 1
+# Operation log actions (current and old format) to access channel
+CHANNELS = {
+    'Call' : 'Call',
+    'Call:' : 'Call',
+    'SMS' : 'SMS',
+    'Telegram' : 'Telegram',
+    'RF' : 'RF',
+    'RF cmd' : 'RF',
+    'Local' : 'Local',
+    'LocalTrigger' : 'Local'}
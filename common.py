@@ -1,86 +1,339 @@
 import os
 import subprocess
+import signal
 import time
+import sys
+import atexit
+import traceback
 import multiprocessing as mp
-import multiprocessing_logging
 import logging
 import fcntl
+import queue
+import types
+import collections.abc
 
 import colors
 import colorama
-from past.builtins import execfile
 
-def configLoad(cfgFileName, expectedConfigs=None):
-    cfg = {}
-    execfile(cfgFileName, cfg)
+from logpipe import *
+from logarchive import *
+
+def freezeConfigValue(value):
+    if isinstance(value, dict):
+        return FrozenMapping(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freezeConfigValue(x) for x in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+class FrozenMapping(collections.abc.Mapping):
+    """ Read only, picklable dict """
+    def __init__(self, values):
+        self._values = {key : freezeConfigValue(value) for key, value in values.items()}
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __hash__(self):
+        return hash(frozenset(self._values.items()))
+
+    def __repr__(self):
+        return repr(self._values)
+
+    def __reduce__(self):
+        return (self.__class__, (self._values,))
+
+class ConfigSnapshot(FrozenMapping):
+    """ The settings of one load of the config file. Changes come as a new snapshot """
+    def __init__(self, values, fileName=None):
+        super(ConfigSnapshot, self).__init__({
+                key : value for key, value in values.items()
+                if not key.startswith('_') and not isinstance(value, (types.ModuleType, type)) and not callable(value)})
+        self.fileName = fileName
+
+    def __reduce__(self):
+        return (self.__class__, (self._values, self.fileName))
+
+    def replace(self, **changes):
+        values = dict(self._values)
+        values.update(changes)
+        return ConfigSnapshot(values, self.fileName)
+
+    def diff(self, other):
+        """ Names of the settings that are added, removed or different in other """
+        return {key for key in set(self._values) | set(other) if self.get(key, None) != other.get(key, None)}
+
+def validateConfig(cfg, expectedConfigs=None, expectedTypes=None):
     if expectedConfigs:
         for config_name in expectedConfigs:
             assert config_name in cfg, "%s configuration is missing in config file" % config_name
+    if expectedTypes:
+        for config_name, expectedType in expectedTypes.items():
+            if config_name in cfg:
+                assert isinstance(cfg[config_name], expectedType), \
+                        "%s configuration should be %r, not %r" % (config_name, expectedType, cfg[config_name])
     return cfg
 
+def configLoad(cfgFileName, expectedConfigs=None, expectedTypes=None):
+    values = {}
+    with open(cfgFileName, 'r') as cfgFile:
+        exec(compile(cfgFile.read(), cfgFileName, 'exec'), values)
+    return validateConfig(ConfigSnapshot(values, cfgFileName), expectedConfigs, expectedTypes)
+
 logger = None
 cfg = configLoad('config.py')
+
+def useConfig(newCfg):
+    """ Makes newCfg the config this process sees, from the parent or from a reload """
+    global cfg
+    cfg = newCfg
+
+def pollConfigUpdate(configUpdates):
+    """ Returns the newest config snapshot sent to a module, None if nothing changed """
+    latest = None
+    while None != configUpdates:
+        try:
+            latest = configUpdates.get_nowait()
+        except queue.Empty:
+            break
+    return latest
+
+# Module name -> time.monotonic() when the parent asked to start it
+MODULE_START_REQUESTS = {}
+
+def getProcessAge():
+    """ Seconds since this process was created, from /proc """
+    try:
+        with open('/proc/self/stat', 'r') as stat:
+            # The command name may contain spaces, the fields after it don't
+            startTicks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as uptime:
+            return float(uptime.read().split()[0]) - startTicks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+
+def workerMain(entryPoint, name, requestedAt, parentCfg, *args):
+    """ Entry of every module process, runs the module with the parent's config """
+    # Config reloads are driven by the main process, a SIGHUP to the group must not kill modules
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    useConfig(parentCfg)
+    MODULE_START_REQUESTS[name] = requestedAt
+    try:
+        return entryPoint(parentCfg, *args)
+    except:
+        dumpLogRing("%s crashed\n%s" % (name, traceback.format_exc()))
+        raise
+    finally:
+        # Process children skip atexit
+        closeLogPipe()
+
+def reportReady(name):
+    requestedAt = MODULE_START_REQUESTS.pop(name, None)
+    if None == requestedAt:
+        logPrint("%s ready, process up %.3f sec" % (name, getProcessAge()))
+    else:
+        logPrint("%s ready in %.3f sec, process up %.3f sec" % (name, time.monotonic() - requestedAt, getProcessAge()))
+
+# Names the crash dump files, %s is the time and pid
+LOG_CRASH_DUMP = 'logs/crash_%s.log'
+logPipe = None
+logRing = None
+
 def getLogger():
     global logger
+    global logPipe
+    global logRing
     if logger:
         return logger
     logger = mp.get_logger()
     logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('[%(asctime)s| %(levelname)s| %(processName)s] %(message)s')
-    handler = logging.FileHandler(cfg['LOG_FILE_NAME'])
-    handler.setFormatter(formatter)
+    formatter = logging.Formatter(LOG_FORMAT)
+    sinks = [SegmentSink(
+            cfg['LOG_FILE_NAME'],
+            cfg.get('LOG_SEGMENT_PERIOD', LOG_SEGMENT_PERIOD),
+            cfg.get('MAX_LOG_FILE_SIZE', LOG_SEGMENT_MAX_SIZE))]
+    if cfg.get('LOG_TO_TTY', True) and sys.stderr.isatty():
+        sinks.append(TtySink(sys.stderr))
+    logPipe = LogPipe(
+            sinks,
+            formatter,
+            cfg.get('LOG_BATCH_SIZE', LOG_BATCH_SIZE),
+            cfg.get('LOG_FLUSH_INTERVAL', LOG_FLUSH_INTERVAL))
+    logRing = RingBufferHandler(cfg.get('LOG_RING_SIZE', LOG_RING_SIZE))
+    logRing.setFormatter(formatter)
+    pipeHandler = PipeHandler(logPipe)
+    pipeHandler.addFilter(RateLimitFilter(
+            cfg.get('LOG_RATE_LIMIT', LOG_RATE_LIMIT),
+            cfg.get('LOG_RATE_WINDOW', LOG_RATE_WINDOW)))
     if not len(logger.handlers):
-        logger.addHandler(handler)
-    multiprocessing_logging.install_mp_handler()
+        logger.addHandler(logRing)
+        logger.addHandler(pipeHandler)
+    atexit.register(closeLogPipe)
     return logger
 
-LOCK_FILE_HANDLE = None
+def closeLogPipe():
+    if None != logPipe:
+        logPipe.close()
+
+def dumpLogRing(reason=None):
+    """ Writes the records kept in memory, including the rate limited ones, returns the file name """
+    if None == logRing:
+        return None
+    fileName = cfg.get('LOG_CRASH_DUMP', LOG_CRASH_DUMP) % ('%s_%d' % (time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+    try:
+        return logRing.dump(fileName, reason)
+    except OSError:
+        return None
+
+# Lock handles by instance name, a process may hold a few when the modules share it
+LOCK_FILE_HANDLES = {}
 def validate_single_instance(name):
-    global LOCK_FILE_HANDLE
-    if LOCK_FILE_HANDLE:
-        print(f"File already locked")
-        return False
+    if name in LOCK_FILE_HANDLES:
+        print(f"{name} is already locked by this process")
+        return True
     lock_file_path = cfg['LOCK_FILE'] + '_' + name
-    LOCK_FILE_HANDLE = os.open(lock_file_path, os.O_WRONLY | os.O_CREAT)
+    handle = os.open(lock_file_path, os.O_WRONLY | os.O_CREAT)
     try:
         print(f"Locking {lock_file_path}")
-        fcntl.lockf(LOCK_FILE_HANDLE, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.lockf(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        LOCK_FILE_HANDLES[name] = handle
         return True
-    except IOError:
-        print(f"File is already locked {lock_file_path}")
-        return False
     except PermissionError:
         print(f"File {lock_file_path} is opened by someone stronger")
+        os.close(handle)
+        return False
+    except IOError:
+        print(f"File is already locked {lock_file_path}")
+        os.close(handle)
         return False
     print("WTF! 12483749")
     return False
 
 def logPrint(text):
-    getLogger().info(text)
+    # The rate limit goes by the caller's line, stacklevel would need Python 3.8
+    caller = sys._getframe(1)
+    getLogger().info(text, extra={'site' : (caller.f_code.co_filename, caller.f_lineno)})
 
-def safeOpenAppend(fileName):
-    dirName = os.path.dirname(fileName)
-    if dirName:
-        os.makedirs(dirName, exist_ok=True)
-    targetFileSize = 0
-    try:
-        targetFileSize = os.path.getsize(fileName)
-    except OSError:
-        targetFileSize = 0
-    if cfg['MAX_LOG_FILE_SIZE'] < targetFileSize:
-        os.unlink(fileName)
-    return open(fileName, 'a')
-
-def kill_process_by_name(target):
-    stdout, stderr = subprocess.Popen(['ps', '-A'], stdout=subprocess.PIPE).communicate()
-    if isinstance(target, str):
-        target = target.encode('utf8')
-    for l in stdout.splitlines():
-        if target not in l:
+class PipeQueue(object):
+    """ Commands from the module processes to the gate process. Unlike multiprocessing.Queue
+    there is no feeder thread, an item is in the pipe once put returns, so the gate process
+    can wait on this queue together with its other file descriptors """
+    def __init__(self, ctx):
+        self.reader, self.writer = ctx.Pipe(duplex=False)
+        self.lock = ctx.Lock()
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def put(self, item):
+        with self.lock:
+            self.writer.send(item)
+
+    def get_nowait(self):
+        # Only the gate process reads, a message seen by poll is all there once sent
+        if not self.reader.poll():
+            raise queue.Empty()
+        return self.reader.recv()
+
+class ChildProcess(object):
+    def __init__(self, popen, purpose):
+        self.popen = popen
+        self.pid = popen.pid
+        # Every child is started in its own session, so its process group id is its pid
+        self.pgid = popen.pid
+        self.startTime = time.time()
+        self.purpose = purpose
+
+    def isAlive(self):
+        return None == self.popen.poll()
+
+    def __repr__(self):
+        return "<%s pid %d up %.1f sec>" % (self.purpose, self.pid, time.time() - self.startTime)
+
+def findProcessesByName(name):
+    """ Scans /proc for processes whose executable name is exactly name, without forking ps """
+    if isinstance(name, bytes):
+        name = name.decode('utf8')
+    name = os.path.basename(name)
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry, 'r') as stat:
+                stat = stat.read()
+            with open('/proc/%s/cmdline' % entry, 'rb') as cmdline:
+                argv0 = cmdline.read().split(b'\0', 1)[0]
+        except OSError:
             continue
-        pid = int(l.split()[0])
-        logPrint(colors.red("Killing %d with command line: '%s'" % (pid, l.split()[3])))
-        os.kill(pid, signal.SIGKILL)
-        time.sleep(0.1)
-        logPrint(colors.red("Killed %d" % pid))
+        # pid (comm) state ...
+        comm = stat[stat.find('(') + 1:stat.rfind(')')]
+        if 'Z' == stat[stat.rfind(')') + 2:][:1]:
+            continue
+        if name == comm or name == os.path.basename(argv0.decode('utf8', errors='ignore')):
+            pids.append(int(entry))
+    return pids
+
+class ProcessRegistry(object):
+    """ Tracks the processes we start in the background so they can be reaped and
+    stopped without searching the process table """
+    def __init__(self):
+        self.children = {}
+
+    def spawn(self, cmd, purpose, **kwargs):
+        self.reap()
+        kwargs.setdefault('close_fds', True)
+        popen = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        child = ChildProcess(popen, purpose)
+        self.children[child.pid] = child
+        return child
+
+    def reap(self):
+        """ Collects children that exited, never blocks """
+        for pid, child in list(self.children.items()):
+            if not child.isAlive():
+                del self.children[pid]
+
+    def find(self, purpose):
+        self.reap()
+        return [child for child in self.children.values() if child.purpose == purpose]
+
+    def kill(self, child, sig=signal.SIGKILL):
+        """ Signals the whole process group of the child, so shells and what they started go too """
+        if child.isAlive():
+            logPrint(colors.red("Killing %r" % child))
+            try:
+                os.killpg(child.pgid, sig)
+            except ProcessLookupError:
+                pass
+        self.reap()
+
+    def killByPurpose(self, purpose, sig=signal.SIGKILL):
+        for child in self.find(purpose):
+            self.kill(child, sig)
+
+    def killExternal(self, name, sig=signal.SIGKILL):
+        """ Kills the processes named name that we did not start, like a player left by an
+        earlier instance that crashed """
+        self.reap()
+        for pid in findProcessesByName(name):
+            if pid == os.getpid() or pid in self.children:
+                continue
+            logPrint(colors.red("Killing left over %d (%s)" % (pid, name)))
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                continue
+
+processes = ProcessRegistry()
 
+def runInBackground(cmd, purpose='background'):
+    logPrint("Executing: " + colors.blue(cmd))
+    return processes.spawn(cmd, purpose, shell=True, stdin=None)
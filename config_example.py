@@ -1,5 +1,3 @@
-from datetime import datetime
-
 GSM_PWR_PIN = 7
 #GSM_PWR_PIN = 31 # SIM7600X
 GSM_SERIAL_DEV = "/dev/ttyUSB0"
@@ -7,13 +5,55 @@ GSM_SERIAL_DEV = "/dev/ttyUSB0"
 GPIO_GATE_UP    = 36
 GPIO_GATE_POWER = 38
 GPIO_GATE_HOLD  = 40 # Not in use
+# 'pi' for the board, 'sim' to run against the simulated devices in simhw.py
+HARDWARE_BACKEND = 'pi'
+# 'processes' runs every module in its own process, 'asyncio' runs them all as threads
+# of one process, for the 512MB boards
+RUNTIME = 'processes'
+# How module processes start: 'spawn' imports everything and runs this file again in each,
+# 'forkserver' does it once and forks the modules from there
+START_METHOD = 'forkserver'
 
 TEMPERATURE_CHECK_INTERVAL = 300
+HEALTH_SAMPLE_INTERVAL = 10
+HEALTH_HISTORY_SIZE = 1024
+# Root of the sysfs / procfs tree the health checks read
+HEALTH_SYS_ROOT = '/'
 
 MP3_PLAYER = 'mpg321'
-current_datetime_str = datetime.now().strftime("%Y%m%d")
-LOG_FILE_NAME = "logs/ctl_" + current_datetime_str + ".log"
+# Keep one player running in remote control mode instead of starting one per clip
+AUDIO_REMOTE_CONTROL = True
+MP3_PLAYER_REMOTE_ARGS = ['-R', 'gatectl']
+# The player runs as this user when we are root
+AUDIO_USER = 'pi'
+AUDIO_PRECACHE = ['ping.mp3']
+# %s is replaced with the start time of the log segment, a name without it gets _%s before the extension
+LOG_FILE_NAME = "logs/ctl_%s.log"
+# Log records are written in batches by a background thread
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1
+# Repeats of the same line allowed from one log call in LOG_RATE_WINDOW seconds, warnings and errors always pass
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 10
+# Last records kept in memory, written to LOG_CRASH_DUMP when a module crashes
+LOG_RING_SIZE = 5000
+LOG_CRASH_DUMP = 'logs/crash_%s.log'
+# Also print coloured logs when running on a terminal
+LOG_TO_TTY = True
 OPERATION_LOG = "logs/operation_%s.log"
+OPERATION_LOG_BATCH_SIZE = 64
+OPERATION_LOG_FLUSH_INTERVAL = 5
+# Indexed copy of the operation log for history queries, see opstore.py. None to disable
+OPERATION_STORE = "logs/operations.db"
+# Prometheus text file with gate latency histograms per channel
+LATENCY_METRICS_FILE = "logs/latency.prom"
+LATENCY_SLA = 2
+# Restart delay of a module that keeps stopping, doubles from min up to max seconds
+MODULE_BACKOFF_MIN = 1
+MODULE_BACKOFF_MAX = 300
+# Reboot when the modules stopped more than this many times within the window (seconds)
+MODULE_CRASH_WINDOW = 3600
+MODULE_CRASH_BUDGET = 30
 PING_INTERVAL = 60 * 2
 MAX_FAILS_IN_A_ROW = 4
 MAX_USB_FAIL_COUNT = 20
@@ -23,11 +63,26 @@ KILL_FILE = 'KILLAPP'
 
 MUST_EXISTS_USB = [b'148f:7601', b'0403:6001']
 
-MAX_LOG_FILE_SIZE = 1024 * 1024 * 100
+# The log is written in segments of LOG_SEGMENT_PERIOD seconds, or less when one grows past
+# MAX_LOG_FILE_SIZE. Sealed segments are compressed with a time index, see logarchive.py
+LOG_SEGMENT_PERIOD = 3600
+MAX_LOG_FILE_SIZE = 1024 * 1024 * 16
+# Seconds of log in one compressed block, the unit of a range read
+LOG_ARCHIVE_BLOCK_INTERVAL = 60
+# Oldest segments are removed when the compressed ones take more than this
+LOG_ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
 
 TELEGRAM_BOT_TOKEN = ''
 TELEGRAM_LAST_MSG_FILE = 'telegram_last_msg_id.txt'
 TELEGRAM_CHECK_INTERVAL = 1
+# Seconds a getUpdates request is held open by Telegram, 0 to poll every TELEGRAM_CHECK_INTERVAL
+TELEGRAM_LONG_POLL_TIMEOUT = 25
+#TELEGRAM_API_URL = 'https://api.telegram.org'
+# Chat ids that get alerts (denied access, reboots, USB failures, modem power downs), empty to disable
+TELEGRAM_NOTIFY_CHATS = []
+# Alerts within this many seconds are sent as one message per chat
+NOTIFY_BATCH_INTERVAL = 60
+NOTIFY_SPOOL_FILE = 'logs/notify_spool.json'
 
 OPEN_GATE_WORDS_LIST = {
         'up' : 'up',
@@ -55,4 +110,6 @@ RF_GPIO = 17
 RF_PROTO = 1
 RF_PULSELENGTH = (330, 340)
 RF_CODE = (2040, 2050)
+# Seconds a held remote button keeps counting as the same press
+RF_HOLD_WINDOW = 1.0
 
@@ -0,0 +1,91 @@
+import os
+import signal
+import time
+
+from common import *
+from fswatch import *
+
+# Used only when inotify is not available
+CONFIG_POLL_INTERVAL = 2
+
+class ConfigReloader(object):
+    """ Loads the config file again on SIGHUP or when it is written. fileno() / signalFileno()
+    become readable when that happens, reload() returns the new snapshot """
+    def __init__(self, snapshot, expectedConfigs=None, expectedTypes=None, overrides=None):
+        self.snapshot = snapshot
+        self.overrides = overrides or {}
+        self.fileName = snapshot.fileName
+        self.expectedConfigs = expectedConfigs
+        self.expectedTypes = expectedTypes
+        self.fileStat = self.statFile()
+        self.lastPoll = time.monotonic()
+        self.signalReader, self.signalWriter = os.pipe()
+        os.set_blocking(self.signalReader, False)
+        os.set_blocking(self.signalWriter, False)
+        self.previousHandler = signal.signal(signal.SIGHUP, self.onSignal)
+        self.watcher = DirWatcher(os.path.dirname(self.fileName), IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    def onSignal(self, signum, frame):
+        # The main loop is waiting on the pipe, a retried select would miss the signal
+        try:
+            os.write(self.signalWriter, b'\0')
+        except BlockingIOError:
+            pass
+
+    def statFile(self):
+        try:
+            stat = os.stat(self.fileName)
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def signalFileno(self):
+        return self.signalReader
+
+    def isReloadNeeded(self):
+        """ Consumes the pending events, True if the file should be loaded again """
+        isNeeded = False
+        try:
+            while os.read(self.signalReader, 64):
+                logPrint(colors.blue("Got SIGHUP"))
+                isNeeded = True
+        except BlockingIOError:
+            pass
+        if None != self.watcher.fileno():
+            baseName = os.path.basename(self.fileName)
+            if any(baseName == name for _, name in self.watcher.read()):
+                isNeeded = True
+        elif CONFIG_POLL_INTERVAL <= (time.monotonic() - self.lastPoll):
+            self.lastPoll = time.monotonic()
+            isNeeded = isNeeded or (self.statFile() != self.fileStat)
+        return isNeeded
+
+    def reload(self):
+        """ Returns (snapshot, changed names), a bad file keeps the current snapshot """
+        self.fileStat = self.statFile()
+        try:
+            newSnapshot = configLoad(self.fileName, self.expectedConfigs, self.expectedTypes).replace(**self.overrides)
+        except Exception as e:
+            logPrint(colors.red("Config reload failed, keeping the current config: %r" % e))
+            return (self.snapshot, set())
+        changed = self.snapshot.diff(newSnapshot)
+        self.snapshot = newSnapshot
+        if changed:
+            logPrint(colors.blue("Config reloaded, changed: %s" % ', '.join(sorted(changed))))
+        return (newSnapshot, changed)
+
+    def close(self):
+        # The default action ends the process, a SIGHUP while run() makes a new GateControl
+        # must not kill the daemon
+        if signal.SIG_DFL == self.previousHandler:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        else:
+            signal.signal(signal.SIGHUP, self.previousHandler)
+        self.watcher.close()
+        os.close(self.signalReader)
+        os.close(self.signalWriter)
+
+colorama.init(strip=False)
@@ -0,0 +1,86 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+
+from common import *
+
+IN_MODIFY       = 0x00000002
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_NONBLOCK     = os.O_NONBLOCK
+IN_CLOEXEC      = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+def getLibc():
+    global _libc
+    if None == _libc:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _libc.inotify_init1
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+class DirWatcher(object):
+    """ Wakes up a select/wait loop when files in a directory change.
+    If inotify is not available fileno() returns None and the owner should fall back to polling """
+    def __init__(self, path, mask=IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM):
+        self.path = path or '.'
+        self.fd = None
+        libc = getLibc()
+        if not libc:
+            logPrint(colors.yellow("inotify is not available, %s will be polled" % self.path))
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logPrint(colors.yellow("inotify_init1 failed (errno %d)" % ctypes.get_errno()))
+            return
+        self.fd = fd
+        self.mask = mask
+        if not self.addWatch(self.path):
+            self.close()
+
+    def addWatch(self, path):
+        if None == self.fd:
+            return False
+        if getLibc().inotify_add_watch(self.fd, os.fsencode(path or '.'), self.mask) < 0:
+            logPrint(colors.yellow("Can't watch %s (errno %d)" % (path, ctypes.get_errno())))
+            return False
+        return True
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """ Returns a list of (mask, name) for all pending events """
+        events = []
+        if None == self.fd:
+            return events
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                _, mask, _, nameLen = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + nameLen].rstrip(b'\0')
+                offset += nameLen
+                events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if None != self.fd:
+            os.close(self.fd)
+            self.fd = None
+
+colorama.init(strip=False)
@@ -3,13 +3,15 @@
 import time
 import os
 import traceback
+import queue
 import multiprocessing as mp
 
 import colors
 from datetime import datetime
-import RPi.GPIO as GPIO
+from hardware import GPIO
 
 from common import *
+from tracing import *
 
 class GateMachine(object):
     def __init__(self, up_gpio, power_gpio):
@@ -21,7 +23,7 @@ class GateMachine(object):
         self.power_gpio = power_gpio
 
     def close(self):
-        GPIO.cleanup()
+        GPIO.cleanup([self.up_gpio, self.power_gpio])
 
     def triggerPin(self, pin_number, active_low=False, uptime=2):
         self.activatePin(pin_number, active_low)
@@ -56,25 +58,133 @@ class GateMachine(object):
         logPrint("Gate power off")
 
 def up(uptime=2):
-    cfg = configLoad('config.py')
     uptime = float(uptime)
     gm = GateMachine(cfg['GPIO_GATE_UP'], cfg['GPIO_GATE_POWER'])
     gm.up(uptime)
 
+# Commands with a lower value are handled first when a batch is drained
+COMMANDS_PRIORITY = {'close' : 0, 'resetGate' : 1, 'up' : 2}
+GATE_RESET_TIME = 4
+
+class GateScheduler(object):
+    """ Holds the gate pins active until a deadline instead of sleeping.
+    Overlapping requests for the same pin extend the deadline of the active hold.
+    An open during a reset waits until the gate controller is powered back """
+    def __init__(self, gm):
+        self.gm = gm
+        self.holds = {}
+        self.deferredUptime = 0
+
+    def hold(self, pin_number, uptime, active_low=False):
+        deadline = time.monotonic() + uptime
+        if pin_number in self.holds:
+            currentDeadline, active_low = self.holds[pin_number]
+            self.holds[pin_number] = (max(currentDeadline, deadline), active_low)
+            return False
+        self.gm.activatePin(pin_number, active_low)
+        self.holds[pin_number] = (deadline, active_low)
+        return True
+
+    def release(self, pin_number):
+        if pin_number not in self.holds:
+            return
+        _, active_low = self.holds.pop(pin_number)
+        self.gm.deactivatePin(pin_number, active_low)
+
+    def releaseExpired(self):
+        now = time.monotonic()
+        for pin_number, (deadline, _) in list(self.holds.items()):
+            if deadline <= now:
+                self.release(pin_number)
+        if self.deferredUptime and not self.isResetting():
+            uptime = self.deferredUptime
+            self.deferredUptime = 0
+            self.up(uptime)
+
+    def releaseAll(self):
+        self.deferredUptime = 0
+        for pin_number in list(self.holds.keys()):
+            self.release(pin_number)
+
+    def timeout(self):
+        """ Seconds until the next hold expires, None if nothing is held """
+        if not self.holds:
+            return None
+        return max(0, min(deadline for deadline, _ in self.holds.values()) - time.monotonic())
+
+    def isResetting(self):
+        return self.gm.power_gpio in self.holds
+
+    def up(self, uptime=2):
+        uptime = float(uptime)
+        if self.isResetting():
+            self.deferredUptime = max(self.deferredUptime, uptime)
+            logPrint(colors.green("Gate is resetting, up for %f sec once it is done" % uptime))
+            return
+        if self.hold(self.gm.up_gpio, uptime):
+            logPrint(colors.green("Gate up! for %f sec" % uptime))
+        else:
+            logPrint(colors.green("Gate is already up, holding for %f more sec" % uptime))
+
+    def resetGate(self, active_low=False):
+        logPrint(colors.yellow("Reset gate control"))
+        self.release(self.gm.up_gpio)
+        if self.hold(self.gm.power_gpio, GATE_RESET_TIME, active_low=active_low):
+            logPrint("Gate power on")
+
+    def close(self):
+        self.releaseAll()
+        self.gm.close()
+
+def orderCommands(commands):
+    """ A drained batch of (cmd, args, trace) in the order it is handled """
+    return sorted(commands, key=lambda x: COMMANDS_PRIORITY.get(x[0], len(COMMANDS_PRIORITY)))
+
+def nearestTimeout(*timeouts):
+    timeouts = [x for x in timeouts if None != x]
+    if not timeouts:
+        return None
+    return min(timeouts)
+
 def MachineLoopRun(cfg, cmdQueue):
     validate_single_instance('machine')
     logPrint("Gate machine started")
     gm = GateMachine(cfg['GPIO_GATE_UP'], cfg['GPIO_GATE_POWER'])
+    scheduler = GateScheduler(gm)
+    latency = LatencyRecorder(
+            cfg.get('LATENCY_METRICS_FILE', LATENCY_METRICS_FILE),
+            cfg.get('LATENCY_SLA', LATENCY_SLA))
+    reportReady('gateMachine')
     while True:
+        commands = []
+        try:
+            commands.append(cmdQueue.get(timeout=nearestTimeout(scheduler.timeout(), latency.timeout())))
+            while True:
+                commands.append(cmdQueue.get_nowait())
+        except queue.Empty:
+            pass
+        for cmd, args, trace in orderCommands(commands):
+            try:
+                if 'reconfigure' == cmd:
+                    cfg, = args
+                    latency.metricsFile = cfg.get('LATENCY_METRICS_FILE', LATENCY_METRICS_FILE)
+                    latency.sla = cfg.get('LATENCY_SLA', LATENCY_SLA)
+                    continue
+                logPrint("Gate handle: %s %r" % (cmd, args))
+                getattr(scheduler, cmd)(*args)
+                if None != trace:
+                    trace.mark('actuated')
+                    logPrint("Gate trace: %r" % trace)
+                    latency.record(trace)
+                if 'close' == cmd:
+                    latency.publish(force=True)
+                    return
+            except:
+                last_error = traceback.format_exc()
+                logPrint(colors.bold(colors.red(last_error)))
         try:
-            if cmdQueue.empty():
-                time.sleep(0.02)
-                continue
-            cmd, args = cmdQueue.get()
-            logPrint("Gate handle: %s %r" % (cmd, args))
-            getattr(gm, cmd)(*args)
-            if 'close' == cmd:
-                return
+            scheduler.releaseExpired()
+            latency.publish()
         except:
             last_error = traceback.format_exc()
             logPrint(colors.bold(colors.red(last_error)))
@@ -1,11 +1,129 @@
 import binascii
 import time
 import traceback
+import threading
+import queue
+import concurrent.futures
 
-import RPi.GPIO as GPIO
+from hardware import GPIO
 import serial
 
 from common import *
+from tracing import *
+
+AT_FINAL_RESULTS = (b'OK', b'ERROR', b'+CME ERROR', b'+CMS ERROR')
+# Lines the modem may send at any time, even in the middle of a command response
+AT_URC_PREFIXES = (b'RING', b'+CLIP:', b'+CMTI:', b'NO CARRIER', b'MISSED_CALL', b'VOICE CALL:',
+        b'RDY', b'SMS DONE', b'PB DONE', b'+CPIN: READY')
+AT_DEFAULT_TIMEOUT = 5
+AT_PING_TIMEOUT = 1.5
+# How long the main loop waits for URCs before checking the kill file and ping interval
+URC_WAIT_TIMEOUT = 1
+# Stored SMS deleted on each idle pass of the main loop
+SMS_DELETE_BATCH = 8
+# +CLIP comes right after the first RING, a call without it is looked up with AT+CLCC after this
+CALL_CLIP_GRACE = 0.5
+# RING repeats every few seconds while a call rings, a call with no URC for this long is over
+CALL_IDLE_TIMEOUT = 10
+CALL_END_URCS = (b'NO CARRIER', b'MISSED_CALL', b'VOICE CALL: END')
+
+def isFinalResult(line):
+    return line.startswith(AT_FINAL_RESULTS)
+
+def isUrc(line):
+    return line.startswith(AT_URC_PREFIXES) or b'POWER DOWN' in line
+
+def isOK(lines):
+    return bool(lines) and lines[-1] == b'OK'
+
+class CallSession(object):
+    """ One incoming call, from its first RING or +CLIP until it ends. Gets one access decision """
+    def __init__(self, startedAt):
+        self.startedAt = startedAt
+        self.lastEventAt = startedAt
+        self.callerId = None
+        self.isDecided = False
+        self.events = 0
+
+class ATChannel(object):
+    """ Frames the modem output into command responses and unsolicited result codes.
+    A reader thread owns the serial input, a command waits on a future that is resolved
+    once the echo of the command and then a final result line arrive and URCs are queued with their arrival time """
+    def __init__(self, serialPort):
+        self.serial = serialPort
+        self.urcQueue = queue.Queue()
+        self.cmdLock = threading.Lock()
+        self.stateLock = threading.Lock()
+        self.pending = None
+        self.running = True
+        self.reader = threading.Thread(target=self.readLoop, name='ATReader', daemon=True)
+        self.reader.start()
+
+    def readLoop(self):
+        buf = b''
+        while self.running:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except:
+                if self.running:
+                    last_error = traceback.format_exc()
+                    logPrint(colors.bold(colors.red(last_error)))
+                self.running = False
+                break
+            if not data:
+                continue
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                line = line.strip()
+                if line:
+                    self.handleLine(line, time.monotonic())
+
+    def handleLine(self, line, receivedAt):
+        if isUrc(line):
+            logPrint(colors.faint(colors.red(line.decode('utf8', errors='ignore'))))
+            self.urcQueue.put((line, receivedAt))
+            return
+        with self.stateLock:
+            if None == self.pending:
+                logPrint("Unexpected modem data: " + colors.red(line.decode('utf8', errors='ignore')))
+                return
+            cmd, future, lines = self.pending
+            if not lines and line != cmd:
+                # The response of a command that timed out, ours starts with its echo
+                logPrint("Stale modem data: " + colors.red(line.decode('utf8', errors='ignore')))
+                return
+            lines.append(line)
+            if isFinalResult(line):
+                self.pending = None
+                future.set_result(lines)
+
+    def command(self, cmd, timeout=AT_DEFAULT_TIMEOUT, quiet=False):
+        """ Returns the response lines, the last one is the final result unless the command timed out """
+        with self.cmdLock:
+            future = concurrent.futures.Future()
+            lines = []
+            with self.stateLock:
+                self.pending = (cmd, future, lines)
+            self.serial.write(cmd + b'\r\n')
+            self.serial.flush()
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                with self.stateLock:
+                    self.pending = None
+                logPrint(colors.yellow("Timeout waiting for %r, got: %r" % (cmd, lines)))
+                return lines
+            if not quiet:
+                logPrint(colors.faint(colors.red(b'\n'.join(lines).decode('utf8', errors='ignore'))))
+            return lines
+
+    def close(self):
+        self.running = False
+        self.reader.join(2)
+
+# Changes to these wait for the next restart of the GSM module
+GSM_DEVICE_SETTINGS = frozenset(['GSM_SERIAL_DEV', 'GSM_PWR_PIN'])
 
 class GSMHat(object):
     def __init__(self, cfg, cmdQueue):
@@ -14,12 +132,24 @@ class GSMHat(object):
         self.cfg = cfg
         self.cmdQueue = cmdQueue
         self.initPwrPin()
-        self.serial = serial.Serial(self.cfg['GSM_SERIAL_DEV'], 115200, timeout=1.5)
+        self.serial = serial.Serial(self.cfg['GSM_SERIAL_DEV'], 115200, timeout=0.2)
+        self.channel = ATChannel(self.serial)
+        self.isConfigured = False
+        self.smsToDelete = set()
+        self.call = None
+        # URCs that arrived before this are left overs of the call that ended, unless
+        # their caller id is of someone else
+        self.callEndedAt = 0
+        self.endedCallerId = None
+        self.urcHandlers = [
+                (b'+CLIP:', self.answerCallClip),
+                (b'RING', self.handleRing),
+                (b'+CMTI:', self.handleNewSMS)]
         self.pwrOnIfNeeded()
         self.deviceId = self.getDeviceId()
         self.lastPing = time.time()
         logPrint("Connected to GSM hat")
-        self.recv()
+        self.readAndHandleSMS()
 
     def initPwrPin(self):
         if not self.cfg['GSM_PWR_PIN']:
@@ -28,8 +158,7 @@ class GSMHat(object):
         GPIO.output(self.cfg['GSM_PWR_PIN'], GPIO.HIGH)
 
     def getDeviceId(self):
-        self.sendCmd(b"ATI")
-        id_data = self.normalizedRecv()
+        id_data = self.command(b"ATI")
         logPrint("ATI answer: %r" % id_data)
         if len(id_data) < 3:
             return None
@@ -51,18 +180,18 @@ class GSMHat(object):
         return True
 
     def configure(self):
+        if self.isConfigured:
+            return
         logPrint(colors.blue("Reconfiguring SMS format"))
-        self.sendCmd(b'AT+CSCS="UCS2"')
-        data = self.recv()
-        assert b"OK" in data, "Cant setup SMS to UCS2"
-        self.sendCmd(b"AT+CMGF=1")
-        data = self.recv()
-        assert b"OK" in data, "Cant setup SMS to TEXT mode"
+        assert isOK(self.command(b'AT+CSCS="UCS2"')), "Cant setup SMS to UCS2"
+        assert isOK(self.command(b"AT+CMGF=1")), "Cant setup SMS to TEXT mode"
+        self.isConfigured = True
 
     def pwrSwitch(self):
         if not self.cfg['GSM_PWR_PIN']:
             logPrint("No power pin")
             return
+        self.isConfigured = False
         GPIO.output(self.cfg['GSM_PWR_PIN'], GPIO.LOW)
         time.sleep(3)
         GPIO.output(self.cfg['GSM_PWR_PIN'], GPIO.HIGH)
@@ -70,79 +199,96 @@ class GSMHat(object):
         time.sleep(10)
 
     def pingDevice(self):
-        self.sendCmd(b"AT")
-        recv = self.recv(quiet=True)
-        if 10 < len(recv):
-            logPrint("Got extra data: " + colors.red(recv.decode('utf8')))
-        if b"OK" in recv[-10:]:
+        recv = self.command(b"AT", timeout=AT_PING_TIMEOUT, quiet=True)
+        if isOK(recv):
             return True
         logPrint(colors.bold(colors.yellow('Ping result in: %r' % recv)))
         return False
 
+    def decodeSMSText(self, data):
+        try:
+            return binascii.unhexlify(data).decode('utf-16be')
+        except:
+            return None
+
     def readSMS(self):
+        """ Reads all unread messages in storage, everything listed is later deleted """
         self.configure()
         messages = []
-        self.sendCmd(b'AT+CMGL="REC UNREAD"')
-        smsData = self.normalizedRecv()
-        logPrint("SMS data: " + colors.green(smsData))
+        smsData = self.command(b'AT+CMGL="ALL"')
+        logPrint("SMS data: " + colors.green(repr(smsData)))
+        smsId = None
+        isUnread = False
         for l in smsData:
-            if l.startswith(b'OK'):
-                break
-            if l.startswith(b'ERROR'):
+            if isFinalResult(l):
                 break
             if l.startswith(b'+CMGL: '):
                 # +CMGL: 6,"REC UNREAD","002B003900370032003500300035003200330037003800300039",,"" 0054006500730074
                 smsInfo = l[len(b'+CMGL: '):].split(b',')
                 smsId = int(smsInfo[0])
-                smsSender = smsInfo[2].replace(b'"', b'')
-                smsSender = binascii.unhexlify(smsSender).decode('utf-16be')
+                isUnread = (b'"REC UNREAD"' == smsInfo[1])
+                smsSender = self.decodeSMSText(smsInfo[2].replace(b'"', b''))
+                self.smsToDelete.add(smsId)
                 continue
-            try:
-                msg = binascii.unhexlify(l).decode('utf-16be')
-            except:
+            msg = self.decodeSMSText(l)
+            if None == smsId or None == msg or not isUnread:
                 continue
             logPrint("%d: %s sent: %s (%s)" % (smsId, smsSender, l, msg))
             messages.append((smsSender, msg))
-        # Delete all stored SMS
-        self.sendCmd(b'AT+CMGDA="DEL ALL"')
-        self.sendCmd(b'AT+CMGD=0,4')
-        deleteResult = self.recv()
-        logPrint(colors.blue(deleteResult.decode('utf8')))
         return messages
 
-    def hangUpCall(self):
-        self.sendCmd(b'AT+CHUP')
-
-    def normalizedRecv(self):
-        return [x.strip() for x in self.recv().replace(b'\r\n', b'\n').split(b'\n') if x.strip()]
+    def readSMSByIndex(self, smsId):
+        self.configure()
+        smsData = self.command(b'AT+CMGR=%d' % smsId)
+        self.smsToDelete.add(smsId)
+        smsSender = None
+        for l in smsData:
+            if isFinalResult(l):
+                break
+            if l.startswith(b'+CMGR: '):
+                # +CMGR: "REC UNREAD","002B003900370032003500300035003200330037003800300039",,"20/05/27,12:00:00+12"
+                smsInfo = l[len(b'+CMGR: '):].split(b',')
+                smsSender = self.decodeSMSText(smsInfo[1].replace(b'"', b''))
+                continue
+            msg = self.decodeSMSText(l)
+            if None == smsSender or None == msg:
+                continue
+            logPrint("%d: %s sent: %s (%s)" % (smsId, smsSender, l, msg))
+            return (smsSender, msg)
+        logPrint(colors.yellow("Can't parse SMS %d: %r" % (smsId, smsData)))
+        return None
 
-    def recv(self, quiet=False):
-        data = self.serial.read(1048576)
-        clearData = data.decode('utf8', errors='ignore').strip()
-        if clearData and not quiet:
-            logPrint(colors.faint(colors.red(clearData)))
-        return data
+    def deleteReadSMS(self):
+        for smsId in sorted(self.smsToDelete)[:SMS_DELETE_BATCH]:
+            self.smsToDelete.discard(smsId)
+            if not isOK(self.command(b'AT+CMGD=%d' % smsId, quiet=True)):
+                logPrint(colors.yellow("Failed to delete SMS %d" % smsId))
 
-    def sendCmd(self, cmd):
-        self.send(cmd + b'\r\n')
+    def hangUpCall(self):
+        return isOK(self.command(b'AT+CHUP'))
 
-    def send(self, data):
-        self.serial.write(data)
-        self.serial.flush()
+    def command(self, cmd, timeout=AT_DEFAULT_TIMEOUT, quiet=False):
+        return self.channel.command(cmd, timeout=timeout, quiet=quiet)
 
     def close(self):
+        self.channel.close()
         self.serial.close()
-        GPIO.cleanup()
+        if self.cfg['GSM_PWR_PIN']:
+            GPIO.cleanup(self.cfg['GSM_PWR_PIN'])
 
     def resetIfNeeded(self):
         if self.pwrOnIfNeeded():
             self.readAndHandleSMS()
 
+    def readAndHandleSMS(self):
+        detectedAt = time.monotonic()
+        for sender, msg in self.readSMS():
+            self.cmdQueue.put(('SMS', sender, msg, Trace('SMS', detectedAt).mark('queued')))
+
     def getCallingNumber(self):
-        self.sendCmd(b'AT+CLCC')
-        lines = self.normalizedRecv()
+        lines = self.command(b'AT+CLCC')
         for l in lines:
-            if len(l) < 10:
+            if not l.startswith(b'+CLCC: '):
                 continue
             info = l[len('+CLCC: '):].split(b',')
             if 0 != int(info[3]):
@@ -155,7 +301,52 @@ class GSMHat(object):
                 logPrint("Parsing error: %r" % l)
         return None
 
-    def answerCallClip(self, data):
+    def callEvent(self, receivedAt, callerId=None):
+        """ The session a RING or +CLIP belongs to, None for the ones of a call that ended """
+        if receivedAt < self.callEndedAt and callerId in (None, self.endedCallerId):
+            return None
+        if None == self.call:
+            self.call = CallSession(receivedAt)
+        self.call.lastEventAt = max(self.call.lastEventAt, receivedAt)
+        self.call.events += 1
+        return self.call
+
+    def endCall(self, endedAt, reason):
+        call = self.call
+        if None == call:
+            return
+        if call.isDecided:
+            logPrint("Call from %r ended (%s) after %d RING/CLIP" % (call.callerId, reason, call.events))
+        else:
+            logPrint(colors.yellow("Call ended (%s) before the caller was known" % reason))
+        self.call = None
+        self.callEndedAt = endedAt
+        self.endedCallerId = call.callerId
+
+    def checkCall(self, now):
+        """ Looks up the caller of a call that had no +CLIP and ends idle calls.
+        Returns the seconds until the call needs another check, None if there is no call """
+        call = self.call
+        if None == call:
+            return None
+        if not call.isDecided:
+            clccAt = call.startedAt + CALL_CLIP_GRACE
+            if now < clccAt:
+                return clccAt - now
+            callingNumber = self.getCallingNumber()
+            if not callingNumber:
+                self.endCall(time.monotonic(), "no active call")
+                return None
+            self.answerCall(call, callingNumber)
+            if None == self.call:
+                return None
+        idleAt = call.lastEventAt + CALL_IDLE_TIMEOUT
+        if idleAt <= now:
+            self.endCall(now, "idle")
+            return None
+        return idleAt - now
+
+    def answerCallClip(self, data, receivedAt):
         call_details = data.split()
         callerInfo = call_details[1]
         if callerInfo.count(b',') < 1:
@@ -163,42 +354,91 @@ class GSMHat(object):
         callerId = callerInfo.split(b',')[0].replace(b'"', b'')
         if len(callerId) < 3:
             return False
-        return self.answerCall(callerId)
+        call = self.callEvent(receivedAt, callerId)
+        if None == call or call.isDecided:
+            return False
+        return self.answerCall(call, callerId)
 
-    def answerCall(self, callerId):
+    def answerCall(self, call, callerId):
         logPrint(colors.yellow("%r is calling" % callerId))
-        self.cmdQueue.put(('GSM Call', callerId, None))
+        call.callerId = callerId
+        call.isDecided = True
+        self.cmdQueue.put(('GSM Call', callerId, None, Trace('Call', call.startedAt).mark('queued')))
         # We do not answer calls, just using the caller id
-        self.hangUpCall()
+        if self.hangUpCall():
+            self.endCall(time.monotonic(), "hung up")
+        return True
 
-    def mainLoop(self):
+    def handleRing(self, data, receivedAt):
+        # The caller comes with the +CLIP that follows, or from AT+CLCC in checkCall
+        self.callEvent(receivedAt)
+
+    def handleNewSMS(self, data, receivedAt):
+        # +CMTI: "SM",3
+        try:
+            smsId = int(data.split(b',')[-1])
+        except ValueError:
+            logPrint(colors.yellow("Can't parse %r, reading all messages" % data))
+            self.readAndHandleSMS()
+            return
+        sms = self.readSMSByIndex(smsId)
+        if sms:
+            self.cmdQueue.put(('SMS', sms[0], sms[1], Trace('SMS', receivedAt).mark('queued')))
+
+    def handleUrc(self, line, receivedAt):
+        if b"POWER DOWN" in line:
+            self.isConfigured = False
+            self.cmdQueue.put(('Notify', 'modem', line.decode('utf8', errors='ignore'), None))
+            time.sleep(4)
+            self.resetIfNeeded()
+            return
+        if line.startswith(CALL_END_URCS):
+            self.endCall(receivedAt, line.decode('utf8', errors='ignore'))
+            return
+        if line.startswith(b'RDY'):
+            # Modem restarted by itself, the SMS format settings are gone
+            self.isConfigured = False
+            return
+        for prefix, handler in self.urcHandlers:
+            if line.startswith(prefix):
+                handler(line, receivedAt)
+                return
+
+    def reconfigure(self, newCfg):
+        deviceChanges = self.cfg.diff(newCfg) & GSM_DEVICE_SETTINGS
+        if deviceChanges:
+            logPrint(colors.yellow("%s changed, used after the GSM module restarts" % ', '.join(sorted(deviceChanges))))
+            newCfg = newCfg.replace(**{key : self.cfg.get(key, None) for key in deviceChanges})
+        self.cfg = newCfg
+
+    def mainLoop(self, configUpdates=None):
         while not os.path.isfile(self.cfg['KILL_FILE']):
-            lines = self.normalizedRecv()
-            for l in lines:
-                l = l.strip()
-                if l.startswith(b'+CLIP:'):
-                    self.answerCallClip(l)
-                if l.startswith(b'RING'):
-                    callingNumber = self.getCallingNumber()
-                    if callingNumber:
-                        self.answerCall(callingNumber)
-                if l.startswith(b'+CMTI:'):
-                    msgs = self.readSMS()
-                    for sender, msg in msgs:
-                        self.cmdQueue.put(('SMS', sender, msg))
-                if b"POWER DOWN" in l:
-                    time.sleep(4)
-                    self.resetIfNeeded()
+            if not self.channel.running:
+                raise Exception("GSM serial reader stopped")
+            newCfg = pollConfigUpdate(configUpdates)
+            if None != newCfg:
+                self.reconfigure(newCfg)
+            timeout = URC_WAIT_TIMEOUT
+            callCheck = self.checkCall(time.monotonic())
+            if None != callCheck:
+                timeout = min(timeout, callCheck)
+            try:
+                line, receivedAt = self.channel.urcQueue.get(timeout=timeout)
+                self.handleUrc(line, receivedAt)
+            except queue.Empty:
+                if None == self.call:
+                    self.deleteReadSMS()
             if self.cfg['PING_INTERVAL'] < (time.time() - self.lastPing):
                 self.lastPing = time.time()
                 self.resetIfNeeded()
 
-def GSMHatRun(cfg, cmdQueue):
+def GSMHatRun(cfg, cmdQueue, configUpdates=None):
     validate_single_instance('gsmhat')
     gsm = None
     try:
         gsm = GSMHat(cfg, cmdQueue)
-        gsm.mainLoop()
+        reportReady('GSM')
+        gsm.mainLoop(configUpdates)
     except:
         last_error = traceback.format_exc()
         logPrint(colors.bold(colors.red(last_error)))
@@ -211,4 +451,3 @@ def GSMHatRun(cfg, cmdQueue):
 
 colorama.init(strip=False)
 
-
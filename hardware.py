@@ -0,0 +1,15 @@
+import os
+
+from common import *
+
+# 'pi' for the real board, 'sim' for the simulated devices in simhw.py.
+# The environment variable wins so spawned children follow the parent
+HARDWARE_BACKEND = os.environ.get('GATECTL_HARDWARE', cfg.get('HARDWARE_BACKEND', 'pi'))
+
+if 'sim' == HARDWARE_BACKEND:
+    from simhw import GPIO, FakeRFDevice as RFDevice
+else:
+    import RPi.GPIO as GPIO
+    from rpi_rf import RFDevice
+
+colorama.init(strip=False)
@@ -0,0 +1,101 @@
+import os
+import glob
+import math
+import time
+import collections
+
+from common import *
+
+HEALTH_HISTORY_SIZE = 1024
+HEALTH_SAMPLE_INTERVAL = 10
+THERMAL_ZONE = 'sys/class/thermal/thermal_zone0/temp'
+USB_DEVICES = 'sys/bus/usb/devices'
+
+HealthSample = collections.namedtuple('HealthSample',
+        ['timestamp', 'temperature', 'load1', 'memAvailable', 'memTotal', 'missingUsb'])
+# Numeric fields that get min / max / avg summaries
+SUMMARY_FIELDS = ('temperature', 'load1', 'memAvailable')
+
+def normalizeUsbId(usbId):
+    if isinstance(usbId, bytes):
+        usbId = usbId.decode('utf8')
+    return usbId.strip().lower()
+
+class HealthSampler(object):
+    """ Reads the board health straight from sysfs / procfs and keeps the last
+    samples in a ring buffer. sysRoot can point at a fake tree """
+    def __init__(self, mustExistUsb, sysRoot='/', historySize=HEALTH_HISTORY_SIZE):
+        self.sysRoot = sysRoot
+        self.setMustExistUsb(mustExistUsb)
+        self.history = collections.deque(maxlen=historySize)
+
+    def setMustExistUsb(self, mustExistUsb):
+        self.mustExistUsb = frozenset(normalizeUsbId(x) for x in mustExistUsb)
+
+    def path(self, *parts):
+        return os.path.join(self.sysRoot, *parts)
+
+    def readFile(self, *parts):
+        with open(self.path(*parts), 'r') as inFile:
+            return inFile.read()
+
+    def readTemperature(self):
+        try:
+            return int(self.readFile(THERMAL_ZONE)) / 1000.0
+        except (OSError, ValueError):
+            return math.nan
+
+    def readUsbIds(self):
+        usbIds = set()
+        for device in glob.glob(self.path(USB_DEVICES, '*', 'idVendor')):
+            device = os.path.dirname(device)
+            try:
+                usbIds.add('%s:%s' % (
+                    self.readFile(device, 'idVendor').strip().lower(),
+                    self.readFile(device, 'idProduct').strip().lower()))
+            except OSError:
+                continue
+        return usbIds
+
+    def readLoad(self):
+        try:
+            return float(self.readFile('proc/loadavg').split()[0])
+        except (OSError, ValueError, IndexError):
+            return math.nan
+
+    def readMemory(self):
+        """ Returns (available, total) in kB """
+        memory = {}
+        try:
+            for line in self.readFile('proc/meminfo').splitlines():
+                name, _, value = line.partition(':')
+                if name in ('MemAvailable', 'MemTotal'):
+                    memory[name] = int(value.split()[0])
+        except (OSError, ValueError, IndexError):
+            pass
+        return (memory.get('MemAvailable', math.nan), memory.get('MemTotal', math.nan))
+
+    def sample(self):
+        memAvailable, memTotal = self.readMemory()
+        missingUsb = tuple(sorted(self.mustExistUsb - self.readUsbIds()))
+        result = HealthSample(time.time(), self.readTemperature(), self.readLoad(), memAvailable, memTotal, missingUsb)
+        self.history.append(result)
+        return result
+
+    def summary(self):
+        """ Returns {field : (min, max, avg)} over the history, and how many samples had USB missing """
+        result = {}
+        for field in SUMMARY_FIELDS:
+            values = [getattr(x, field) for x in self.history if not math.isnan(getattr(x, field))]
+            if values:
+                result[field] = (min(values), max(values), sum(values) / len(values))
+        result['usbFailures'] = sum(1 for x in self.history if x.missingUsb)
+        result['samples'] = len(self.history)
+        return result
+
+    def logSummary(self, lastSamples=10):
+        logPrint("Health summary: %r" % self.summary())
+        for sample in list(self.history)[-lastSamples:]:
+            logPrint("Health sample: %r" % (sample,))
+
+colorama.init(strip=False)
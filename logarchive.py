@@ -0,0 +1,346 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import zlib
+import gzip
+import ctypes
+import platform
+import threading
+import collections
+
+from logpipe import FileSink
+
+# A new segment is started every period (seconds, a divisor of a day) or when the current one
+# grows past the size limit. Every process derives the same segment name, so they need no locking
+LOG_SEGMENT_PERIOD = 3600
+LOG_SEGMENT_MAX_SIZE = 1024 * 1024 * 16
+# Sealed segments are compressed as a series of gzip members, one per block of this many
+# seconds, so a read only decompresses the blocks of the time it asks for
+LOG_ARCHIVE_BLOCK_INTERVAL = 60
+LOG_ARCHIVE_BLOCK_SIZE = 1024 * 256
+# Oldest compressed segments are deleted when all of them take more than this
+LOG_ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
+LOG_ARCHIVE_CHECK_INTERVAL = 60
+# A segment untouched this long is not written by anyone
+LOG_ARCHIVE_SEAL_GRACE = 30
+LOG_ARCHIVE_COMPRESS_LEVEL = 6
+LOG_ARCHIVE_NICE = 19
+
+# gettid syscall numbers, for Python 3.7 that has no threading.get_native_id
+SYS_GETTID = {'x86_64' : 186, 'aarch64' : 178, 'armv6l' : 224, 'armv7l' : 224, 'i686' : 224}
+
+ARCHIVE_SUFFIX = '.gz'
+INDEX_SUFFIX = '.gz.idx'
+SEGMENT_PART_PATTERN = '%s_%d'
+
+def segmentStart(now, period):
+    day = time.localtime(now)
+    dayStart = time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0, 0, 0, -1))
+    return dayStart + ((now - dayStart) // period) * period
+
+def nativeThreadId():
+    """ The kernel id of the calling thread, setpriority with it changes only this thread """
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+    number = SYS_GETTID.get(platform.machine(), None)
+    if None == number:
+        raise OSError("No gettid for %s" % platform.machine())
+    return ctypes.CDLL(None, use_errno=True).syscall(number)
+
+def segmentPattern(fileName):
+    """ The segment file names, fileName with a %s for the segment id. Older configs name a
+    single file, like logs/ctl.log, its segments are logs/ctl_%s.log """
+    if '%s' in fileName:
+        return fileName
+    root, ext = os.path.splitext(fileName)
+    return root + '_%s' + ext
+
+def segmentSortKey(fileName):
+    # Numbers compare as numbers, so part 10 comes after part 9
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', os.path.basename(fileName))]
+
+class SegmentSink(FileSink):
+    """ Appends to the segment of the current period, moving to the next part of the period
+    once the segment is full. Writers in other processes see the same size and follow """
+    def __init__(self, fileName, period=LOG_SEGMENT_PERIOD, maxSize=LOG_SEGMENT_MAX_SIZE):
+        super(SegmentSink, self).__init__(segmentPattern(fileName))
+        self.period = period
+        self.maxSize = maxSize
+        self.segmentId = None
+        self.part = 0
+
+    def currentFileName(self, now):
+        start = segmentStart(now, self.period)
+        self.rolloverAt = start + self.period
+        segmentId = time.strftime('%Y%m%d_%H%M', time.localtime(start))
+        if segmentId != self.segmentId:
+            self.segmentId = segmentId
+            self.part = 0
+        while True:
+            name = self.segmentName()
+            try:
+                if os.path.getsize(name) < self.maxSize:
+                    return name
+            except OSError:
+                return name
+            self.part += 1
+
+    def segmentName(self):
+        if 0 == self.part:
+            return self.fileName % self.segmentId
+        return self.fileName % (SEGMENT_PART_PATTERN % (self.segmentId, self.part))
+
+    def write(self, records, formatter):
+        if None != self.stream and self.maxSize <= os.fstat(self.stream.fileno()).st_size:
+            self.close()
+        super(SegmentSink, self).write(records, formatter)
+
+class LogTimeParser(object):
+    """ Reads the asctime at the start of a log line, mktime is only called once per hour of data """
+    def __init__(self):
+        self.hours = {}
+
+    def parse(self, line):
+        # '[2026-10-18 10:24:19,476| INFO| ...', continuation lines of a record return None
+        if 25 > len(line) or '[' != line[0] or '|' != line[24]:
+            return None
+        try:
+            key = line[1:14]
+            base = self.hours.get(key, None)
+            if None == base:
+                base = time.mktime((int(line[1:5]), int(line[6:8]), int(line[9:11]), int(line[12:14]), 0, 0, 0, 0, -1))
+                self.hours[key] = base
+            return base + int(line[15:17]) * 60 + int(line[18:20]) + int(line[21:24]) / 1000
+        except ValueError:
+            return None
+
+def compressSegment(fileName, blockInterval=LOG_ARCHIVE_BLOCK_INTERVAL, blockSize=LOG_ARCHIVE_BLOCK_SIZE, level=LOG_ARCHIVE_COMPRESS_LEVEL):
+    """ Writes fileName.gz and its index, then removes fileName. The index lists for every
+    block the first and last time in it with its offset and length in the compressed file.
+    Lines of different processes are only roughly ordered, so first and last are the
+    smallest and largest time in the block """
+    parser = LogTimeParser()
+    blocks = []
+    with open(fileName, 'rb') as segment, open(fileName + ARCHIVE_SUFFIX + '.tmp', 'wb') as archive:
+        lines = []
+        size = 0
+        blockStart = None
+        first = last = None
+        def flushBlock():
+            data = gzip.compress(b''.join(lines), level)
+            blocks.append([first, last, archive.tell(), len(data)])
+            archive.write(data)
+        for line in segment:
+            timestamp = parser.parse(line[:25].decode('utf8', errors='replace'))
+            if None != timestamp:
+                if lines and (blockSize <= size or blockInterval <= timestamp - blockStart):
+                    flushBlock()
+                    lines = []
+                    size = 0
+                    first = last = None
+                if not lines or None == blockStart:
+                    blockStart = timestamp
+                first = timestamp if None == first else min(first, timestamp)
+                last = timestamp if None == last else max(last, timestamp)
+            lines.append(line)
+            size += len(line)
+        if lines:
+            flushBlock()
+        archive.flush()
+        os.fsync(archive.fileno())
+    known = [x for x in blocks if None != x[0]]
+    index = {
+        'segment' : os.path.basename(fileName),
+        'first' : min(x[0] for x in known) if known else None,
+        'last' : max(x[1] for x in known) if known else None,
+        'size' : os.path.getsize(fileName),
+        'blocks' : blocks}
+    with open(fileName + INDEX_SUFFIX + '.tmp', 'w') as indexFile:
+        json.dump(index, indexFile)
+    os.replace(fileName + INDEX_SUFFIX + '.tmp', fileName + INDEX_SUFFIX)
+    os.replace(fileName + ARCHIVE_SUFFIX + '.tmp', fileName + ARCHIVE_SUFFIX)
+    os.unlink(fileName)
+    return index
+
+class LogArchive(object):
+    """ Reads the log segments of fileNamePattern, compressed or not, by time """
+    def __init__(self, fileNamePattern):
+        self.fileNamePattern = segmentPattern(fileNamePattern)
+
+    def segments(self):
+        """ Segment names from the oldest, compressed ones without their suffix """
+        names = set(glob.glob(self.fileNamePattern % '*'))
+        names.update(x[:-len(INDEX_SUFFIX)] for x in glob.glob(self.fileNamePattern % '*' + INDEX_SUFFIX))
+        return sorted(names, key=segmentSortKey)
+
+    def loadIndex(self, segment):
+        try:
+            with open(segment + INDEX_SUFFIX, 'r') as indexFile:
+                return json.load(indexFile)
+        except (OSError, ValueError):
+            return None
+
+    def readBlock(self, segment, block):
+        with open(segment + ARCHIVE_SUFFIX, 'rb') as archive:
+            archive.seek(block[2])
+            data = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(archive.read(block[3]))
+        return data.decode('utf8', errors='replace').splitlines(True)
+
+    def readPlain(self, segment):
+        with open(segment, 'r', encoding='utf8', errors='replace') as plain:
+            yield from plain
+
+    def segmentBlocks(self, segment, index):
+        """ (first, last, read lines) for the blocks of a segment. A segment that is still
+        plain text is one block without known times """
+        if None == index:
+            if not os.path.isfile(segment):
+                return []
+            return [(None, None, lambda: self.readPlain(segment))]
+        return [(block[0], block[1], lambda block=block: self.readBlock(segment, block)) for block in index['blocks']]
+
+    def segmentIndex(self, segment):
+        if os.path.isfile(segment):
+            return None
+        return self.loadIndex(segment)
+
+    def range(self, start, end):
+        """ Yields the lines logged from start to end (epoch seconds) """
+        parser = LogTimeParser()
+        for segment in self.segments():
+            index = self.segmentIndex(segment)
+            if None != index and None != index['first'] and (index['last'] < start or end < index['first']):
+                continue
+            for first, last, read in self.segmentBlocks(segment, index):
+                if None != first and (last < start or end < first):
+                    continue
+                isInRange = False
+                for line in read():
+                    timestamp = parser.parse(line)
+                    if None != timestamp:
+                        isInRange = start <= timestamp <= end
+                    if isInRange:
+                        yield line
+
+    def tail(self, count):
+        """ The last count lines, reading only the blocks at the end """
+        lines = collections.deque(maxlen=count)
+        for segment in reversed(self.segments()):
+            for _, _, read in reversed(self.segmentBlocks(segment, self.segmentIndex(segment))):
+                lines.extendleft(reversed(collections.deque(read(), maxlen=count - len(lines))))
+                if count <= len(lines):
+                    return list(lines)
+        return list(lines)
+
+class LogArchiver(object):
+    """ Background thread that compresses the sealed log segments and keeps the archive
+    within its size budget. Runs in one process only, at the lowest CPU priority """
+    def __init__(self, fileNamePattern,
+            maxArchiveSize=LOG_ARCHIVE_MAX_SIZE,
+            checkInterval=LOG_ARCHIVE_CHECK_INTERVAL,
+            blockInterval=LOG_ARCHIVE_BLOCK_INTERVAL,
+            sealGrace=LOG_ARCHIVE_SEAL_GRACE,
+            log=None):
+        self.archive = LogArchive(fileNamePattern)
+        self.maxArchiveSize = maxArchiveSize
+        self.checkInterval = checkInterval
+        self.blockInterval = blockInterval
+        self.sealGrace = sealGrace
+        self.log = log
+        self.isClosing = threading.Event()
+        self.worker = None
+
+    def start(self):
+        self.worker = threading.Thread(target=self.workerLoop, name='log-archiver', daemon=True)
+        self.worker.start()
+
+    def close(self):
+        self.isClosing.set()
+        if None != self.worker:
+            self.worker.join()
+
+    def report(self, text):
+        if None != self.log:
+            self.log(text)
+        else:
+            sys.stderr.write(text + '\n')
+
+    def workerLoop(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, nativeThreadId(), LOG_ARCHIVE_NICE)
+        except OSError as e:
+            self.report("Can't lower the log archiver priority: %r" % e)
+        while not self.isClosing.wait(self.checkInterval):
+            try:
+                self.compressSealed()
+                self.enforceRetention()
+            except Exception as e:
+                self.report("Log archiver failed: %r" % e)
+
+    def sealedSegments(self):
+        """ Plain segments that are not the newest and were not written for a while """
+        plain = [x for x in self.archive.segments() if os.path.isfile(x)]
+        now = time.time()
+        return [x for x in plain[:-1] if self.sealGrace < now - os.path.getmtime(x)]
+
+    def compressSealed(self):
+        for segment in self.sealedSegments():
+            if self.isClosing.is_set():
+                return
+            index = compressSegment(segment, self.blockInterval)
+            self.report("Archived %s, %d blocks, %d bytes to %d" % (
+                    segment, len(index['blocks']), index['size'], os.path.getsize(segment + ARCHIVE_SUFFIX)))
+
+    def enforceRetention(self):
+        archived = [x for x in self.archive.segments() if os.path.isfile(x + ARCHIVE_SUFFIX)]
+        sizes = [os.path.getsize(x + ARCHIVE_SUFFIX) for x in archived]
+        total = sum(sizes)
+        for segment, size in zip(archived, sizes):
+            if total <= self.maxArchiveSize:
+                break
+            self.report("Archive is over %d bytes, removing %s" % (self.maxArchiveSize, segment))
+            os.unlink(segment + ARCHIVE_SUFFIX)
+            os.unlink(segment + INDEX_SUFFIX)
+            total -= size
+
+def parseTime(text):
+    for timeFormat in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, timeFormat))
+        except ValueError:
+            continue
+    raise ValueError("Bad time %r, use YYYY-mm-dd [HH:MM[:SS]]" % text)
+
+USAGE = """Usage: logarchive.py <command> [args]
+    tail [lines] [pattern]          Last lines of the log
+    range <from> <to> [pattern]     Lines logged between two times, YYYY-mm-dd [HH:MM[:SS]]
+    compress [pattern]              Compress the sealed segments now"""
+
+def main(argv, fileNamePattern='logs/ctl_%s.log'):
+    if len(argv) < 2:
+        print(USAGE)
+        return 1
+    command = argv[1]
+    args = argv[2:]
+    if 'tail' == command:
+        if 2 <= len(args):
+            fileNamePattern = args[1]
+        sys.stdout.writelines(LogArchive(fileNamePattern).tail(int(args[0]) if args else 50))
+    elif 'range' == command and 2 <= len(args):
+        if 3 <= len(args):
+            fileNamePattern = args[2]
+        sys.stdout.writelines(LogArchive(fileNamePattern).range(parseTime(args[0]), parseTime(args[1])))
+    elif 'compress' == command:
+        if args:
+            fileNamePattern = args[0]
+        LogArchiver(fileNamePattern, log=print).compressSealed()
+    else:
+        print(USAGE)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
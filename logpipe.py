@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import collections
+
+import colors
+
+LOG_FORMAT = '[%(asctime)s| %(levelname)s| %(processName)s] %(message)s'
+# Records written together, and the longest a record waits for its batch
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1
+# Records kept in memory for a crash dump
+LOG_RING_SIZE = 5000
+# Repeats of a message from one line of code allowed per window, the rest are counted and dropped
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 10
+# Messages tracked before the ones with an ended window are forgotten
+LOG_RATE_MAX_TRACKED = 1024
+# Red and yellow lines are errors and warnings, they always get through
+LOG_RATE_EXEMPT_COLORS = ('\x1b[31m', '\x1b[33m')
+
+class FileSink(object):
+    """ Appends plain text lines to fileName, or to fileName % date with a new file every day """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.isDaily = '%s' in fileName
+        self.rolloverAt = 0
+        self.stream = None
+
+    def currentFileName(self, now):
+        if not self.isDaily:
+            return self.fileName
+        day = time.localtime(now)
+        self.rolloverAt = time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        return self.fileName % time.strftime('%Y%m%d', day)
+
+    def write(self, records, formatter):
+        now = records[-1].created
+        if None == self.stream or (self.isDaily and self.rolloverAt <= now):
+            self.close()
+            fileName = self.currentFileName(now)
+            dirName = os.path.dirname(fileName)
+            if dirName:
+                os.makedirs(dirName, exist_ok=True)
+            self.stream = open(fileName, 'a')
+        # One write per batch, O_APPEND keeps the lines of different processes whole
+        self.stream.write(''.join(colors.strip_color(formatter.format(x)) + '\n' for x in records))
+        self.stream.flush()
+
+    def close(self):
+        if None != self.stream:
+            self.stream.close()
+            self.stream = None
+
+class TtySink(object):
+    """ Coloured output, only used when the stream is a terminal """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, records, formatter):
+        self.stream.write(''.join(formatter.format(x) + '\n' for x in records))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class RateLimitFilter(logging.Filter):
+    """ Passes up to limit repeats of a message from one call site in every window, then reports
+    how many were dropped. logPrint puts its caller in record.site """
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW, maxTracked=LOG_RATE_MAX_TRACKED):
+        super(RateLimitFilter, self).__init__()
+        self.limit = limit
+        self.window = window
+        self.maxTracked = maxTracked
+        self.lock = threading.Lock()
+        # (pathname, lineno, message) -> [window start, count, suppressed]
+        self.messages = {}
+
+    def isExempt(self, record, message):
+        return logging.WARNING <= record.levelno or any(x in message for x in LOG_RATE_EXEMPT_COLORS)
+
+    def forgetEnded(self, now):
+        for key, state in list(self.messages.items()):
+            if self.window <= now - state[0]:
+                del self.messages[key]
+
+    def filter(self, record):
+        message = record.getMessage()
+        if self.isExempt(record, message):
+            return True
+        pathname, lineno = getattr(record, 'site', (record.pathname, record.lineno))
+        key = (pathname, lineno, message)
+        with self.lock:
+            state = self.messages.get(key, None)
+            if None == state or self.window <= (record.created - state[0]):
+                suppressed = state[2] if state else 0
+                if None == state and self.maxTracked <= len(self.messages):
+                    self.forgetEnded(record.created)
+                self.messages[key] = [record.created, 1, 0]
+                if suppressed:
+                    record.msg = "%s (%d repeats suppressed from %s:%d)" % (
+                            message, suppressed, os.path.basename(pathname), lineno)
+                    record.args = None
+                return True
+            state[1] += 1
+            if state[1] <= self.limit:
+                return True
+            state[2] += 1
+            return False
+
+class RingBufferHandler(logging.Handler):
+    """ Keeps the last records in memory, before any rate limit """
+    def __init__(self, size=LOG_RING_SIZE):
+        super(RingBufferHandler, self).__init__()
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, fileName, reason=None):
+        formatter = self.formatter or logging.Formatter(LOG_FORMAT)
+        dirName = os.path.dirname(fileName)
+        if dirName:
+            os.makedirs(dirName, exist_ok=True)
+        with open(fileName, 'w') as dumpFile:
+            if reason:
+                dumpFile.write("# %s\n" % reason)
+            for record in list(self.records):
+                dumpFile.write(colors.strip_color(formatter.format(record)) + '\n')
+        return fileName
+
+class PipeHandler(logging.Handler):
+    """ Hands records to the writer thread, never touches the disk or blocks """
+    def __init__(self, pipe):
+        super(PipeHandler, self).__init__()
+        self.pipe = pipe
+
+    def emit(self, record):
+        self.pipe.put(record)
+
+    def handleError(self, record):
+        pass
+
+class LogPipe(object):
+    """ A writer thread that takes records from a queue and writes them to the sinks in batches """
+    def __init__(self, sinks, formatter, batchSize=LOG_BATCH_SIZE, flushInterval=LOG_FLUSH_INTERVAL):
+        self.sinks = sinks
+        self.formatter = formatter
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.records = queue.SimpleQueue()
+        self.pid = os.getpid()
+        self.writer = None
+        self.start()
+
+    def start(self):
+        self.writer = threading.Thread(target=self.writeLoop, name='log-writer', daemon=True)
+        self.writer.start()
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            # Forked, the writer thread stayed in the parent
+            self.pid = os.getpid()
+            self.records = queue.SimpleQueue()
+            self.start()
+        self.records.put(record)
+
+    def writeLoop(self):
+        while True:
+            record = self.records.get()
+            if None == record:
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flushInterval
+            isClosing = False
+            while len(batch) < self.batchSize:
+                try:
+                    record = self.records.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if None == record:
+                    isClosing = True
+                    break
+                batch.append(record)
+            self.writeBatch(batch)
+            if isClosing:
+                return
+
+    def writeBatch(self, batch):
+        for sink in self.sinks:
+            try:
+                sink.write(batch, self.formatter)
+            except Exception as e:
+                sys.stderr.write("Log sink %r failed: %r\n" % (sink, e))
+
+    def close(self):
+        """ Writes what is still queued """
+        if None != self.writer and self.writer.is_alive() and self.pid == os.getpid():
+            self.records.put(None)
+            self.writer.join(5)
+        for sink in self.sinks:
+            sink.close()
@@ -3,16 +3,29 @@ import os
 import sys
 import subprocess
 import multiprocessing as mp
+import multiprocessing.connection
+import queue
 import traceback
 import math
-
-import re
+import asyncio
+import concurrent.futures
 
 from common import *
 from gatectl import *
 from gsmhat import *
 from telegram_bot import *
 from rfcontrol import *
+from whitelist import *
+from fswatch import *
+from oplog import *
+from router import *
+from audio import *
+from health import *
+from tracing import *
+from aioruntime import *
+from confreload import *
+from supervisor import *
+from notify import *
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 EXPECTED_CONFIGURATIONS = [
@@ -38,59 +51,97 @@ EXPECTED_CONFIGURATIONS = [
         'RF_PROTO',
         'RF_PULSELENGTH',
         'RF_CODE']
-cfg = configLoad('config.py', EXPECTED_CONFIGURATIONS)
+CONFIG_TYPES = {
+        'PING_INTERVAL' : (int, float),
+        'TEMPERATURE_CHECK_INTERVAL' : (int, float),
+        'TELEGRAM_CHECK_INTERVAL' : (int, float),
+        'MAX_FAILS_IN_A_ROW' : int,
+        'MAX_USB_FAIL_COUNT' : int,
+        'MAX_LOG_FILE_SIZE' : int,
+        'OPEN_GATE_WORDS_LIST' : FrozenMapping,
+        'MUST_EXISTS_USB' : tuple}
+# Loaded once by common, on import
+cfg = validateConfig(cfg, EXPECTED_CONFIGURATIONS, CONFIG_TYPES)
+# Settings that win over the config file on reload, simhw points the devices at its fakes
+CONFIG_OVERRIDES = {}
+
+# Commands handled before going back to check the trigger files and timers
+COMMANDS_BATCH_SIZE = 32
+# Used only when inotify is not available
+TRIGGER_FILES_POLL_INTERVAL = 0.5
+# Seconds the asyncio runtime waits for module threads to see the KILL_FILE,
+# on top of the Telegram long poll
+MODULES_STOP_TIMEOUT = 15
+# Seconds a terminated module process has to exit before it is left behind
+MODULES_TERMINATE_TIMEOUT = 2
+# Imported once by the forkserver, the module processes are forked from it ready to run.
+# With __main__ preloaded the children don't import main.py and run its config again
+FORKSERVER_PRELOAD = ['__main__', 'common', 'tracing', 'hardware', 'gatectl', 'gsmhat', 'telegram_bot', 'rfcontrol']
+
+audioPlayer = None
+def getAudioPlayer():
+    global audioPlayer
+    if None == audioPlayer:
+        audioPlayer = AudioPlayer(
+                cfg['MP3_PLAYER'],
+                cfg.get('MP3_PLAYER_REMOTE_ARGS', PLAYER_REMOTE_ARGS),
+                cfg.get('AUDIO_USER', 'pi') if 0 == os.geteuid() else None)
+        audioPlayer.start()
+        audioPlayer.precache(cfg.get('AUDIO_PRECACHE', ['ping.mp3']))
+    return audioPlayer
 
-def runInBackground(cmd):
-    logPrint("Executing: " + colors.blue(cmd))
-    _ = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdin=None, close_fds=True)
+def closeAudioPlayer():
+    global audioPlayer
+    if None != audioPlayer:
+        audioPlayer.close()
+        audioPlayer = None
 
 def playMusic(fname):
+    if cfg.get('AUDIO_REMOTE_CONTROL', True):
+        getAudioPlayer().play(fname)
+        return
     # Clean current playing music
-    kill_process_by_name(cfg['MP3_PLAYER'])
-    cmd = "%s %s/%s &" % (cfg['MP3_PLAYER'], os.path.abspath('.'), fname)
+    processes.killByPurpose('music')
+    cmd = "%s %s/%s" % (cfg['MP3_PLAYER'], os.path.abspath('.'), fname)
     if 0 == os.geteuid():
-        runInBackground('runuser -l pi -c "%s"' % cmd)
+        runInBackground('runuser -l pi -c "%s"' % cmd, 'music')
     else:
-        runInBackground(cmd)
-
-def get_pi_temperature():
-    stdout, _ = subprocess.Popen(['vcgencmd', 'measure_temp'], stdout=subprocess.PIPE).communicate()
-    result = re.findall(b"([0-9\\.]*)'C", stdout)
-    if 1 != len(result):
-        return 0.0
-    return float(result[0])
-
-def validate_usb():
-    stdout, _ = subprocess.Popen(['lsusb'], stdout=subprocess.PIPE).communicate()
-    for usb_id in cfg['MUST_EXISTS_USB']:
-        if usb_id not in stdout:
-            logPrint(colors.red("USB failure!- %r is missing" % usb_id))
-            return False
-    return True
+        runInBackground(cmd, 'music')
 
 def reboot_system():
     logPrint(colors.red("Rebooting!!!"))
-    runInBackground("reboot")
+    runInBackground("reboot", 'reboot')
+
+def getProcessContext():
+    startMethod = cfg.get('START_METHOD', 'spawn')
+    ctx = mp.get_context(startMethod)
+    if 'forkserver' == startMethod:
+        ctx.set_forkserver_preload(cfg.get('FORKSERVER_PRELOAD', FORKSERVER_PRELOAD))
+    return ctx
 
 def run():
     assert validate_single_instance('main'), "Already running!"
     logPrint("My PID is %d" % os.getpid())
+    processes.killExternal(cfg['MP3_PLAYER'])
     playMusic('ping.mp3')
     logPrint(colors.blue("Starting!"))
     lastFail = 0
     failCount = 0
+    if 'asyncio' == cfg.get('RUNTIME', 'processes'):
+        controlType = AsyncGateControl
+    else:
+        controlType = GateControl
     keepRunning = True
     while keepRunning:
-        time.sleep(1)
         try:
-            with GateControl(cfg) as gateControl:
+            with controlType(cfg) as gateControl:
                 keepRunning = gateControl.mainLoop()
+            if keepRunning:
+                time.sleep(1)
         except:
             last_error = traceback.format_exc()
             logPrint(colors.bold(colors.red(last_error)))
+            logPrint("Log dumped to %s" % dumpLogRing("GateControl failed\n" + last_error))
             time.sleep(2)
             if 60 < (time.time() - lastFail):
                 failCount = 1
@@ -104,64 +155,110 @@ def run():
 class GateControl(object):
     def __init__(self, cfg):
         logPrint("Starting GateControl")
-        self.globalCtx = mp.get_context('spawn')
-        self.cmdQueue = self.globalCtx.Queue()
-        self.gateQueue = self.globalCtx.Queue()
+        self.globalCtx = getProcessContext()
+        self.cmdQueue, self.gateQueue = self.createQueues()
+        # The gate machine gets new configs on gateQueue, the rest on their own channel
+        self.configUpdates = {name : self.createUpdateChannel(name) for name in ['TelegramBot', 'GSM', 'RF']}
         self.gateModules = [
-                    (MachineLoopRun, 'gateMachine', 'gateMachineProcess', (cfg, self.gateQueue,)),
-                    (TelegramBotRun, 'TelegramBot', 'telegramBotProcess', (cfg, self.cmdQueue,)),
-                    (GSMHatRun, 'GSM', 'GSMHatProcess', (cfg, self.cmdQueue,)),
-                    (RFCtlRun, 'RF', 'RFCtlProcess', (cfg, self.cmdQueue,)),
+                    (MachineLoopRun, 'gateMachine', (self.gateQueue,)),
+                    (TelegramBotRun, 'TelegramBot', (self.cmdQueue, self.configUpdates['TelegramBot'])),
+                    (GSMHatRun, 'GSM', (self.cmdQueue, self.configUpdates['GSM'])),
+                    (RFCtlRun, 'RF', (self.cmdQueue, self.configUpdates['RF'])),
                 ]
-        self.modulesRestart = 0
-        for _, _, var, _ in self.gateModules:
-            setattr(self, var, None)
+        self.supervisor = self.createSupervisor()
+        for entryPoint, name, args in self.gateModules:
+            self.supervisor.add(name, entryPoint, args)
+        self.nextModuleStart = None
         self.lastPing = time.time()
         self.lastTempCheck = time.time()
+        self.lastHealthSample = 0
         self.usbFailCount = 0
+        self.health = HealthSampler(
+                cfg['MUST_EXISTS_USB'],
+                cfg.get('HEALTH_SYS_ROOT', '/'),
+                cfg.get('HEALTH_HISTORY_SIZE', HEALTH_HISTORY_SIZE))
         self.isLocked = False
+        self.whitelists = {}
+        self.notifier = createNotifier(cfg)
+        self.operationLog = OperationLog(
+                cfg['OPERATION_LOG'],
+                cfg.get('OPERATION_LOG_BATCH_SIZE', OPERATION_LOG_BATCH_SIZE),
+                cfg.get('OPERATION_LOG_FLUSH_INTERVAL', OPERATION_LOG_FLUSH_INTERVAL),
+                cfg.get('OPERATION_STORE', None))
+        self.router = MessageRouter(cfg['OPEN_GATE_WORDS_LIST'])
+        if '%s' not in cfg['LOG_FILE_NAME']:
+            logPrint(colors.yellow("LOG_FILE_NAME has no %%s, logging to %s" % segmentPattern(cfg['LOG_FILE_NAME'])))
+        self.logArchiver = LogArchiver(
+                cfg['LOG_FILE_NAME'],
+                cfg.get('LOG_ARCHIVE_MAX_SIZE', LOG_ARCHIVE_MAX_SIZE),
+                cfg.get('LOG_ARCHIVE_CHECK_INTERVAL', LOG_ARCHIVE_CHECK_INTERVAL),
+                cfg.get('LOG_ARCHIVE_BLOCK_INTERVAL', LOG_ARCHIVE_BLOCK_INTERVAL),
+                log=logPrint)
+        self.logArchiver.start()
+        self.configReloader = ConfigReloader(cfg, EXPECTED_CONFIGURATIONS, CONFIG_TYPES, CONFIG_OVERRIDES)
+
+    def createQueues(self):
+        return (PipeQueue(self.globalCtx), self.globalCtx.Queue())
+
+    def createUpdateChannel(self, name):
+        return self.globalCtx.Queue()
+
+    def createSupervisor(self):
+        return Supervisor(
+                self.launchModule,
+                self.isStopping,
+                cfg.get('MODULE_BACKOFF_MIN', MODULE_BACKOFF_MIN),
+                cfg.get('MODULE_BACKOFF_MAX', MODULE_BACKOFF_MAX),
+                cfg.get('MODULE_CRASH_WINDOW', MODULE_CRASH_WINDOW),
+                cfg.get('MODULE_CRASH_BUDGET', MODULE_CRASH_BUDGET))
+
+    def isStopping(self):
+        return os.path.isfile(cfg['KILL_FILE'])
 
     def __enter__(self):
         return self
 
     def __exit__(self, t, value, tb):
         self.isLocked = False
-        self.gateQueue.put(('close', ()))
+        self.gateQueue.put(('close', (), None))
+        self.operationLog.close()
+        self.notifier.close()
+        self.logArchiver.close()
+        self.router.close()
+        self.configReloader.close()
         if tb or value or t:
             trace = traceback.format_exc()
             logPrint(colors.red(trace))
         return
 
-    def writeToOperationLog(self, msg):
-        operationLog = cfg['OPERATION_LOG'] % datetime.now().strftime("%Y%m%d")
-        with open(operationLog, "ab") as log:
-            log.write(time.ctime().encode('utf8') + b'\t' + msg)
+    def writeToOperationLog(self, source, sender, message, access, trace=None):
+        latency = None
+        if None != trace:
+            latency = time.monotonic() - trace.stages[0][1]
+        self.operationLog.write(source, sender, message, access, latency)
+
+    def reboot(self, reason):
+        self.notifier.notify('reboot', None, reason)
+        # The reboot kills the sender thread, the alert must be out or spooled before it
+        self.notifier.flush()
+        reboot_system()
 
     def hasGateAccess(self, userId, whiteListFileName, isPhone):
         logPrint("Validating %r with whitelist %s (Is phone: %r)" % (userId, whiteListFileName, isPhone))
-        whitelist = []
-        userId = userId.strip()
-        if isPhone:
-            userId = userId.replace(b'-', b'').replace(b' ', b'').replace(b'.', b'')
-        with open(whiteListFileName, 'rb') as whiteListFile:
-            whitelist.extend(whiteListFile.read().split())
-        if userId in whitelist:
-            return True
-        if isPhone:
-            if (b'+972' + userId[1:]) in whitelist:
-                return True
-            if (b'972' + userId[1:]) in whitelist:
-                return True
-            if userId.startswith(b'+972') and (b'0' + userId[4:]) in whitelist:
-                return True
-            if userId.startswith(b'972') and (b'0' + userId[3:]) in whitelist:
-                return True
-        return False
-
-    def gateUp(self, uptime=2):
+        key = (whiteListFileName, isPhone)
+        whitelist = self.whitelists.get(key, None)
+        if None == whitelist:
+            whitelist = Whitelist(whiteListFileName, isPhone)
+            self.whitelists[key] = whitelist
+        return userId in whitelist
+
+    def gateUp(self, uptime=2, trace=None):
         if self.isLocked:
-            return
-        self.gateQueue.put(('up', (uptime,)))
+            return False
+        if None != trace:
+            trace.mark('gate_queued')
+        self.gateQueue.put(('up', (uptime,), trace))
+        return True
 
     def gateLock(self):
         self.isLocked = True
@@ -169,13 +266,13 @@ class GateControl(object):
     def gateUnlock(self):
         self.isLocked = False
 
-    def handleMessage(self, msg, whitelist, isPhone):
+    def handleMessage(self, msg, whitelist, isPhone, source, trace=None):
         sender, msg = msg
         msg = msg.strip()
         sender_utf8 = sender.encode('utf8')
-        got_access = False
+        got_access = None
         played = False
-        command = cfg['OPEN_GATE_WORDS_LIST'].get(msg, None)
+        command = self.router.getCommand(msg)
         uptime = 2
         if msg.isnumeric():
             command = 'up'
@@ -187,13 +284,14 @@ class GateControl(object):
         if command:
             logPrint("Got %s command" % command)
         if 'up' == command:
-            if self.hasGateAccess(sender_utf8, whitelist, isPhone):
-                got_access = True
-                self.gateUp(uptime=uptime)
+            got_access = self.hasGateAccess(sender_utf8, whitelist, isPhone)
+            if got_access:
+                self.gateUp(uptime=uptime, trace=trace)
             else:
                 logPrint(colors.red("No access to %r" % sender_utf8))
+                self.notifier.notify('denied', sender, "%s by %s" % (sender, source))
         elif 'reboot' == command:
-            reboot_system()
+            self.reboot("asked by %s over %s" % (sender, source))
         elif 'lock' == command:
             if self.hasGateAccess(sender_utf8, whitelist, isPhone):
                 self.gateLock()
@@ -202,27 +300,24 @@ class GateControl(object):
                 self.gateUnlock()
         elif 'gatereset' == command:
             if self.hasGateAccess(sender_utf8, whitelist, isPhone):
-                self.gateQueue.put(('resetGate', ()))
+                self.gateQueue.put(('resetGate', (), None))
         elif None != command:
             logPrint("Unknown command %s" % command)
         else:
-            for fname in os.listdir('./mp3/'):
-                if not fname.endswith('.mp3'):
-                    continue
-                if fname.startswith(msg) or msg.startswith(fname[:-4]):
-                    playMusic('./mp3/%s' % fname)
-                    played = True
-                    break
-        self.writeToOperationLog( \
-            b'Msg:\t%s\t%s\t%r\n' % (sender_utf8, msg.encode('utf8', errors='ignore'), got_access))
-
-    def handleCall(self, callerId):
+            fname = self.router.findMp3(msg)
+            if fname:
+                playMusic(fname)
+                played = True
+        self.writeToOperationLog(source, sender, msg, got_access, trace)
+
+    def handleCall(self, callerId, trace=None):
         isAllowedIn = self.hasGateAccess(callerId, 'whitelist.txt', True)
         if isAllowedIn:
-            self.gateUp()
+            self.gateUp(trace=trace)
         else:
             logPrint(colors.red("No access to %r" % callerId))
-        self.writeToOperationLog(b'Call:\t' + callerId + b'\t%r\n' % isAllowedIn)
+            self.notifier.notify('denied', callerId, "%s by Call" % toText(callerId))
+        self.writeToOperationLog('Call', callerId, None, isAllowedIn, trace)
 
     def readMessagesFromFile(self, inFileName):
         lines = []
@@ -236,66 +331,258 @@ class GateControl(object):
             messages.append((sender, data))
         return messages
 
+    def launchModule(self, entryPoint, name, args):
+        process = self.globalCtx.Process(
+                target=workerMain,
+                args=(entryPoint, name, time.monotonic(), cfg) + args,
+                name=name)
+        process.start()
+        return process
+
     def createSubProcessesSafe(self):
-        for entryPoint, name, var, args in self.gateModules:
-            process = getattr(self, var)
-            if None != process and process.is_alive():
-                continue
-            self.modulesRestart += 1
-            logPrint("Creating %s" % name)
-            process = self.globalCtx.Process(target=entryPoint, args=args, name=name)
-            setattr(self, var, process)
-            process.start()
+        delay = self.supervisor.startDue()
+        self.nextModuleStart = None if None == delay else time.monotonic() + delay
+
+    def isModuleStartDue(self):
+        return None != self.nextModuleStart and self.nextModuleStart <= time.monotonic()
 
     def killProcesses(self):
-        for _, _, var, _ in self.gateModules:
-            process = getattr(self, var)
-            if process and process.is_alive():
+        for process in self.supervisor.handles():
+            if process.is_alive():
                 process.terminate()
-                setattr(self, var, None)
+        for process in self.supervisor.handles():
+            process.join(MODULES_TERMINATE_TIMEOUT)
+        self.supervisor.reap()
+
+    def checkConfig(self):
+        if self.configReloader.isReloadNeeded():
+            self.applyConfig(*self.configReloader.reload())
+
+    def applyConfig(self, newCfg, changed):
+        """ Switches to newCfg and hands it to the modules, nothing is restarted.
+        Device settings (serial port, pins) still take a restart """
+        global cfg
+        if not changed:
+            return
+        cfg = newCfg
+        useConfig(newCfg)
+        if 'OPEN_GATE_WORDS_LIST' in changed:
+            self.router.setWords(cfg['OPEN_GATE_WORDS_LIST'])
+        if 'MUST_EXISTS_USB' in changed:
+            self.health.setMustExistUsb(cfg['MUST_EXISTS_USB'])
+        if changed & {'MP3_PLAYER', 'MP3_PLAYER_REMOTE_ARGS', 'AUDIO_USER', 'AUDIO_REMOTE_CONTROL'}:
+            closeAudioPlayer()
+        if changed & NOTIFY_SETTINGS:
+            # A slow Telegram must not hold the main loop, the old notifier finishes by itself
+            self.notifier.close(wait=False)
+            self.notifier = createNotifier(cfg, self.notifier)
+        self.gateQueue.put(('reconfigure', (newCfg,), None))
+        for updates in self.configUpdates.values():
+            updates.put(newCfg)
+
+    def handleCommand(self, moduleName, sender, msg, trace):
+        if 'Notify' == moduleName:
+            # From a module, sender is the kind of the event
+            self.notifier.notify(sender, None, msg)
+            return
+        trace.mark('dequeued')
+        if 'RF' == moduleName:
+            self.writeToOperationLog('RF', None, None, self.gateUp(trace=trace), trace)
+        elif 'TelegramBot' == moduleName:
+            self.handleMessage((sender, msg), 'telegram_whitelist.txt', True, 'Telegram', trace)
+        elif 'GSM Call' == moduleName:
+            self.handleCall(sender, trace)
+        elif 'SMS' == moduleName:
+            self.handleMessage((sender, msg), 'whitelist.txt', True, 'SMS', trace)
+
+    def handlePendingCommands(self):
+        for _ in range(COMMANDS_BATCH_SIZE):
+            try:
+                moduleName, sender, msg, trace = self.cmdQueue.get_nowait()
+            except queue.Empty:
+                return
+            self.handleCommand(moduleName, sender, msg, trace)
+
+    def checkTriggerFiles(self):
+        if os.path.isfile(cfg['GATEUP_TRIGGER_FILE']):
+            os.unlink(cfg['GATEUP_TRIGGER_FILE'])
+            trace = Trace('Local')
+            self.writeToOperationLog('Local', None, None, self.gateUp(trace=trace), trace)
+        if os.path.isfile(cfg['KILL_FILE']):
+            logPrint(colors.magenta("KTHXBYE"))
+            time.sleep(2)
+            self.killProcesses()
+            os.unlink(cfg['KILL_FILE'])
+            return False
+        return True
+
+    def runPeriodicChecks(self):
+        """ Returns the time left until the next check is due """
+        processes.reap()
+        now = time.time()
+        nextHealthSample = self.lastHealthSample + cfg.get('HEALTH_SAMPLE_INTERVAL', HEALTH_SAMPLE_INTERVAL)
+        if nextHealthSample <= now:
+            self.lastHealthSample = now
+            nextHealthSample = now + cfg.get('HEALTH_SAMPLE_INTERVAL', HEALTH_SAMPLE_INTERVAL)
+            self.health.sample()
+        nextTempCheck = self.lastTempCheck + cfg.get('TEMPERATURE_CHECK_INTERVAL', math.inf)
+        if nextTempCheck <= now:
+            self.lastTempCheck = now
+            nextTempCheck = now + cfg.get('TEMPERATURE_CHECK_INTERVAL', math.inf)
+            logPrint("Pi temperature is %f" % self.health.history[-1].temperature)
+        nextPing = self.lastPing + cfg['PING_INTERVAL']
+        if nextPing <= now:
+            if self.supervisor.isOverCrashBudget():
+                logPrint(colors.red("Modules keep failing, rebooting!"))
+                self.supervisor.logStatus()
+                self.reboot("modules keep failing")
+            sample = self.health.sample()
+            if sample.missingUsb:
+                logPrint(colors.red("USB failure!- %r is missing" % (sample.missingUsb,)))
+                for device in sample.missingUsb:
+                    self.notifier.notify('usb', device, "%s is missing" % toText(device))
+                self.usbFailCount += 1
+                if cfg['MAX_USB_FAIL_COUNT'] < self.usbFailCount:
+                    logPrint(colors.red("Too many USB failures, rebooting!"))
+                    self.health.logSummary()
+                    time.sleep(20)
+                    self.reboot("too many USB failures")
+            else:
+                self.usbFailCount = 0
+            self.lastPing = time.time()
+            nextPing = self.lastPing + cfg['PING_INTERVAL']
+        timeout = max(0, min(nextHealthSample, nextTempCheck, nextPing) - time.time())
+        if None != self.nextModuleStart:
+            timeout = min(timeout, max(0, self.nextModuleStart - time.monotonic()))
+        return timeout
+
+    def createTriggerWatcher(self):
+        triggerWatcher = DirWatcher(os.path.dirname(cfg['GATEUP_TRIGGER_FILE']))
+        if os.path.dirname(cfg['KILL_FILE']) != os.path.dirname(cfg['GATEUP_TRIGGER_FILE']):
+            if not triggerWatcher.addWatch(os.path.dirname(cfg['KILL_FILE'])):
+                triggerWatcher.close()
+        return triggerWatcher
 
     def mainLoop(self):
         logPrint("--- MainLoop ---")
-        while True:
+        triggerWatcher = self.createTriggerWatcher()
+        try:
             self.createSubProcessesSafe()
-            if os.path.isfile(cfg['GATEUP_TRIGGER_FILE']):
-                self.writeToOperationLog(b'LocalTrigger')
-                os.unlink(cfg['GATEUP_TRIGGER_FILE'])
-                self.gateUp()
-            if os.path.isfile(cfg['KILL_FILE']):
-                logPrint(colors.magenta("KTHXBYE"))
-                time.sleep(2)
-                self.killProcesses()
-                os.unlink(cfg['KILL_FILE'])
-                return False
-            if not self.cmdQueue.empty():
-                moduleName, sender, msg = self.cmdQueue.get()
-                if 'RF' == moduleName:
-                    self.writeToOperationLog('RF cmd')
-                    gatectl.gateUp()
-                elif 'TelegramBot' == moduleName:
-                    self.handleMessage((sender, msg), 'telegram_whitelist.txt', True)
-                elif 'GSM Call' == moduleName:
-                    self.handleCall(sender)
-                elif 'SMS' == moduleName:
-                    self.handleMessage((sender, msg), 'whitelist.txt', True)
-
-            if cfg.get('TEMPERATURE_CHECK_INTERVAL', math.inf) < (time.time() - self.lastTempCheck):
-                self.lastTempCheck = time.time()
-                logPrint("Pi temperature is %f" % get_pi_temperature())
-            if cfg['PING_INTERVAL'] < (time.time() - self.lastPing):
-                if 100 < self.modulesRestart:
-                    reboot_system()
-                if not validate_usb():
-                    self.usbFailCount += 1
-                    if cfg['MAX_USB_FAIL_COUNT'] < self.usbFailCount:
-                        logPrint(colors.red("Too many USB failures, rebooting!"))
-                        time.sleep(20)
-                        reboot_system()
+            sentinels = self.supervisor.sentinels()
+            checkTriggers = True
+            while True:
+                if checkTriggers and not self.checkTriggerFiles():
+                    return False
+                timeout = self.runPeriodicChecks()
+                waitOn = [self.cmdQueue] + sentinels
+                if None != triggerWatcher.fileno():
+                    waitOn.append(triggerWatcher.fileno())
                 else:
-                    self.usbFailCount = 0
-                self.lastPing = time.time()
-            time.sleep(0.01)
+                    timeout = min(timeout, TRIGGER_FILES_POLL_INTERVAL)
+                if None != self.router.fileno():
+                    waitOn.append(self.router.fileno())
+                waitOn.append(self.configReloader.signalFileno())
+                if None != self.configReloader.fileno():
+                    waitOn.append(self.configReloader.fileno())
+                ready = mp.connection.wait(waitOn, timeout)
+                self.checkConfig()
+                checkTriggers = (None == triggerWatcher.fileno())
+                if triggerWatcher.fileno() in ready:
+                    triggerWatcher.read()
+                    checkTriggers = True
+                if None != self.router.fileno() and self.router.fileno() in ready:
+                    self.router.handleEvents()
+                if self.cmdQueue in ready:
+                    self.handlePendingCommands()
+                if any(x in ready for x in sentinels) or self.isModuleStartDue():
+                    self.createSubProcessesSafe()
+                    sentinels = self.supervisor.sentinels()
+        finally:
+            triggerWatcher.close()
+
+class AsyncGateControl(GateControl):
+    """ Runs the module loops as threads of this process under an asyncio main loop,
+    one interpreter instead of five for the low memory boards """
+    # Shared by all instances, so a restart after an error keeps the module threads that still run
+    sharedCmdQueue = LoopQueue()
+    sharedGateQueue = queue.Queue()
+    sharedConfigUpdates = {}
+    sharedSupervisor = None
+    executor = None
+
+    def createQueues(self):
+        return (AsyncGateControl.sharedCmdQueue, AsyncGateControl.sharedGateQueue)
+
+    def createUpdateChannel(self, name):
+        return AsyncGateControl.sharedConfigUpdates.setdefault(name, queue.Queue())
+
+    def createSupervisor(self):
+        if None == AsyncGateControl.sharedSupervisor:
+            AsyncGateControl.sharedSupervisor = super(AsyncGateControl, self).createSupervisor()
+        return AsyncGateControl.sharedSupervisor
+
+    def launchModule(self, entryPoint, name, args):
+        if None == AsyncGateControl.executor:
+            AsyncGateControl.executor = concurrent.futures.ThreadPoolExecutor(len(self.gateModules), 'gatectl')
+        MODULE_START_REQUESTS[name] = time.monotonic()
+        future = self.executor.submit(entryPoint, cfg, *args)
+        future.add_done_callback(lambda _: self.cmdQueue.wake())
+        return ThreadHandle(future)
+
+    def killProcesses(self):
+        # Threads can't be terminated, the modules return once they see the KILL_FILE
+        self.gateQueue.put(('close', (), None))
+        concurrent.futures.wait(
+                [x.future for x in self.supervisor.handles()],
+                MODULES_STOP_TIMEOUT + cfg.get('TELEGRAM_LONG_POLL_TIMEOUT', 0))
+        self.supervisor.reap()
+        for module in self.supervisor.status():
+            if module['alive']:
+                logPrint(colors.red("%s did not stop" % module['name']))
+
+    def mainLoop(self):
+        return asyncio.run(self.mainLoopAsync())
+
+    async def mainLoopAsync(self):
+        logPrint("--- MainLoop (asyncio) ---")
+        loop = asyncio.get_running_loop()
+        triggerWatcher = self.createTriggerWatcher()
+        self.checkTriggers = True
+        def onTriggerEvent():
+            triggerWatcher.read()
+            self.checkTriggers = True
+        self.cmdQueue.bind(loop)
+        try:
+            if None != triggerWatcher.fileno():
+                loop.add_reader(triggerWatcher.fileno(), onTriggerEvent)
+            if None != self.router.fileno():
+                loop.add_reader(self.router.fileno(), self.router.handleEvents)
+            loop.add_reader(self.configReloader.signalFileno(), self.checkConfig)
+            if None != self.configReloader.fileno():
+                loop.add_reader(self.configReloader.fileno(), self.checkConfig)
+            self.createSubProcessesSafe()
+            while True:
+                if self.checkTriggers and not self.checkTriggerFiles():
+                    return False
+                self.checkTriggers = (None == triggerWatcher.fileno())
+                timeout = self.runPeriodicChecks()
+                if None == triggerWatcher.fileno():
+                    timeout = min(timeout, TRIGGER_FILES_POLL_INTERVAL)
+                await self.cmdQueue.wait(timeout)
+                if None == self.configReloader.fileno():
+                    self.checkConfig()
+                self.handlePendingCommands()
+                self.createSubProcessesSafe()
+        finally:
+            if None != triggerWatcher.fileno():
+                loop.remove_reader(triggerWatcher.fileno())
+            if None != self.router.fileno():
+                loop.remove_reader(self.router.fileno())
+            loop.remove_reader(self.configReloader.signalFileno())
+            if None != self.configReloader.fileno():
+                loop.remove_reader(self.configReloader.fileno())
+            self.cmdQueue.unbind()
+            triggerWatcher.close()
 
 if __name__ == '__main__':
     colorama.init(strip=False)
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+import collections
+
+from common import *
+from telegram_bot import TelegramApi, TelegramError, TELEGRAM_API_URL
+
+# Events that come within this many seconds of the first pending one go out as one message
+NOTIFY_BATCH_INTERVAL = 60
+# Telegram allows about one message per second in a chat and 20 per minute in a group
+NOTIFY_CHAT_RATE = 20 / 60.0
+NOTIFY_CHAT_BURST = 3
+NOTIFY_GLOBAL_RATE = 20
+NOTIFY_SEND_TIMEOUT = 10
+# The longest a reboot waits for its alert to be sent or spooled
+NOTIFY_FLUSH_TIMEOUT = 5
+# Messages that failed to send are kept here and retried, the oldest are dropped past the size
+NOTIFY_SPOOL_FILE = 'logs/notify_spool.json'
+NOTIFY_SPOOL_SIZE = 200
+NOTIFY_RETRY_MIN = 5
+NOTIFY_RETRY_MAX = 600
+# Subjects listed by name in a summary, the rest are counted
+NOTIFY_MAX_SUBJECTS = 5
+
+# Event kind -> (title of a single event, of many events, what the subjects are)
+NOTIFY_KINDS = {
+    'denied' : ("Access denied", "denied attempts", "senders"),
+    'usb' : ("USB failure", "USB failures", "devices"),
+    'reboot' : ("Rebooting", "reboots", None),
+    'modem' : ("GSM modem powered down", "GSM modem power downs", None)}
+# These go out without waiting for the batch, the process may not live to send them later
+NOTIFY_URGENT_KINDS = frozenset(['reboot'])
+# Changing any of these makes a new notifier
+NOTIFY_SETTINGS = frozenset([
+        'TELEGRAM_BOT_TOKEN',
+        'TELEGRAM_NOTIFY_CHATS',
+        'TELEGRAM_API_URL',
+        'NOTIFY_BATCH_INTERVAL',
+        'NOTIFY_CHAT_RATE',
+        'NOTIFY_CHAT_BURST',
+        'NOTIFY_SPOOL_FILE',
+        'NOTIFY_SPOOL_SIZE'])
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = time.monotonic()
+
+    def refill(self, now):
+        # now may be from before the bucket was made
+        if now <= self.updatedAt:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    def delay(self, now=None):
+        """ Seconds until a token is available, 0 if one is available now """
+        if None == now:
+            now = time.monotonic()
+        self.refill(now)
+        if 1 <= self.tokens:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def toText(value):
+    if None == value:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf8', errors='ignore')
+    return str(value)
+
+def summarize(kind, events, period):
+    """ One line for the events of a kind, like "12 denied attempts from 3 senders in the
+    last 60 sec: 0501234567 (10), bob, 0527654321" """
+    single, many, subjectsName = NOTIFY_KINDS.get(kind, (kind, kind + " events", None))
+    if 1 == len(events):
+        subject, text = events[0]
+        return "%s: %s" % (single, text or subject)
+    subjects = collections.Counter(subject for subject, _ in events if subject)
+    title = "%d %s" % (len(events), many)
+    if 1 == len(subjects):
+        title += " from %s" % next(iter(subjects))
+        subjects.clear()
+    elif subjectsName and subjects:
+        title += " from %d %s" % (len(subjects), subjectsName)
+    listed = ', '.join(
+            '%s (%d)' % (subject, count) if 1 < count else subject
+            for subject, count in subjects.most_common(NOTIFY_MAX_SUBJECTS))
+    if NOTIFY_MAX_SUBJECTS < len(subjects):
+        listed += ' and %d more' % (len(subjects) - NOTIFY_MAX_SUBJECTS)
+    text = "%s in the last %d sec" % (title, period)
+    if listed:
+        text += ": " + listed
+    return text
+
+class Notifier(object):
+    """ Sends alerts to Telegram chats from a background thread. notify never blocks,
+    events are collected for a batch interval and every chat gets one message per batch """
+    def __init__(self, token, chats,
+            apiUrl=TELEGRAM_API_URL,
+            batchInterval=NOTIFY_BATCH_INTERVAL,
+            chatRate=NOTIFY_CHAT_RATE,
+            chatBurst=NOTIFY_CHAT_BURST,
+            spoolFileName=NOTIFY_SPOOL_FILE,
+            spoolSize=NOTIFY_SPOOL_SIZE,
+            previous=None):
+        self.token = token
+        self.chats = list(chats)
+        self.apiUrl = apiUrl
+        self.batchInterval = batchInterval
+        self.chatRate = chatRate
+        self.chatBurst = chatBurst
+        self.spoolFileName = spoolFileName
+        self.events = queue.SimpleQueue()
+        self.api = None
+        self.buckets = {}
+        self.globalBucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+        # (chat, text) waiting to be sent, the ones that failed stay here for a retry
+        self.outbox = collections.deque(maxlen=spoolSize)
+        # The notifier this one replaces, it may still be sending what it had
+        self.previous = previous
+        self.retryAt = 0
+        self.retryDelay = 0
+        self.sender = None
+        if self.isEnabled():
+            self.sender = threading.Thread(target=self.senderLoop, name='Notifier', daemon=True)
+            self.sender.start()
+
+    def isEnabled(self):
+        return bool(self.token and self.chats)
+
+    def notify(self, kind, subject=None, text=None):
+        if None != self.sender:
+            self.events.put((kind, toText(subject), text, time.time()))
+
+    def close(self, wait=True):
+        """ Sends or spools what is pending. Without wait the sender thread does it on its own,
+        a notifier made with this one as previous takes over its spool once it is done """
+        if None != self.sender:
+            self.events.put(None)
+            if wait:
+                self.sender.join(NOTIFY_SEND_TIMEOUT * 2)
+
+    def flush(self, timeout=NOTIFY_FLUSH_TIMEOUT):
+        """ Waits up to timeout for the events so far to be sent, or spooled when they can't be.
+        Returns True if that happened in time """
+        if None == self.sender:
+            return False
+        flushed = threading.Event()
+        self.events.put(flushed)
+        return flushed.wait(timeout)
+
+    def loadSpool(self):
+        try:
+            with open(self.spoolFileName, 'r') as spool:
+                self.outbox.extend(tuple(x) for x in json.load(spool))
+        except (OSError, ValueError):
+            pass
+        if self.outbox:
+            logPrint("%d notifications left from the last run" % len(self.outbox))
+
+    def saveSpool(self):
+        try:
+            if not self.outbox:
+                if os.path.isfile(self.spoolFileName):
+                    os.unlink(self.spoolFileName)
+                return
+            dirName = os.path.dirname(self.spoolFileName)
+            if dirName:
+                os.makedirs(dirName, exist_ok=True)
+            with open(self.spoolFileName + '.tmp', 'w') as spool:
+                json.dump(list(self.outbox), spool)
+            os.replace(self.spoolFileName + '.tmp', self.spoolFileName)
+        except OSError as e:
+            logPrint(colors.red("Can't write the notification spool: %r" % e))
+
+    def compose(self, pending, period):
+        lines = [summarize(kind, events, period) for kind, events in pending.items()]
+        return '\n'.join(lines)
+
+    def bucket(self, chat):
+        bucket = self.buckets.get(chat, None)
+        if None == bucket:
+            bucket = TokenBucket(self.chatRate, self.chatBurst)
+            self.buckets[chat] = bucket
+        return bucket
+
+    def send(self, chat, text):
+        if None == self.api:
+            self.api = TelegramApi(self.token, self.apiUrl)
+        self.api.call('sendMessage', {'chat_id' : chat, 'text' : text}, readTimeout=NOTIFY_SEND_TIMEOUT)
+
+    def sendOutbox(self):
+        """ Sends what the rate limits allow, returns the seconds until more can be sent,
+        None when the outbox is empty """
+        isChanged = False
+        try:
+            while self.outbox:
+                now = time.monotonic()
+                if now < self.retryAt:
+                    return self.retryAt - now
+                chat, text = self.outbox[0]
+                delay = max(self.globalBucket.delay(now), self.bucket(chat).delay(now))
+                if 0 < delay:
+                    return delay
+                try:
+                    self.send(chat, text)
+                except Exception as e:
+                    if isinstance(e, TelegramError) and e.errorCode in (400, 403):
+                        # The chat is gone or the bot was blocked, retrying won't help
+                        logPrint(colors.red("Dropping notification to %s: %s" % (chat, e)))
+                        self.outbox.popleft()
+                        isChanged = True
+                        continue
+                    self.retryDelay = min(max(NOTIFY_RETRY_MIN, self.retryDelay * 2), NOTIFY_RETRY_MAX)
+                    if isinstance(e, TelegramError) and e.retryAfter:
+                        self.retryDelay = max(self.retryDelay, e.retryAfter)
+                    self.retryAt = time.monotonic() + self.retryDelay
+                    logPrint(colors.yellow("Notification failed (%r), %d waiting, retry in %d sec" % (
+                            e, len(self.outbox), self.retryDelay)))
+                    self.api = None
+                    isChanged = True
+                    return self.retryDelay
+                self.globalBucket.take()
+                self.bucket(chat).take()
+                self.outbox.popleft()
+                self.retryDelay = 0
+                isChanged = True
+            return None
+        finally:
+            # The spool only matters while something waits, a clean send leaves no file
+            if isChanged and (self.outbox or os.path.isfile(self.spoolFileName)):
+                self.saveSpool()
+
+    def senderLoop(self):
+        if None != self.previous and None != self.previous.sender:
+            self.previous.sender.join()
+        self.previous = None
+        self.loadSpool()
+        pending = collections.OrderedDict()
+        batchStart = None
+        isRunning = True
+        while isRunning:
+            timeouts = []
+            if None != batchStart:
+                timeouts.append(batchStart + self.batchInterval - time.monotonic())
+            try:
+                sendIn = self.sendOutbox()
+            except:
+                logPrint(colors.bold(colors.red(traceback.format_exc())))
+                sendIn = NOTIFY_RETRY_MIN
+            if None != sendIn:
+                timeouts.append(sendIn)
+            isUrgent = False
+            flushed = None
+            try:
+                event = self.events.get(timeout=max(0, min(timeouts)) if timeouts else None)
+                if None == event:
+                    isRunning = False
+                elif isinstance(event, threading.Event):
+                    flushed = event
+                else:
+                    kind, subject, text, _ = event
+                    pending.setdefault(kind, []).append((subject, text))
+                    isUrgent = kind in NOTIFY_URGENT_KINDS
+                    if None == batchStart:
+                        batchStart = time.monotonic()
+            except queue.Empty:
+                pass
+            if pending and (isUrgent or None != flushed or not isRunning or batchStart + self.batchInterval <= time.monotonic()):
+                text = self.compose(pending, max(1, time.monotonic() - batchStart))
+                for chat in self.chats:
+                    self.outbox.append((chat, text))
+                if self.retryDelay:
+                    # Sending fails, keep the new ones in case we don't live to retry
+                    self.saveSpool()
+                pending = collections.OrderedDict()
+                batchStart = None
+                if isUrgent or not isRunning:
+                    self.sendOutbox()
+            if None != flushed:
+                self.sendOutbox()
+                if self.outbox:
+                    self.saveSpool()
+                flushed.set()
+        # What the rate limit held back goes out with the next notifier
+        if self.outbox:
+            self.saveSpool()
+
+def createNotifier(cfg, previous=None):
+    return Notifier(
+            cfg.get('TELEGRAM_BOT_TOKEN', ''),
+            cfg.get('TELEGRAM_NOTIFY_CHATS', ()),
+            cfg.get('TELEGRAM_API_URL', TELEGRAM_API_URL),
+            cfg.get('NOTIFY_BATCH_INTERVAL', NOTIFY_BATCH_INTERVAL),
+            cfg.get('NOTIFY_CHAT_RATE', NOTIFY_CHAT_RATE),
+            cfg.get('NOTIFY_CHAT_BURST', NOTIFY_CHAT_BURST),
+            cfg.get('NOTIFY_SPOOL_FILE', NOTIFY_SPOOL_FILE),
+            cfg.get('NOTIFY_SPOOL_SIZE', NOTIFY_SPOOL_SIZE),
+            previous)
+
+colorama.init(strip=False)
@@ -0,0 +1,134 @@
+import os
+import time
+import queue
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from common import *
+
+# Every operation log line holds these tab separated fields
+OPERATION_LOG_FIELDS = ('timestamp', 'source', 'sender', 'message', 'access', 'latency')
+OPERATION_LOG_BATCH_SIZE = 64
+OPERATION_LOG_FLUSH_INTERVAL = 5
+
+def toLogField(value):
+    if None == value:
+        return ''
+    if isinstance(value, bytes):
+        value = value.decode('utf8', errors='ignore')
+    return str(value).replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+def formatOperation(timestamp, source, sender, message, access, latency):
+    return '%.3f\t%s\t%s\t%s\t%s\t%s\n' % (
+            timestamp,
+            toLogField(source),
+            toLogField(sender),
+            toLogField(message),
+            toLogField(access),
+            '' if None == latency else '%.6f' % latency)
+
+class OperationLog(object):
+    """ Collects operation records in memory and appends them to a daily file from a
+    background thread, so callers never wait for the SD card. With storeFileName the
+    batches also go to the indexed operation store """
+    def __init__(self, fileNamePattern, batchSize=OPERATION_LOG_BATCH_SIZE, flushInterval=OPERATION_LOG_FLUSH_INTERVAL, storeFileName=None):
+        self.fileNamePattern = fileNamePattern
+        self.storeFileName = storeFileName
+        self.store = None
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.dayStart = 0
+        self.dayEnd = 0
+        self.fileName = None
+        self.records = queue.Queue()
+        self.writer = threading.Thread(target=self.writerLoop, name='OperationLog', daemon=True)
+        self.writer.start()
+
+    def write(self, source, sender, message=None, access=None, latency=None, timestamp=None):
+        if None == timestamp:
+            timestamp = time.time()
+        self.records.put((timestamp, source, sender, message, access, latency))
+
+    def close(self):
+        self.records.put(None)
+        self.writer.join()
+
+    def getFileName(self, timestamp):
+        if not (self.dayStart <= timestamp < self.dayEnd):
+            day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+            self.dayStart = day.timestamp()
+            self.dayEnd = (day + timedelta(days=1)).timestamp()
+            self.fileName = self.fileNamePattern % day.strftime("%Y%m%d")
+        return self.fileName
+
+    def flush(self, batch):
+        lines = {}
+        for record in batch:
+            lines.setdefault(self.getFileName(record[0]), []).append(formatOperation(*record))
+        for fileName, data in lines.items():
+            dirName = os.path.dirname(fileName)
+            if dirName:
+                os.makedirs(dirName, exist_ok=True)
+            with open(fileName, 'a', encoding='utf8') as log:
+                log.write(''.join(data))
+
+    def openStore(self):
+        # SQLite connections stay in the thread that made them
+        if None == self.storeFileName:
+            return
+        try:
+            # Only loaded when the store is configured, sqlite3 stays out of the gate process otherwise
+            from opstore import OperationStore
+            self.store = OperationStore(self.storeFileName)
+        except:
+            self.store = None
+            logPrint(colors.bold(colors.red(traceback.format_exc())))
+
+    def flushToStore(self, batch):
+        if None == self.store:
+            return
+        try:
+            self.store.add(batch)
+        except:
+            logPrint(colors.bold(colors.red(traceback.format_exc())))
+
+    def writerLoop(self):
+        self.openStore()
+        try:
+            self.writeBatches()
+        finally:
+            if None != self.store:
+                self.store.close()
+
+    def writeBatches(self):
+        batch = []
+        flushTime = None
+        isRunning = True
+        while isRunning:
+            timeout = None
+            if batch:
+                timeout = max(0, flushTime - time.monotonic())
+            try:
+                record = self.records.get(timeout=timeout)
+                if None == record:
+                    isRunning = False
+                else:
+                    if not batch:
+                        flushTime = time.monotonic() + self.flushInterval
+                    batch.append(record)
+                    if len(batch) < self.batchSize:
+                        continue
+            except queue.Empty:
+                pass
+            if not batch:
+                continue
+            try:
+                self.flush(batch)
+            except:
+                last_error = traceback.format_exc()
+                logPrint(colors.bold(colors.red(last_error)))
+            self.flushToStore(batch)
+            batch = []
+
+colorama.init(strip=False)
@@ -0,0 +1,226 @@
+import os
+import sys
+import glob
+import time
+import datetime
+import sqlite3
+import colorama
+import colors
+
+from channels import CHANNELS, ACCESS_UNKNOWN, ACCESS_DENIED, ACCESS_GRANTED
+
+OPERATION_STORE = 'logs/operations.db'
+# Pages the WAL may grow to before it is folded back into the database
+OPERATION_STORE_CHECKPOINT_PAGES = 1000
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER PRIMARY KEY,
+        ts REAL NOT NULL,
+        source TEXT NOT NULL,
+        channel TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        message TEXT NOT NULL,
+        access INTEGER NOT NULL,
+        latency REAL)''',
+    # The same line may come from the live writer and from an import of its text log
+    'CREATE UNIQUE INDEX IF NOT EXISTS operations_entry ON operations (ts, source, sender, message)',
+    'CREATE INDEX IF NOT EXISTS operations_ts ON operations (ts)',
+    'CREATE INDEX IF NOT EXISTS operations_sender ON operations (sender, ts)',
+    'CREATE INDEX IF NOT EXISTS operations_channel ON operations (channel, ts)',
+    '''CREATE TABLE IF NOT EXISTS imported_files (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        entries INTEGER NOT NULL)''']
+
+def toText(value):
+    if None == value:
+        return ''
+    if isinstance(value, bytes):
+        return value.decode('utf8', errors='ignore')
+    return str(value)
+
+def toAccess(value):
+    if True is value:
+        return ACCESS_GRANTED
+    if False is value:
+        return ACCESS_DENIED
+    if value in (ACCESS_GRANTED, ACCESS_DENIED, ACCESS_UNKNOWN):
+        return value
+    return ACCESS_UNKNOWN
+
+def toChannel(source, sender):
+    channel = CHANNELS.get(source, None)
+    if None != channel:
+        return channel
+    if 'Msg:' == source:
+        # Old logs wrote 'Msg:' for both SMS and Telegram, Telegram senders are user names
+        return 'SMS' if sender.lstrip('+').isdigit() else 'Telegram'
+    return 'Other'
+
+def senderAliases(sender):
+    """ A phone number is logged in local or international form, depending on the modem """
+    if sender.startswith('+972'):
+        return (sender, '0' + sender[4:])
+    if sender.startswith('0') and sender.isdigit():
+        return (sender, '+972' + sender[1:])
+    return (sender,)
+
+class OperationStore(object):
+    """ Operation records in an indexed SQLite database. WAL mode lets the queries run
+    while the gate process is writing. A connection is used by the thread that made it """
+    def __init__(self, fileName=OPERATION_STORE, checkpointPages=OPERATION_STORE_CHECKPOINT_PAGES):
+        self.fileName = fileName
+        dirName = os.path.dirname(fileName)
+        if dirName:
+            os.makedirs(dirName, exist_ok=True)
+        self.db = sqlite3.connect(fileName, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # With WAL a power cut may lose the last transactions but never corrupts the file
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA wal_autocheckpoint=%d' % checkpointPages)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, records):
+        """ Inserts (timestamp, source, sender, message, access, latency) records in one
+        transaction, returns how many were new """
+        rows = []
+        for timestamp, source, sender, message, access, latency in records:
+            source = toText(source)
+            sender = toText(sender)
+            # Rounded like the text log, so importing it later finds the same entries
+            rows.append((round(timestamp, 3), source, toChannel(source, sender), sender, toText(message), toAccess(access), latency))
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                    'INSERT OR IGNORE INTO operations (ts, source, channel, sender, message, access, latency) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            return self.db.total_changes - before
+
+    def query(self, sql, args=()):
+        cursor = self.db.execute(sql, args)
+        names = [x[0] for x in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def lastSeen(self, sender, granted=True):
+        """ The newest entry of sender, only ones that opened the gate unless granted is False """
+        aliases = senderAliases(sender)
+        sql = 'SELECT * FROM operations WHERE sender IN (%s)' % ','.join('?' * len(aliases))
+        if granted:
+            sql += ' AND access = %d' % ACCESS_GRANTED
+        result = self.query(sql + ' ORDER BY ts DESC LIMIT 1', aliases)
+        return result[0] if result else None
+
+    def history(self, sender, since=0, until=None, limit=100):
+        """ Entries of sender in the range, newest first """
+        aliases = senderAliases(sender)
+        return self.query(
+                'SELECT * FROM operations WHERE sender IN (%s) AND ts >= ? AND ts < ? ORDER BY ts DESC LIMIT ?' % (
+                        ','.join('?' * len(aliases))),
+                aliases + (since, until or time.time() + 1, limit))
+
+    def denied(self, since=0, until=None, channel=None, limit=100):
+        """ Denied attempts in the range, newest first """
+        sql = 'SELECT * FROM operations WHERE access = %d AND ts >= ? AND ts < ?' % ACCESS_DENIED
+        args = [since, until or time.time() + 1]
+        if channel:
+            sql += ' AND channel = ?'
+            args.append(channel)
+        return self.query(sql + ' ORDER BY ts DESC LIMIT ?', args + [limit])
+
+    def counts(self, since=0, until=None):
+        """ Attempts, grants and denials per channel in the range """
+        return self.query(
+                'SELECT channel, COUNT(*) AS attempts, '
+                'SUM(access = %d) AS granted, SUM(access = %d) AS denied '
+                'FROM operations WHERE ts >= ? AND ts < ? GROUP BY channel ORDER BY attempts DESC' % (
+                        ACCESS_GRANTED, ACCESS_DENIED),
+                (since, until or time.time() + 1))
+
+    def importLogs(self, log_files):
+        """ Loads text operation logs, each file once unless it changed since its import.
+        Returns the number of new entries """
+        # The parser brings numpy, which the live writer has no use for
+        from stats import parse_single_file
+        total = 0
+        for fname in sorted(glob.glob(log_files)):
+            st = os.stat(fname)
+            imported = self.query('SELECT size, mtime_ns FROM imported_files WHERE name = ?', (os.path.abspath(fname),))
+            if imported and (st.st_size, st.st_mtime_ns) == (imported[0]['size'], imported[0]['mtime_ns']):
+                continue
+            columns = parse_single_file(fname)
+            entries = self.add(zip(
+                    columns['timestamp'],
+                    columns['action'],
+                    columns['sender'],
+                    columns['msg'],
+                    columns['gate_access'],
+                    (None if x != x else x for x in columns['latency'])))
+            with self.db:
+                self.db.execute(
+                        'INSERT OR REPLACE INTO imported_files (name, size, mtime_ns, entries) VALUES (?, ?, ?, ?)',
+                        (os.path.abspath(fname), st.st_size, st.st_mtime_ns, entries))
+            print("%s: %d new entries" % (fname, entries))
+            total += entries
+        return total
+
+def formatEntry(entry):
+    return '%s\t%-8s\t%s\t%s\t%s' % (
+            datetime.datetime.fromtimestamp(entry['ts']).strftime('%Y-%m-%d %H:%M:%S'),
+            entry['channel'],
+            entry['sender'],
+            entry['message'],
+            {ACCESS_GRANTED : colors.green('granted'), ACCESS_DENIED : colors.red('denied')}.get(entry['access'], '-'))
+
+def daysAgo(days):
+    return time.time() - float(days) * 86400
+
+USAGE = """Usage: opstore.py <command> [args]
+    last-seen <sender>          When sender last opened the gate
+    history <sender> [days]     Entries of sender, last 30 days by default
+    denied [days] [channel]     Denied attempts, last 7 days by default
+    counts [days]               Attempts per channel, last 30 days by default
+    import [files glob]         Load the text operation logs"""
+
+def main(argv, storeFileName=OPERATION_STORE):
+    if len(argv) < 2:
+        print(USAGE)
+        return 1
+    command = argv[1]
+    args = argv[2:]
+    if 'import' == command:
+        store = OperationStore(storeFileName)
+        logFiles = args[0] if args else 'logs/operation_*.log'
+        print("Imported %d entries" % store.importLogs(logFiles))
+        return 0
+    if not os.path.isfile(storeFileName):
+        print(colors.red("%s not found" % storeFileName))
+        return 1
+    store = OperationStore(storeFileName)
+    if 'last-seen' == command and 1 == len(args):
+        entry = store.lastSeen(args[0])
+        print(formatEntry(entry) if entry else "%s never opened the gate" % args[0])
+    elif 'history' == command and 1 <= len(args):
+        for entry in store.history(args[0], daysAgo(args[1] if 2 <= len(args) else 30)):
+            print(formatEntry(entry))
+    elif 'denied' == command:
+        for entry in store.denied(daysAgo(args[0] if args else 7), channel=args[1] if 2 <= len(args) else None):
+            print(formatEntry(entry))
+    elif 'counts' == command:
+        for row in store.counts(daysAgo(args[0] if args else 30)):
+            print('%(channel)-8s\t%(attempts)d attempts\t%(granted)d granted\t%(denied)d denied' % row)
+    else:
+        print(USAGE)
+        return 1
+    return 0
+
+colorama.init(strip=False)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
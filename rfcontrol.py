@@ -1,82 +1,158 @@
-from rpi_rf import RFDevice
-import RPi.GPIO as GPIO
+from hardware import GPIO, RFDevice
+import bisect
+import queue
 import traceback
 
 from common import *
+from tracing import *
+
+# Codes repeating within this many seconds are one button press
+RF_HOLD_WINDOW = 1.0
+RF_KILL_CHECK_INTERVAL = 1
+
+class NotifyingRFDevice(RFDevice):
+    """ rpi_rf device that pushes every decoded code to a queue from the edge callback,
+    so the listener can block instead of polling rx_code_timestamp """
+    def __init__(self, gpio, notifyQueue, **kwargs):
+        super().__init__(gpio, **kwargs)
+        self.notifyQueue = notifyQueue
+
+    def _rx_waveform(self, pnum, change_count, timestamp):
+        if not super()._rx_waveform(pnum, change_count, timestamp):
+            return False
+        self.notifyQueue.put((self.rx_code, self.rx_pulselength, self.rx_proto, time.monotonic()))
+        return True
+
+    def cleanup(self):
+        # Only our pin, the gate and modem pins may belong to the same process
+        if self.tx_enabled:
+            self.disable_tx()
+        if self.rx_enabled:
+            self.disable_rx()
+        GPIO.cleanup(self.gpio)
+
+class IntervalSet(object):
+    """ Sorted, merged [min, max] ranges with a bisect lookup """
+    def __init__(self, ranges):
+        # Config may hold a single (min, max) pair instead of a list of them
+        if 2 == len(ranges) and all(isinstance(x, int) for x in ranges):
+            ranges = [ranges]
+        merged = []
+        for low, high in sorted((min(x), max(x)) for x in ranges):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        self.starts = [x[0] for x in merged]
+        self.ends = [x[1] for x in merged]
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        return 0 <= i and value <= self.ends[i]
+
+    def __repr__(self):
+        return repr(list(zip(self.starts, self.ends)))
 
 class RFControl(object):
-    def __init__(self, rf_gpio, proto, code, pulselength):
+    def __init__(self, rf_gpio, proto, code, pulselength, holdWindow=RF_HOLD_WINDOW):
         self.rf_gpio = rf_gpio
         self.dev = None
+        self.codes = queue.Queue()
         if not rf_gpio:
             logPrint("RF control is disabled")
             return
-        self.proto = proto
-        self.code_ranges = code
-        self.pulse_ranges = pulselength
-        self.last_timestamp = None
+        self.configure(proto, code, pulselength, holdWindow)
+        self.lastSeen = {}
         GPIO.setmode(GPIO.BOARD)
-        self.dev = RFDevice(self.rf_gpio)
+        self.dev = NotifyingRFDevice(self.rf_gpio, self.codes)
         self.dev.enable_rx()
         if self.proto:
             logPrint("RF control ready - Waiting for protcol %x Code (%r) Pulse length(%r)" %
                     (self.proto, self.code_ranges, self.pulse_ranges))
 
+    def configure(self, proto, code, pulselength, holdWindow=RF_HOLD_WINDOW):
+        self.proto = proto
+        self.code_ranges = IntervalSet(code)
+        self.pulse_ranges = IntervalSet(pulselength)
+        self.holdWindow = holdWindow
+
     def cleanup(self):
         if self.dev:
             logPrint("RF cleanup")
             self.dev.cleanup()
             self.dev = None
 
-    def should_open_the_gate(self):
-        if not self.dev:
-            return False
-        if self.last_timestamp == self.dev.rx_code_timestamp:
-            return False
-        self.last_timestamp = self.dev.rx_code_timestamp
-        proto       = self.dev.rx_proto
-        code        = self.dev.rx_code
-        pulselength = self.dev.rx_pulselength
+    def is_valid(self, code, pulselength, proto):
         if None != self.proto and proto != self.proto:
             return False
-        #logPrint("Got RF signal: code %d pulselength %d" % (code, pulselength))
-        for pulse_min, pulse_max in self.pulse_ranges:
-            if pulse_min <= pulselength <= pulse_max:
-                break
-        else:
-            return False
-        for code_min, code_max in self.code_ranges:
-            if code_min <= code <= code_max:
-                break
-        else:
-            return False
-        return True
+        return pulselength in self.pulse_ranges and code in self.code_ranges
+
+    def is_repeat(self, code, receivedAt):
+        """ A held button keeps decoding the same code, the window slides while it repeats """
+        lastSeen = self.lastSeen.get(code, None)
+        self.lastSeen[code] = receivedAt
+        return None != lastSeen and (receivedAt - lastSeen) < self.holdWindow
+
+    def wait_for_open(self, timeout=None):
+        """ Blocks until a valid code is pressed, returns its receive time or None on timeout """
+        deadline = None if None == timeout else time.monotonic() + timeout
+        while self.dev:
+            try:
+                code, pulselength, proto, receivedAt = self.codes.get(
+                        timeout=None if None == deadline else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+            #logPrint("Got RF signal: code %d pulselength %d" % (code, pulselength))
+            if not self.is_valid(code, pulselength, proto):
+                continue
+            if self.is_repeat(code, receivedAt):
+                continue
+            return receivedAt
+        return None
 
 def rf_test(gpio):
     gpio = int(gpio)
     rfCtl = RFControl(gpio, None, [(0, 1000)], [(0, 10000)])
     logPrint("Starting loop")
     while True:
-        rfCtl.should_open_the_gate()
-        time.sleep(0.1)
+        code, pulselength, proto, receivedAt = rfCtl.codes.get()
+        logPrint("Got RF signal: code %d pulselength %d protocol %d" % (code, pulselength, proto))
 
-def RFCtlRun(cfg, cmdQueue):
+def RFCtlRun(cfg, cmdQueue, configUpdates=None):
     validate_single_instance('rfctl')
-    rfCtl = RFControl(cfg['RF_GPIO'], cfg['RF_PROTO'], cfg['RF_CODE'], cfg['RF_PULSELENGTH'])
+    rfCtl = RFControl(
+            cfg['RF_GPIO'],
+            cfg['RF_PROTO'],
+            cfg['RF_CODE'],
+            cfg['RF_PULSELENGTH'],
+            cfg.get('RF_HOLD_WINDOW', RF_HOLD_WINDOW))
+    reportReady('RF')
     while True:
         if os.path.isfile(cfg['KILL_FILE']):
             rfCtl.cleanup()
             logPrint(colors.magenta("rfCtl KTHXBYE"))
             return False
-        while True:
-            try:
-                if rfCtl.should_open_the_gate():
-                    cmdQueue.put(('RF', None, None))
-                time.sleep(0.01)
-            except:
-                last_error = traceback.format_exc()
-                logPrint(colors.bold(colors.red(last_error)))
-                time.sleep(10)
+        try:
+            newCfg = pollConfigUpdate(configUpdates)
+            if None != newCfg:
+                if newCfg['RF_GPIO'] != cfg['RF_GPIO']:
+                    logPrint(colors.yellow("RF_GPIO changed, used after the RF module restarts"))
+                if rfCtl.dev:
+                    rfCtl.configure(
+                            newCfg['RF_PROTO'],
+                            newCfg['RF_CODE'],
+                            newCfg['RF_PULSELENGTH'],
+                            newCfg.get('RF_HOLD_WINDOW', RF_HOLD_WINDOW))
+                cfg = newCfg
+            if not rfCtl.dev:
+                time.sleep(RF_KILL_CHECK_INTERVAL)
+                continue
+            receivedAt = rfCtl.wait_for_open(RF_KILL_CHECK_INTERVAL)
+            if None != receivedAt:
+                cmdQueue.put(('RF', None, None, Trace('RF', receivedAt).mark('queued')))
+        except:
+            last_error = traceback.format_exc()
+            logPrint(colors.bold(colors.red(last_error)))
+            time.sleep(10)
 
 colorama.init(strip=False)
-
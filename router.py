@@ -0,0 +1,68 @@
+import os
+import time
+import bisect
+
+from common import *
+from fswatch import *
+
+MP3_DIR = './mp3/'
+# Used only when inotify is not available for the mp3 directory
+MP3_REFRESH_INTERVAL = 60
+
+def normalizeMessage(msg):
+    return ' '.join(msg.lower().split())
+
+class MessageRouter(object):
+    """ Maps incoming messages to commands or mp3 clips without touching the disk,
+    the clips index is rebuilt when the mp3 directory changes """
+    def __init__(self, wordsList, mp3Dir=MP3_DIR):
+        self.setWords(wordsList)
+        self.mp3Dir = mp3Dir
+        self.mp3Names = []
+        self.mp3Set = frozenset()
+        self.lastRefresh = 0
+        self.watcher = DirWatcher(mp3Dir, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+        self.refreshMp3()
+
+    def setWords(self, wordsList):
+        self.commands = {normalizeMessage(words) : command for words, command in wordsList.items()}
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def handleEvents(self):
+        if self.watcher.read():
+            self.refreshMp3()
+
+    def refreshMp3(self):
+        self.lastRefresh = time.monotonic()
+        try:
+            names = [fname[:-4] for fname in os.listdir(self.mp3Dir) if fname.endswith('.mp3')]
+        except OSError:
+            names = []
+        self.mp3Names = sorted(names)
+        self.mp3Set = frozenset(names)
+        logPrint("Indexed %d mp3 files" % len(self.mp3Names))
+
+    def getCommand(self, msg):
+        return self.commands.get(normalizeMessage(msg), None)
+
+    def findMp3(self, msg):
+        """ Returns the path of a clip whose name starts with the message, or whose name
+        the message starts with """
+        if None == self.watcher.fileno() and MP3_REFRESH_INTERVAL < (time.monotonic() - self.lastRefresh):
+            self.refreshMp3()
+        if not msg:
+            return None
+        i = bisect.bisect_left(self.mp3Names, msg)
+        if i < len(self.mp3Names) and self.mp3Names[i].startswith(msg):
+            return os.path.join(self.mp3Dir, self.mp3Names[i] + '.mp3')
+        for end in range(len(msg), 0, -1):
+            if msg[:end] in self.mp3Set:
+                return os.path.join(self.mp3Dir, msg[:end] + '.mp3')
+        return None
+
+    def close(self):
+        self.watcher.close()
+
+colorama.init(strip=False)
@@ -0,0 +1,377 @@
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import random
+import binascii
+import threading
+import http.server
+
+from common import *
+
+SIM_GPIO_LOG = 'GATECTL_SIM_GPIO_LOG'
+SIM_RF_SCRIPT = 'GATECTL_SIM_RF_SCRIPT'
+
+class FakeGPIO(object):
+    """ Stands in for the RPi.GPIO module and records every pin change """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+    BOTH = 33
+    RISING = 31
+    FALLING = 32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.pins = {}
+        self.timeline = []
+        self.callbacks = {}
+        self.logFileName = os.environ.get(SIM_GPIO_LOG, None)
+
+    def record(self, pin, what, value):
+        event = (time.monotonic(), os.getpid(), pin, what, value)
+        with self.lock:
+            self.timeline.append(event)
+            if self.logFileName:
+                with open(self.logFileName, 'a') as log:
+                    log.write('%f\t%d\t%s\t%s\t%r\n' % event)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, **kwargs):
+        self.pins[pin] = self.pins.get(pin, self.LOW)
+        self.record(pin, 'setup', direction)
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+        self.record(pin, 'output', value)
+
+    def input(self, pin):
+        return self.pins.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, **kwargs):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        if None == pins:
+            pins = list(self.pins.keys())
+        elif not isinstance(pins, (list, tuple)):
+            pins = [pins]
+        for pin in pins:
+            self.pins.pop(pin, None)
+            self.record(pin, 'cleanup', None)
+
+GPIO = FakeGPIO()
+
+class FakeRFDevice(object):
+    """ Stands in for rpi_rf.RFDevice, replays codes from a script file with lines of:
+    <delay sec> <code> <pulse length> <protocol> """
+    def __init__(self, gpio, **kwargs):
+        self.gpio = gpio
+        self.tx_enabled = False
+        self.rx_enabled = False
+        self.rx_code = None
+        self.rx_code_timestamp = None
+        self.rx_proto = None
+        self.rx_bitlength = None
+        self.rx_pulselength = None
+        self.pending = None
+        self.player = None
+
+    def enable_rx(self):
+        if self.rx_enabled:
+            return True
+        self.rx_enabled = True
+        script = os.environ.get(SIM_RF_SCRIPT, None)
+        if script:
+            self.player = threading.Thread(target=self.playScript, args=(script,), daemon=True)
+            self.player.start()
+        return True
+
+    def disable_tx(self):
+        self.tx_enabled = False
+
+    def disable_rx(self):
+        self.rx_enabled = False
+
+    def cleanup(self):
+        self.disable_rx()
+
+    def playScript(self, script):
+        with open(script, 'r') as scriptFile:
+            lines = [x.split() for x in scriptFile.readlines() if x.strip() and not x.startswith('#')]
+        for delay, code, pulselength, proto in lines:
+            time.sleep(float(delay))
+            if not self.rx_enabled:
+                return
+            self.receive(int(code), int(pulselength), int(proto))
+
+    def receive(self, code, pulselength, proto=1):
+        """ Acts as if a full code was decoded from the air """
+        self.pending = (code, pulselength, proto)
+        self._rx_waveform(proto, 0, int(time.perf_counter() * 1000000))
+
+    def _rx_waveform(self, pnum, change_count, timestamp):
+        if None == self.pending:
+            return False
+        self.rx_code, self.rx_pulselength, self.rx_proto = self.pending
+        self.rx_bitlength = 24
+        self.rx_code_timestamp = timestamp
+        self.pending = None
+        return True
+
+def toUCS2(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf8')
+    return binascii.hexlify(text.encode('utf-16be')).upper()
+
+class FakeModem(object):
+    """ A SIM modem on a pseudo terminal, speaks the part of the AT dialect GSMHat uses.
+    Point GSM_SERIAL_DEV at slaveName """
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.slaveName = os.ttyname(self.slave)
+        self.writeLock = threading.Lock()
+        self.stateLock = threading.Lock()
+        self.storage = {}
+        self.nextIndex = 0
+        self.caller = None
+        self.commandsCount = 0
+        self.reader = threading.Thread(target=self.readLoop, daemon=True)
+        self.reader.start()
+
+    def write(self, *lines):
+        data = b''.join(b'\r\n' + x + b'\r\n' for x in lines)
+        with self.writeLock:
+            os.write(self.master, data)
+
+    def readLoop(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                line = line.strip()
+                if line:
+                    self.handleCommand(line)
+
+    def handleCommand(self, cmd):
+        self.commandsCount += 1
+        with self.stateLock:
+            response = self.respond(cmd)
+        if None == response:
+            self.write(cmd, b'ERROR')
+        else:
+            self.write(cmd, *(response + [b'OK']))
+
+    def respond(self, cmd):
+        if cmd in (b'AT', b'AT+CHUP') or cmd.startswith((b'AT+CSCS=', b'AT+CMGF=')):
+            if b'AT+CHUP' == cmd:
+                self.caller = None
+            return []
+        if b'ATI' == cmd:
+            return [b'Manufacturer: SIMCOM INCORPORATED', b'Model: SIMULATED', b'Revision: 1']
+        if b'AT+CLCC' == cmd:
+            if None == self.caller:
+                return []
+            return [b'+CLCC: 1,1,4,0,0,"%s",129' % self.caller]
+        if cmd.startswith(b'AT+CMGL='):
+            lines = []
+            for index in sorted(self.storage.keys()):
+                status, sender, text = self.storage[index]
+                lines.append(b'+CMGL: %d,"%s","%s",,""' % (index, status, toUCS2(sender)))
+                lines.append(toUCS2(text))
+                self.storage[index] = (b'REC READ', sender, text)
+            return lines
+        if cmd.startswith(b'AT+CMGR='):
+            index = int(cmd[len(b'AT+CMGR='):])
+            if index not in self.storage:
+                return None
+            status, sender, text = self.storage[index]
+            self.storage[index] = (b'REC READ', sender, text)
+            return [b'+CMGR: "%s","%s",,""' % (status, toUCS2(sender)), toUCS2(text)]
+        if cmd.startswith(b'AT+CMGD='):
+            self.storage.pop(int(cmd[len(b'AT+CMGD='):].split(b',')[0]), None)
+            return []
+        if cmd.startswith(b'AT+CMGDA='):
+            self.storage.clear()
+            return []
+        return None
+
+    def ring(self, number, withClip=True, rings=1):
+        """ Like a modem that sends RING, and +CLIP when caller id is on, on every ring """
+        if isinstance(number, str):
+            number = number.encode('utf8')
+        with self.stateLock:
+            self.caller = number
+        lines = [b'RING']
+        if withClip:
+            lines.append(b'+CLIP: "%s",129,"",0,"",0' % number)
+        self.write(*(lines * rings))
+
+    def sms(self, sender, text):
+        with self.stateLock:
+            index = self.nextIndex
+            self.nextIndex += 1
+            self.storage[index] = (b'REC UNREAD', sender, text)
+        self.write(b'+CMTI: "SM",%d' % index)
+
+    def powerDown(self):
+        self.write(b'NORMAL POWER DOWN')
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            params = json.loads(self.rfile.read(length).decode('utf8') or '{}')
+        except ValueError:
+            params = {}
+        method = self.path.rsplit('/', 1)[-1]
+        result = self.server.api.handle(method, params)
+        if None == result:
+            body = {'ok' : False, 'error_code' : 404, 'description' : 'Not Found'}
+        else:
+            body = {'ok' : True, 'result' : result}
+        data = json.dumps(body).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FakeTelegramServer(object):
+    """ Local stand-in for the Bot API methods we use, point TELEGRAM_API_URL at url """
+    def __init__(self, port=0):
+        self.updates = []
+        self.sent = []
+        self.nextUpdateId = 1
+        self.condition = threading.Condition()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FakeTelegramHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, method, params):
+        if 'getMe' == method:
+            return {'id' : 1, 'is_bot' : True, 'first_name' : 'gatectl', 'username' : 'gatectl_sim_bot'}
+        if 'getUpdates' == method:
+            return self.getUpdates(int(params.get('offset', 0) or 0), float(params.get('timeout', 0) or 0))
+        if 'sendMessage' == method:
+            with self.condition:
+                self.sent.append(params)
+                self.condition.notify_all()
+            return {'message_id' : len(self.sent), 'chat' : {'id' : params.get('chat_id', None)}, 'text' : params.get('text', '')}
+        return None
+
+    def getUpdates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.updates = [x for x in self.updates if offset <= x['update_id']]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def sendText(self, username, text):
+        with self.condition:
+            self.updates.append({
+                'update_id' : self.nextUpdateId,
+                'message' : {
+                    'message_id' : self.nextUpdateId,
+                    'date' : int(time.time()),
+                    'from' : {'id' : self.nextUpdateId, 'username' : username},
+                    'chat' : {'id' : 1},
+                    'text' : text}})
+            self.nextUpdateId += 1
+            self.condition.notify_all()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def readWhitelist(fileName):
+    try:
+        with open(fileName, 'r') as whitelist:
+            return whitelist.read().split()
+    except OSError:
+        return []
+
+def generateLoad(modem, telegram, rate, seconds, killFile):
+    """ Sends a mix of calls, SMS and Telegram messages at rate events per second,
+    then asks the control loop to exit """
+    phones = readWhitelist('whitelist.txt') or ['0500000000']
+    users = readWhitelist('telegram_whitelist.txt') or ['sim_user']
+    events = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        kind = random.choice(('Call', 'SMS', 'Telegram'))
+        if 'Call' == kind:
+            modem.ring(random.choice(phones), random.random() < 0.8, random.randint(1, 3))
+        elif 'SMS' == kind:
+            modem.sms(random.choice(phones), 'open')
+        else:
+            telegram.sendText(random.choice(users), 'open')
+        events += 1
+        time.sleep(max(0, start + events / float(rate) - time.monotonic()))
+    logPrint(colors.blue("Simulation sent %d events in %.1f sec" % (events, time.monotonic() - start)))
+    time.sleep(2)
+    open(killFile, 'w').close()
+
+def run_simulation(rate=10, seconds=10):
+    """ Runs the whole GateControl against simulated devices, on any Linux machine """
+    os.environ['GATECTL_HARDWARE'] = 'sim'
+    import main
+    modem = FakeModem()
+    telegram = FakeTelegramServer()
+    main.CONFIG_OVERRIDES.update(
+            GSM_SERIAL_DEV=modem.slaveName,
+            GSM_PWR_PIN=None,
+            TELEGRAM_API_URL=telegram.url,
+            TELEGRAM_LONG_POLL_TIMEOUT=main.cfg.get('TELEGRAM_LONG_POLL_TIMEOUT', 0) or 25,
+            TELEGRAM_NOTIFY_CHATS=main.cfg.get('TELEGRAM_NOTIFY_CHATS', None) or [1],
+            MUST_EXISTS_USB=[])
+    main.cfg = main.cfg.replace(**main.CONFIG_OVERRIDES)
+    logPrint(colors.blue("Simulated modem on %s, Telegram API on %s" % (modem.slaveName, telegram.url)))
+    generator = threading.Thread(
+            target=generateLoad,
+            args=(modem, telegram, float(rate), float(seconds), main.cfg['KILL_FILE']),
+            daemon=True)
+    generator.start()
+    main.run()
+    for message in telegram.sent:
+        logPrint(colors.blue("Notification to %s: %s" % (message.get('chat_id', None), message.get('text', None))))
+    telegram.close()
+    modem.close()
+
+if __name__ == '__main__':
+    colorama.init(strip=False)
+    if 2 <= len(sys.argv) and sys.argv[1] == 'run':
+        run_simulation(*sys.argv[2:4])
@@ -1,39 +1,165 @@
+import os
 import glob
 import datetime
 import time
+import pickle
+import array
+import math
+import concurrent.futures
+import json
 import colorama
 import colors
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
+from channels import CHANNELS, ACCESS_UNKNOWN, ACCESS_DENIED, ACCESS_GRANTED
+
+STATS_CACHE_DIR = '.stats_cache'
+# Bump when the parsed columns change so old cache files are ignored
+STATS_CACHE_VERSION = 1
+MONTHS = {b: i + 1 for i, b in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+# Gate opens closer than this to the previous one are counted once
+DEDUP_WINDOW = 180
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 
 def to_bool(x):
     return x.strip().lower() == 'true'
 
+def to_access(x):
+    x = x.strip().lower()
+    if 'true' == x:
+        return ACCESS_GRANTED
+    if 'false' == x:
+        return ACCESS_DENIED
+    return ACCESS_UNKNOWN
+
+def new_columns():
+    return {
+        'timestamp' : array.array('d'),
+        'action' : [],
+        'sender' : [],
+        'msg' : [],
+        'gate_access' : array.array('b'),
+        'latency' : array.array('d')}
+
+class CtimeParser(object):
+    """ Parses time.ctime() strings, mktime is only called once per hour of data """
+    def __init__(self):
+        self.hours = {}
+
+    def parse(self, timestamp):
+        # 'Sun Oct 18 12:34:56 2026', the day of month is space padded
+        _, month, day, hms, year = timestamp.split()
+        hour, minute, second = hms.split(':')
+        key = (year, month, day, hour)
+        base = self.hours.get(key, None)
+        if None == base:
+            base = time.mktime((int(year), MONTHS[month], int(day), int(hour), 0, 0, 0, 0, -1))
+            self.hours[key] = base
+        return base + int(minute) * 60 + int(second)
+
+def parse_line(l, columns, ctimeParser):
+    items = l.rstrip('\r\n').split('\t')
+    if items[0].replace('.', '', 1).isdigit():
+        # timestamp, source, sender, message, access, latency
+        columns['timestamp'].append(float(items[0]))
+        columns['action'].append(items[1])
+        columns['sender'].append(items[2])
+        columns['msg'].append(items[3])
+        columns['gate_access'].append(to_access(items[4]))
+        columns['latency'].append(float(items[5]) if items[5] else math.nan)
+        return
+    # Old format with a time.ctime() timestamp
+    timestamp = ctimeParser.parse(items[0])
+    if 4 < len(items):
+        msg = items[3]
+        gate_access = to_access(items[4])
+    else:
+        msg = ''
+        gate_access = to_access(items[3])
+    columns['timestamp'].append(timestamp)
+    columns['action'].append(items[1])
+    columns['sender'].append(items[2])
+    columns['msg'].append(msg)
+    columns['gate_access'].append(gate_access)
+    columns['latency'].append(math.nan)
+
 def parse_single_file(fname):
-    result = []
-    with open(fname, 'r', encoding='utf8') as data:
-        for l in data.readlines():
+    columns = new_columns()
+    ctimeParser = CtimeParser()
+    with open(fname, 'r', encoding='utf8', errors='replace') as data:
+        for l in data:
             if len(l) < 3:
                 continue
-            entry = {}
-            items = l.split('\t')
-            timestamp = items[0]
-            entry['datetime'] = datetime.datetime.fromtimestamp(time.mktime(time.strptime(timestamp)))
-            entry['action'] = items[1]
-            entry['sender'] = items[2]
-            if 4 < len(items):
-                entry['msg'] = items[3]
-                entry['gate_access'] = to_bool(items[4])
-                entry['play_music'] = to_bool(items[5])
-            else:
-                entry['gate_access'] = to_bool(items[3])
-            result.append(entry)
-    return result
+            try:
+                parse_line(l, columns, ctimeParser)
+            except (ValueError, IndexError, KeyError):
+                print(colors.yellow("Skipping bad line in %s: %r" % (fname, l)))
+    return columns
 
-def parse(log_files):
-    data = []
-    for fname in glob.glob(log_files):
-        data.extend(parse_single_file(fname))
-    return data
+def cache_file_name(fname):
+    return os.path.join(os.path.dirname(fname), STATS_CACHE_DIR, os.path.basename(fname) + '.cache')
+
+def file_key(fname):
+    st = os.stat(fname)
+    return (STATS_CACHE_VERSION, st.st_size, st.st_mtime_ns)
+
+def load_cache(fname, key):
+    try:
+        with open(cache_file_name(fname), 'rb') as cacheFile:
+            cached = pickle.load(cacheFile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if cached.get('key', None) != key:
+        return None
+    return cached['columns']
+
+def save_cache(fname, key, columns):
+    cacheName = cache_file_name(fname)
+    try:
+        os.makedirs(os.path.dirname(cacheName), exist_ok=True)
+        with open(cacheName + '.tmp', 'wb') as cacheFile:
+            pickle.dump({'key' : key, 'columns' : columns}, cacheFile, pickle.HIGHEST_PROTOCOL)
+        os.replace(cacheName + '.tmp', cacheName)
+    except OSError as e:
+        print(colors.yellow("Can't write cache for %s: %s" % (fname, e)))
+
+def merge_columns(parts):
+    columns = new_columns()
+    for part in parts:
+        for name, values in part.items():
+            columns[name].extend(values)
+    order = sorted(range(len(columns['timestamp'])), key=columns['timestamp'].__getitem__)
+    merged = new_columns()
+    for name, values in columns.items():
+        merged[name].extend(values[i] for i in order)
+    return merged
+
+def parse(log_files, workers=None):
+    """ Returns all entries as columns sorted by time, only files that changed since the
+    last run are parsed and those are parsed in parallel """
+    parts = {}
+    missing = {}
+    for fname in sorted(glob.glob(log_files)):
+        key = file_key(fname)
+        columns = load_cache(fname, key)
+        if None == columns:
+            missing[fname] = key
+        else:
+            parts[fname] = columns
+    if 1 < len(missing):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for fname, columns in zip(missing.keys(), pool.map(parse_single_file, missing.keys())):
+                parts[fname] = columns
+    else:
+        for fname in missing.keys():
+            parts[fname] = parse_single_file(fname)
+    for fname, key in missing.items():
+        save_cache(fname, key, parts[fname])
+    return merge_columns(parts[fname] for fname in sorted(parts.keys()))
 
 def normalize_sender_name(x, phonebook):
     if x.startswith('+972'):
@@ -42,24 +168,123 @@ def normalize_sender_name(x, phonebook):
         return phonebook.get(x, x)
     return x
 
+def load_phonebook(phonebook):
+    if not phonebook:
+        return None
+    with open(phonebook, 'r') as phonebook_file:
+        phonebook_data = phonebook_file.readlines()
+        phonebook_data = [x.split(':') for x in phonebook_data]
+        return {x[0].strip():x[1].strip() for x in phonebook_data}
+
 def csv(log_files, output_file, phonebook=None):
     data = parse(log_files)
-    if phonebook:
-        with open(phonebook, 'r') as phonebook_file:
-            phonebook_data = phonebook_file.readlines()
-            phonebook_data = [x.split(':') for x in phonebook_data]
-            phonebook = {x[0].strip():x[1].strip() for x in phonebook_data}
+    phonebook = load_phonebook(phonebook)
 
     with open(output_file, 'w') as writter:
-        lasttime = datetime.datetime.fromtimestamp(0)
-        for item in [x for x in data if x['gate_access']]:
-            date = item['datetime']
-            delta = lasttime - date
-            delta = abs(delta.seconds + (delta.days * 24 * 60 * 60))
-            lasttime = date
+        lasttime = 0
+        for i, timestamp in enumerate(data['timestamp']):
+            if ACCESS_GRANTED != data['gate_access'][i]:
+                continue
+            delta = abs(int(lasttime - timestamp))
+            lasttime = timestamp
             if delta < 180:
                 continue
-            sender = normalize_sender_name(item['sender'], phonebook)
+            date = datetime.datetime.fromtimestamp(timestamp)
+            sender = normalize_sender_name(data['sender'][i], phonebook)
             writter.write('%s,%s\n' % (date.strftime('%Y/%m/%d,%H:%M'), sender))
 
+def to_arrays(data, phonebook=None):
+    """ Converts parsed columns to numpy arrays, string columns are mapped through their
+    unique values so the per value Python work is done once per distinct value """
+    timestamp = np.frombuffer(data['timestamp'], dtype=np.float64)
+    gate_access = np.frombuffer(data['gate_access'], dtype=np.int8)
+    senders, sender_index = np.unique(np.array(data['sender'], dtype=str), return_inverse=True)
+    # Classified by the logged sender, a phonebook name of a phone number is still an SMS
+    is_phone = np.char.isdigit(np.char.lstrip(senders, '+'))[sender_index]
+    senders = np.array([normalize_sender_name(x, phonebook) for x in senders], dtype=str)
+    sender = senders[sender_index]
+    actions, action_index = np.unique(np.array(data['action'], dtype=str), return_inverse=True)
+    channels = np.array([CHANNELS.get(x, 'Other') for x in actions], dtype=object)
+    channel = channels[action_index]
+    # Old logs wrote 'Msg:' for both SMS and Telegram, Telegram senders are user names
+    is_msg = (actions == 'Msg:')[action_index]
+    if is_msg.any():
+        channel[is_msg & is_phone] = 'SMS'
+        channel[is_msg & ~is_phone] = 'Telegram'
+    return timestamp, gate_access, sender, channel.astype(str)
+
+def local_time(timestamp):
+    """ Shifts epoch timestamps to local wall clock seconds, the UTC offset is looked up
+    once per distinct hour so DST changes are respected """
+    hours, hour_index = np.unique(np.floor(timestamp / 3600).astype(np.int64), return_inverse=True)
+    offsets = np.array([time.localtime(x * 3600).tm_gmtoff for x in hours], dtype=np.float64)
+    return timestamp + offsets[hour_index]
+
+def dedup_opens(timestamp, gate_access, window=DEDUP_WINDOW):
+    """ Returns the indexes of granted accesses that are at least window seconds after the previous one """
+    granted = np.flatnonzero(ACCESS_GRANTED == gate_access)
+    delta = np.diff(timestamp[granted], prepend=-np.inf)
+    return granted[delta >= window]
+
+def analyze(data, phonebook=None, window=DEDUP_WINDOW):
+    assert None != np, "numpy is needed for analytics"
+    timestamp, gate_access, sender, channel = to_arrays(data, phonebook)
+    result = {'events' : int(len(timestamp))}
+    if not len(timestamp):
+        return result
+    result['first'] = datetime.datetime.fromtimestamp(timestamp[0]).isoformat()
+    result['last'] = datetime.datetime.fromtimestamp(timestamp[-1]).isoformat()
+
+    opens = dedup_opens(timestamp, gate_access, window)
+    result['gate_opens'] = int(len(opens))
+
+    open_senders, open_counts = np.unique(sender[opens], return_counts=True)
+    order = np.argsort(-open_counts, kind='stable')
+    result['per_sender'] = {str(open_senders[i]) : int(open_counts[i]) for i in order}
+
+    local = local_time(timestamp[opens])
+    hour = (local // 3600).astype(np.int64) % 24
+    # 1970-01-01 was a Thursday
+    weekday = ((local // 86400).astype(np.int64) + 3) % 7
+    heatmap = np.zeros((7, 24), dtype=np.int64)
+    np.add.at(heatmap, (weekday, hour), 1)
+    result['heatmap'] = {WEEKDAYS[i] : heatmap[i].tolist() for i in range(7)}
+
+    decided = gate_access != ACCESS_UNKNOWN
+    result['channels'] = {}
+    for name in np.unique(channel):
+        in_channel = decided & (channel == name)
+        attempts = int(np.count_nonzero(in_channel))
+        denied = int(np.count_nonzero(in_channel & (ACCESS_DENIED == gate_access)))
+        result['channels'][str(name)] = {
+            'attempts' : attempts,
+            'denied' : denied,
+            'denied_rate' : (denied / attempts) if attempts else 0.0}
+
+    minutes, minute_counts = np.unique((timestamp // 60).astype(np.int64), return_counts=True)
+    peak = np.argmax(minute_counts)
+    result['peak_minute'] = {
+        'time' : datetime.datetime.fromtimestamp(minutes[peak] * 60).isoformat(),
+        'events' : int(minute_counts[peak])}
+    return result
+
+def analytics(log_files, output_prefix, phonebook=None, window=DEDUP_WINDOW):
+    """ Writes output_prefix.json with all the numbers and CSV files for the tables """
+    result = analyze(parse(log_files), load_phonebook(phonebook), window)
+    with open(output_prefix + '.json', 'w') as writter:
+        json.dump(result, writter, indent=2)
+    with open(output_prefix + '_senders.csv', 'w') as writter:
+        writter.write('sender,opens\n')
+        for sender, count in result.get('per_sender', {}).items():
+            writter.write('%s,%d\n' % (sender, count))
+    with open(output_prefix + '_heatmap.csv', 'w') as writter:
+        writter.write('day,%s\n' % ','.join(str(x) for x in range(24)))
+        for day, counts in result.get('heatmap', {}).items():
+            writter.write('%s,%s\n' % (day, ','.join(str(x) for x in counts)))
+    with open(output_prefix + '_channels.csv', 'w') as writter:
+        writter.write('channel,attempts,denied,denied_rate\n')
+        for channel, info in result.get('channels', {}).items():
+            writter.write('%s,%d,%d,%.4f\n' % (channel, info['attempts'], info['denied'], info['denied_rate']))
+    return result
+
 colorama.init(strip=False)
@@ -0,0 +1,166 @@
+import time
+import signal
+import collections
+
+from common import *
+
+MODULE_BACKOFF_MIN = 1
+MODULE_BACKOFF_MAX = 300
+# After running this long a module counts as healthy, its next stop restarts it at once
+MODULE_STABLE_UPTIME = 60
+# Stops of all modules allowed in the window before asking for a reboot
+MODULE_CRASH_WINDOW = 3600
+MODULE_CRASH_BUDGET = 30
+
+def describeExit(exitcode):
+    if None == exitcode:
+        return 'running'
+    if 0 == exitcode:
+        return 'returned'
+    if exitcode < 0:
+        try:
+            return 'killed by %s' % signal.Signals(-exitcode).name
+        except ValueError:
+            return 'killed by signal %d' % -exitcode
+    return 'exit code %d' % exitcode
+
+class ThreadHandle(object):
+    """ A module running on a pool thread, looks like the parts of Process the supervisor uses """
+    sentinel = None
+
+    def __init__(self, future):
+        self.future = future
+
+    def is_alive(self):
+        return not self.future.done()
+
+    def exitReason(self):
+        if not self.future.done():
+            return 'running'
+        error = self.future.exception()
+        if None == error:
+            return 'returned'
+        return 'raised %r' % error
+
+class ModuleState(object):
+    def __init__(self, name, entryPoint, args):
+        self.name = name
+        self.entryPoint = entryPoint
+        self.args = args
+        self.handle = None
+        self.startedAt = None
+        self.starts = 0
+        self.crashes = collections.deque()
+        self.consecutiveCrashes = 0
+        self.nextStartAt = 0
+        self.lastExitReason = None
+
+    def uptime(self, now):
+        if None == self.handle or None == self.startedAt:
+            return 0
+        return now - self.startedAt
+
+class Supervisor(object):
+    """ Starts the modules, restarts the ones that stop with exponential backoff, and keeps
+    uptime, restart counts and exit reasons for each. launch(entryPoint, name, args) returns
+    a Process or a ThreadHandle """
+    def __init__(self, launch, isStopping,
+            backoffMin=MODULE_BACKOFF_MIN,
+            backoffMax=MODULE_BACKOFF_MAX,
+            crashWindow=MODULE_CRASH_WINDOW,
+            crashBudget=MODULE_CRASH_BUDGET):
+        self.launch = launch
+        self.isStopping = isStopping
+        self.backoffMin = backoffMin
+        self.backoffMax = backoffMax
+        self.crashWindow = crashWindow
+        self.crashBudget = crashBudget
+        self.modules = collections.OrderedDict()
+
+    def add(self, name, entryPoint, args):
+        if name not in self.modules:
+            self.modules[name] = ModuleState(name, entryPoint, args)
+
+    def sentinels(self):
+        return [x.handle.sentinel for x in self.modules.values() if None != x.handle and None != x.handle.sentinel]
+
+    def handles(self):
+        return [x.handle for x in self.modules.values() if None != x.handle]
+
+    def reap(self):
+        now = time.monotonic()
+        for module in self.modules.values():
+            if None != module.handle and not module.handle.is_alive():
+                self.recordExit(module, now)
+
+    def recordExit(self, module, now):
+        handle = module.handle
+        if isinstance(handle, ThreadHandle):
+            module.lastExitReason = handle.exitReason()
+        else:
+            module.lastExitReason = describeExit(handle.exitcode)
+        uptime = module.uptime(now)
+        module.handle = None
+        if self.isStopping():
+            return
+        if MODULE_STABLE_UPTIME <= uptime:
+            module.consecutiveCrashes = 0
+        module.consecutiveCrashes += 1
+        module.crashes.append(now)
+        # The first stop after a healthy run restarts at once, then the delay doubles
+        delay = 0
+        if 1 < module.consecutiveCrashes:
+            delay = min(self.backoffMin * 2 ** (module.consecutiveCrashes - 2), self.backoffMax)
+        module.nextStartAt = now + delay
+        logPrint(colors.yellow("%s stopped (%s) after %.1f sec, %d stops in the last %d sec, restarting in %d sec" % (
+                module.name, module.lastExitReason, uptime, self.recentCrashes(module, now), self.crashWindow, delay)))
+
+    def startDue(self):
+        """ Starts the modules that are down and due, returns the seconds until the next
+        pending start, None if nothing is pending """
+        self.reap()
+        if self.isStopping():
+            return None
+        now = time.monotonic()
+        nextStartAt = None
+        for module in self.modules.values():
+            if None != module.handle:
+                continue
+            if module.nextStartAt <= now:
+                logPrint("Creating %s" % module.name)
+                module.handle = self.launch(module.entryPoint, module.name, module.args)
+                module.startedAt = now
+                module.starts += 1
+            elif None == nextStartAt or module.nextStartAt < nextStartAt:
+                nextStartAt = module.nextStartAt
+        if None == nextStartAt:
+            return None
+        return max(0, nextStartAt - time.monotonic())
+
+    def recentCrashes(self, module, now=None):
+        if None == now:
+            now = time.monotonic()
+        while module.crashes and self.crashWindow < (now - module.crashes[0]):
+            module.crashes.popleft()
+        return len(module.crashes)
+
+    def isOverCrashBudget(self):
+        now = time.monotonic()
+        return self.crashBudget < sum(self.recentCrashes(x, now) for x in self.modules.values())
+
+    def status(self):
+        now = time.monotonic()
+        return [{
+                'name' : x.name,
+                'alive' : None != x.handle,
+                'uptime' : round(x.uptime(now), 1),
+                'starts' : x.starts,
+                'recentStops' : self.recentCrashes(x, now),
+                'lastExit' : x.lastExitReason} for x in self.modules.values()]
+
+    def logStatus(self):
+        for module in self.status():
+            logPrint("Module %(name)s: alive %(alive)r up %(uptime).1f sec, %(starts)d starts, "
+                    "%(recentStops)d recent stops, last exit %(lastExit)s" % module)
+
+colorama.init(strip=False)
@@ -1,38 +1,93 @@
 import os
+import json
 
-import telepot
 import traceback
 
 from common import *
-from urllib3.exceptions import ReadTimeoutError
+from tracing import *
+
+# telepot and urllib3 are imported where they are used, only the Telegram module needs them
+# and every other process would pay for them on startup
+
+TELEGRAM_API_URL = 'https://api.telegram.org'
+TELEGRAM_CONNECT_TIMEOUT = 5
+TELEGRAM_BACKOFF_MIN = 1
+TELEGRAM_BACKOFF_MAX = 120
+# Changing any of these makes a new bot, the offset is kept in TELEGRAM_LAST_MSG_FILE
+TELEGRAM_BOT_SETTINGS = frozenset([
+        'TELEGRAM_BOT_TOKEN',
+        'TELEGRAM_LAST_MSG_FILE',
+        'TELEGRAM_LONG_POLL_TIMEOUT',
+        'TELEGRAM_API_URL'])
+
+class TelegramError(Exception):
+    def __init__(self, description, errorCode=None, retryAfter=None):
+        super(TelegramError, self).__init__("Telegram error %r: %s" % (errorCode, description))
+        self.errorCode = errorCode
+        self.retryAfter = retryAfter
+
+class TelegramApi(object):
+    """ Minimal Bot API client that keeps a single connection to the API server open,
+    so long polling does not pay for a new TLS handshake on every request """
+    def __init__(self, token, apiUrl=TELEGRAM_API_URL):
+        import urllib3
+        self.token = token
+        self.basePath = (urllib3.util.parse_url(apiUrl).path or '').rstrip('/')
+        self.pool = urllib3.connection_from_url(apiUrl, maxsize=1, block=True)
+
+    def call(self, method, params=None, readTimeout=10):
+        import urllib3
+        response = self.pool.request(
+                'POST',
+                '%s/bot%s/%s' % (self.basePath, self.token, method),
+                body=json.dumps(params or {}).encode('utf8'),
+                headers={'Content-Type' : 'application/json'},
+                timeout=urllib3.Timeout(connect=TELEGRAM_CONNECT_TIMEOUT, read=readTimeout),
+                retries=False)
+        try:
+            result = json.loads(response.data.decode('utf8'))
+        except ValueError:
+            raise TelegramError("Bad response %r" % response.data[:100], response.status)
+        if not result.get('ok', False):
+            raise TelegramError(
+                    result.get('description', None),
+                    result.get('error_code', response.status),
+                    result.get('parameters', {}).get('retry_after', None))
+        return result['result']
+
+    def getMe(self):
+        return self.call('getMe')
+
+    def getUpdates(self, offset, timeout=0):
+        return self.call('getUpdates', {'offset' : offset, 'timeout' : int(timeout)}, readTimeout=timeout + 10)
 
 class TelegramBot(object):
-    def __init__(self, token, lastMsgFileName):
+    def __init__(self, token, lastMsgFileName, longPollTimeout=0, apiUrl=TELEGRAM_API_URL):
         self.lastMsgId = 0
         self.lastMsgFileName = lastMsgFileName
         if os.path.isfile(lastMsgFileName):
             with open(lastMsgFileName, 'r') as lastMsgFile:
                 self.lastMsgId = int(lastMsgFile.read())
-        self.bot = telepot.Bot(token)
+        self.longPollTimeout = longPollTimeout
+        if self.isLongPolling():
+            self.bot = TelegramApi(token, apiUrl)
+        else:
+            import telepot
+            self.bot = telepot.Bot(token)
         try:
             myDetails = self.bot.getMe()
             logPrint(colors.blue(repr(myDetails)))
         except:
             logPrint('No internet / Telegram is down')
 
+    def isLongPolling(self):
+        return 0 < self.longPollTimeout
+
     def getMessages(self):
-        messages = None
-        try:
+        if self.isLongPolling():
+            messages = self.bot.getUpdates(self.lastMsgId, timeout=self.longPollTimeout)
+        else:
             messages = self.bot.getUpdates(self.lastMsgId, timeout=1.1)
-        except ReadTimeoutError as e:
-            logPrint('Got timeout error, will try again later')
-            time.sleep(20)
-            return []
-        except Exception as e:
-            last_error = traceback.format_exc()
-            logPrint('Got exception in getMessage: \n' + colors.bold(colors.red(last_error)))
-            time.sleep(20)
-            raise e
         result = []
         lastId = self.lastMsgId
         for msg in messages:
@@ -54,30 +109,52 @@ class TelegramBot(object):
                 lastMsgFile.write(str(lastId))
         return result
 
+def createTelegramBot(cfg):
+    return TelegramBot(
+            cfg['TELEGRAM_BOT_TOKEN'],
+            cfg['TELEGRAM_LAST_MSG_FILE'],
+            cfg.get('TELEGRAM_LONG_POLL_TIMEOUT', 0),
+            cfg.get('TELEGRAM_API_URL', TELEGRAM_API_URL))
+
 def read_telegram_messages():
-    cfg = configLoad('config.py')
-    telegramBot = TelegramBot(cfg['TELEGRAM_BOT_TOKEN'], cfg['TELEGRAM_LAST_MSG_FILE'])
+    telegramBot = createTelegramBot(cfg)
     for sender, text in telegramBot.getMessages():
         logPrint("%s sent: %s" % (sender, text))
 
-def TelegramBotRun(cfg, cmdQueue):
+def TelegramBotRun(cfg, cmdQueue, configUpdates=None):
     assert validate_single_instance('telegrambot'), "Already running!"
     logPrint("Telegram Bot main loop")
-    telegramBot = TelegramBot(cfg['TELEGRAM_BOT_TOKEN'], cfg['TELEGRAM_LAST_MSG_FILE'])
+    from urllib3.exceptions import ReadTimeoutError
+    telegramBot = createTelegramBot(cfg)
+    reportReady('TelegramBot')
+    backoff = 0
     while True:
         if os.path.isfile(cfg['KILL_FILE']):
             logPrint(colors.magenta("TelegramBot KTHXBYE"))
             return False
         try:
+            newCfg = pollConfigUpdate(configUpdates)
+            if None != newCfg:
+                if cfg.diff(newCfg) & TELEGRAM_BOT_SETTINGS:
+                    logPrint("Telegram settings changed, reconnecting")
+                    telegramBot = createTelegramBot(newCfg)
+                cfg = newCfg
             messages = telegramBot.getMessages()
+            receivedAt = time.monotonic()
+            backoff = 0
             for sender, text in messages:
-                cmdQueue.put(('TelegramBot', sender, text))
-            time.sleep(cfg['TELEGRAM_CHECK_INTERVAL'])
+                cmdQueue.put(('TelegramBot', sender, text, Trace('Telegram', receivedAt).mark('queued')))
+            if not telegramBot.isLongPolling():
+                time.sleep(cfg['TELEGRAM_CHECK_INTERVAL'])
+        except ReadTimeoutError:
+            logPrint('Got timeout error, will try again')
         except Exception as e:
             last_error = traceback.format_exc()
-            logPrint(colors.bold(colors.red(last_error)))
-            time.sleep(4)
-            raise e
+            logPrint('Got exception in getMessage: \n' + colors.bold(colors.red(last_error)))
+            backoff = min(max(TELEGRAM_BACKOFF_MIN, backoff * 2), TELEGRAM_BACKOFF_MAX)
+            if isinstance(e, TelegramError) and e.retryAfter:
+                backoff = max(backoff, e.retryAfter)
+            logPrint("Retrying in %d sec" % backoff)
+            time.sleep(backoff)
 
 colorama.init(strip=False)
-
@@ -0,0 +1,15 @@
+import os
+import sys
+import shutil
+import tempfile
+
+# The modules live in the repository root and load config.py from the working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['GATECTL_HARDWARE'] = 'sim'
+WORK_DIR = tempfile.mkdtemp(prefix='gatectl_tests_')
+shutil.copy(os.path.join(ROOT, 'config_example.py'), os.path.join(WORK_DIR, 'config.py'))
+# The log is flushed at exit, after pytest went back to the directory it started in
+with open(os.path.join(WORK_DIR, 'config.py'), 'a') as config:
+    config.write('\nLOG_FILE_NAME = %r\n' % os.path.join(WORK_DIR, 'logs', 'ctl_%s.log'))
+os.chdir(WORK_DIR)
@@ -0,0 +1,79 @@
+from gatectl import GateScheduler, GATE_RESET_TIME, orderCommands
+
+UP_PIN = 11
+POWER_PIN = 13
+
+class FakeGateMachine(object):
+    def __init__(self):
+        self.up_gpio = UP_PIN
+        self.power_gpio = POWER_PIN
+        self.actions = []
+
+    def activatePin(self, pin_number, active_low=False):
+        self.actions.append(('on', pin_number))
+
+    def deactivatePin(self, pin_number, active_low=False):
+        self.actions.append(('off', pin_number))
+
+    def close(self):
+        pass
+
+def test_overlapping_opens_extend_one_hold():
+    gm = FakeGateMachine()
+    scheduler = GateScheduler(gm)
+    scheduler.up(2)
+    scheduler.up(30)
+    scheduler.up(1)
+    assert [('on', UP_PIN)] == gm.actions
+    # The longest open wins, a shorter one that comes later doesn't cut it
+    assert 20 < scheduler.timeout() <= 30
+
+def test_expired_hold_is_released():
+    gm = FakeGateMachine()
+    scheduler = GateScheduler(gm)
+    scheduler.up(0)
+    scheduler.releaseExpired()
+    assert [('on', UP_PIN), ('off', UP_PIN)] == gm.actions
+    assert None == scheduler.timeout()
+    scheduler.up(2)
+    assert ('on', UP_PIN) == gm.actions[-1]
+
+def test_reset_releases_up_and_holds_power():
+    gm = FakeGateMachine()
+    scheduler = GateScheduler(gm)
+    scheduler.up(30)
+    scheduler.resetGate()
+    assert [('on', UP_PIN), ('off', UP_PIN), ('on', POWER_PIN)] == gm.actions
+    assert GATE_RESET_TIME - 1 < scheduler.timeout() <= GATE_RESET_TIME
+
+def test_batch_order_puts_close_and_reset_first():
+    commands = [('up', (2,), None), ('resetGate', (), None), ('reconfigure', ({},), None), ('up', (5,), None), ('close', (), None)]
+    assert ['close', 'resetGate', 'up', 'up', 'reconfigure'] == [x[0] for x in orderCommands(commands)]
+    # Commands of the same priority keep their order
+    assert [(2,), (5,)] == [x[1] for x in orderCommands(commands) if 'up' == x[0]]
+
+def test_up_waits_for_reset_to_end():
+    gm = FakeGateMachine()
+    scheduler = GateScheduler(gm)
+    scheduler.resetGate()
+    scheduler.up(2)
+    scheduler.up(5)
+    assert [('on', POWER_PIN)] == gm.actions
+    scheduler.releaseExpired()
+    assert [('on', POWER_PIN)] == gm.actions
+    # The power hold ends, then the gate opens for the longest of the deferred opens
+    scheduler.holds[POWER_PIN] = (0, False)
+    scheduler.releaseExpired()
+    assert [('on', POWER_PIN), ('off', POWER_PIN), ('on', UP_PIN)] == gm.actions
+    assert 4 < scheduler.timeout() <= 5
+    scheduler.releaseExpired()
+    assert 3 == len(gm.actions)
+
+def test_close_drops_deferred_up():
+    gm = FakeGateMachine()
+    scheduler = GateScheduler(gm)
+    scheduler.resetGate()
+    scheduler.up(2)
+    scheduler.close()
+    scheduler.releaseExpired()
+    assert [('on', POWER_PIN), ('off', POWER_PIN)] == gm.actions
@@ -0,0 +1,78 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from common import cfg
+from gsmhat import GSMHat, CallSession, CALL_IDLE_TIMEOUT
+from simhw import FakeModem
+
+# Longer than the +CLIP grace and the AT round trips of a hang up
+DECISION_TIMEOUT = 3
+SETTLE_TIME = 1.5
+
+@pytest.fixture
+def idle_gsm(tmp_path):
+    modem = FakeModem()
+    cmdQueue = queue.Queue()
+    gsm = GSMHat(cfg.replace(GSM_SERIAL_DEV=modem.slaveName, GSM_PWR_PIN=None, KILL_FILE=str(tmp_path / 'KILLAPP')), cmdQueue)
+    gsm.modem = modem
+    yield gsm
+    gsm.close()
+    modem.close()
+
+@pytest.fixture
+def gsm(idle_gsm):
+    loop = threading.Thread(target=idle_gsm.mainLoop, daemon=True)
+    loop.start()
+    yield idle_gsm
+    open(idle_gsm.cfg['KILL_FILE'], 'w').close()
+    loop.join(5)
+
+def decisions(gsm, count):
+    """ The callers of the next count decisions, and of any that come after them in the settle time """
+    callers = []
+    deadline = time.monotonic() + DECISION_TIMEOUT
+    while len(callers) < count or time.monotonic() < deadline:
+        try:
+            module, sender, _, _ = gsm.cmdQueue.get(timeout=max(0.01, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if 'GSM Call' == module:
+            callers.append(sender)
+            if len(callers) == count:
+                deadline = time.monotonic() + SETTLE_TIME
+    return callers
+
+def test_one_decision_for_a_call_with_clip(gsm):
+    gsm.modem.ring('0501234567', withClip=True, rings=3)
+    assert [b'0501234567'] == decisions(gsm, 1)
+
+def test_one_decision_for_a_call_without_clip(gsm):
+    gsm.modem.ring('0501234567', withClip=False, rings=3)
+    assert [b'0501234567'] == decisions(gsm, 1)
+
+def test_next_caller_gets_its_own_decision(gsm):
+    gsm.modem.ring('0501234567', withClip=True, rings=3)
+    assert [b'0501234567'] == decisions(gsm, 1)
+    gsm.modem.ring('0527654321', withClip=False, rings=3)
+    assert [b'0527654321'] == decisions(gsm, 1)
+
+def test_caller_ringing_during_hang_up_is_not_dropped(gsm):
+    gsm.modem.ring('0501234567', withClip=True, rings=3)
+    gsm.modem.ring('0527654321', withClip=True, rings=3)
+    assert [b'0501234567', b'0527654321'] == decisions(gsm, 2)
+
+def test_idle_call_ends_and_its_late_events_are_ignored(idle_gsm):
+    gsm = idle_gsm
+    gsm.call = call = CallSession(100.0)
+    call.callerId = b'0501234567'
+    call.isDecided = True
+    assert CALL_IDLE_TIMEOUT == gsm.checkCall(100.0)
+    assert None == gsm.checkCall(100.0 + CALL_IDLE_TIMEOUT)
+    assert None == gsm.call
+    gsm.callEndedAt = 200.0
+    assert None == gsm.callEvent(150.0)
+    assert None == gsm.callEvent(150.0, b'0501234567')
+    assert None != gsm.callEvent(150.0, b'0527654321')
@@ -0,0 +1,64 @@
+import os
+import time
+import logging
+
+from logarchive import SegmentSink, LogArchive, LogArchiver
+
+FORMATTER = logging.Formatter('%(message)s')
+
+def record(text, created):
+    entry = logging.LogRecord('test', logging.INFO, __file__, 1, text, None, None)
+    entry.created = created
+    return entry
+
+def segment_names(path):
+    return sorted(x for x in os.listdir(str(path)) if x.endswith('.log'))
+
+def test_segments_of_a_name_without_pattern(tmp_path):
+    now = time.mktime((2026, 10, 18, 10, 30, 0, 0, 0, -1))
+    sink = SegmentSink(str(tmp_path / 'ctl.log'), period=3600)
+    sink.write([record('first', now)], FORMATTER)
+    sink.write([record('second', now + 3600)], FORMATTER)
+    sink.close()
+    assert ['ctl_20261018_1000.log', 'ctl_20261018_1100.log'] == segment_names(tmp_path)
+
+def test_full_segment_moves_to_the_next_part(tmp_path):
+    now = time.mktime((2026, 10, 18, 10, 30, 0, 0, 0, -1))
+    sink = SegmentSink(str(tmp_path / 'ctl_%s.log'), period=3600, maxSize=10)
+    sink.write([record('a' * 20, now)], FORMATTER)
+    sink.write([record('b', now + 1)], FORMATTER)
+    sink.close()
+    assert ['ctl_20261018_1000.log', 'ctl_20261018_1000_1.log'] == segment_names(tmp_path)
+
+def touch(path, text=''):
+    with open(str(path), 'w') as segment:
+        segment.write(text)
+
+def make_segments(path):
+    for name in ('ctl_20261018_0900.log', 'ctl_20261018_1000_10.log', 'ctl_20261018_1000_9.log', 'ctl_20261018_1000.log', 'other.log'):
+        touch(path / name)
+    # A compressed segment is listed by its plain name
+    touch(path / 'ctl_20261018_0800.log.gz')
+    touch(path / 'ctl_20261018_0800.log.gz.idx', '{}')
+
+def test_segments_with_pattern(tmp_path):
+    make_segments(tmp_path)
+    segments = LogArchive(str(tmp_path / 'ctl_%s.log')).segments()
+    assert ['ctl_20261018_0800.log', 'ctl_20261018_0900.log', 'ctl_20261018_1000.log', 'ctl_20261018_1000_9.log', 'ctl_20261018_1000_10.log'] == \
+            [os.path.basename(x) for x in segments]
+
+def test_segments_without_pattern(tmp_path):
+    make_segments(tmp_path)
+    touch(tmp_path / 'ctl.log')
+    assert LogArchive(str(tmp_path / 'ctl_%s.log')).segments() == LogArchive(str(tmp_path / 'ctl.log')).segments()
+
+def test_archived_segment_reads_by_time(tmp_path):
+    start = time.mktime((2026, 10, 18, 9, 0, 0, 0, 0, -1))
+    lines = ['[%s,000| INFO| MainProcess] line %d\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + i * 30)), i) for i in range(100)]
+    touch(tmp_path / 'ctl_20261018_0900.log', ''.join(lines))
+    touch(tmp_path / 'ctl_20261018_1000.log')
+    os.utime(str(tmp_path / 'ctl_20261018_0900.log'), (start, start))
+    archiver = LogArchiver(str(tmp_path / 'ctl.log'), log=lambda x: None)
+    archiver.compressSealed()
+    assert ['ctl_20261018_0900.log.gz', 'ctl_20261018_0900.log.gz.idx', 'ctl_20261018_1000.log'] == sorted(os.listdir(str(tmp_path)))
+    assert lines[10:21] == list(LogArchive(str(tmp_path / 'ctl.log')).range(start + 300, start + 600))
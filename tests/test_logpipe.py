@@ -0,0 +1,40 @@
+import logging
+
+import colors
+
+from logpipe import RateLimitFilter
+
+def record(text, created, site=('main.py', 10), level=logging.INFO):
+    entry = logging.LogRecord('test', level, 'common.py', 221, text, None, None)
+    entry.created = created
+    entry.site = site
+    return entry
+
+def passed(rateFilter, records):
+    return [x.getMessage() for x in records if rateFilter.filter(x)]
+
+def test_distinct_messages_from_one_site_all_pass():
+    rateFilter = RateLimitFilter(limit=2, window=10)
+    messages = ["'050%07d' is calling" % i for i in range(50)]
+    assert messages == passed(rateFilter, [record(x, 100 + i * 0.01) for i, x in enumerate(messages)])
+
+def test_repeats_are_limited_and_counted():
+    rateFilter = RateLimitFilter(limit=2, window=10)
+    assert ['Gate up!'] * 2 == passed(rateFilter, [record('Gate up!', 100 + i) for i in range(5)])
+    # The same text from another line has its own limit
+    assert ['Gate up!'] == passed(rateFilter, [record('Gate up!', 105, site=('gatectl.py', 5))])
+    assert ['Gate up! (3 repeats suppressed from main.py:10)'] == passed(rateFilter, [record('Gate up!', 111)])
+
+def test_errors_and_warnings_are_never_dropped():
+    rateFilter = RateLimitFilter(limit=1, window=10)
+    error = colors.bold(colors.red('Traceback'))
+    warning = colors.yellow('Timeout waiting for AT')
+    assert [error] * 5 == passed(rateFilter, [record(error, 100 + i) for i in range(5)])
+    assert [warning] * 5 == passed(rateFilter, [record(warning, 100 + i) for i in range(5)])
+    assert ['disk'] * 3 == passed(rateFilter, [record('disk', 100 + i, level=logging.WARNING) for i in range(3)])
+
+def test_ended_windows_are_forgotten():
+    rateFilter = RateLimitFilter(limit=1, window=10, maxTracked=4)
+    passed(rateFilter, [record('message %d' % i, 100) for i in range(4)])
+    passed(rateFilter, [record('new', 200)])
+    assert 1 == len(rateFilter.messages)
@@ -0,0 +1,50 @@
+import json
+import time
+
+from notify import Notifier, TokenBucket
+
+class RecordingNotifier(Notifier):
+    def __init__(self, *args, **kwargs):
+        self.sent = []
+        self.isFailing = False
+        super(RecordingNotifier, self).__init__(*args, **kwargs)
+
+    def send(self, chat, text):
+        if self.isFailing:
+            raise OSError("Telegram is down")
+        self.sent.append((chat, text))
+
+def load_spool(fileName):
+    with open(fileName, 'r') as spool:
+        return [tuple(x) for x in json.load(spool)]
+
+def test_new_bucket_has_its_burst():
+    now = time.monotonic()
+    bucket = TokenBucket(0.01, 1)
+    assert 0 == bucket.delay(now)
+    bucket.take()
+    assert 0 < bucket.delay()
+
+def test_rate_limited_messages_are_spooled_on_close(tmp_path):
+    spool = str(tmp_path / 'spool.json')
+    notifier = RecordingNotifier('token', [1], chatRate=0.01, chatBurst=1, spoolFileName=spool)
+    notifier.notify('reboot', None, 'first')
+    assert notifier.flush()
+    notifier.notify('denied', '0501234567', 'second')
+    notifier.close()
+    assert [(1, 'Rebooting: first')] == notifier.sent
+    assert [(1, 'Access denied: second')] == load_spool(spool)
+
+def test_flush_spools_what_fails(tmp_path):
+    spool = str(tmp_path / 'spool.json')
+    notifier = RecordingNotifier('token', [1, 2], spoolFileName=spool)
+    notifier.isFailing = True
+    notifier.notify('reboot', None, 'power')
+    assert notifier.flush()
+    assert [(1, 'Rebooting: power'), (2, 'Rebooting: power')] == load_spool(spool)
+    notifier.close(wait=False)
+    # The next notifier sends the spool once the one it replaces is done
+    replacement = RecordingNotifier('token', [1, 2], spoolFileName=spool, previous=notifier)
+    assert replacement.flush()
+    replacement.close()
+    assert [(1, 'Rebooting: power'), (2, 'Rebooting: power')] == replacement.sent
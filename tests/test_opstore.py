@@ -0,0 +1,46 @@
+from oplog import formatOperation
+from opstore import OperationStore
+from channels import ACCESS_GRANTED, ACCESS_DENIED, ACCESS_UNKNOWN
+
+RECORDS = [
+    (1700000000.1234, 'Call', '0501234567', None, True, 0.25),
+    (1700000010.5, 'SMS', '+972527654321', 'open', False, None),
+    (1700000020.0, 'Msg:', 'bob', 'open', None, None)]
+
+def write_log(fileName, records):
+    with open(fileName, 'a', encoding='utf8') as log:
+        log.write(''.join(formatOperation(*x) for x in records))
+
+def test_add_ignores_entries_it_has(tmp_path):
+    store = OperationStore(str(tmp_path / 'ops.db'))
+    assert 3 == store.add(RECORDS)
+    assert 0 == store.add(RECORDS)
+    assert 1 == store.add([(1700000030.0, 'Telegram', 'bob', 'open', True, None)])
+    rows = store.query('SELECT channel, access FROM operations ORDER BY ts')
+    assert [('Call', ACCESS_GRANTED), ('SMS', ACCESS_DENIED), ('Telegram', ACCESS_UNKNOWN), ('Telegram', ACCESS_GRANTED)] == \
+            [(x['channel'], x['access']) for x in rows]
+
+def test_import_of_live_entries_adds_nothing(tmp_path):
+    logName = str(tmp_path / 'operation_20231114.log')
+    write_log(logName, RECORDS)
+    store = OperationStore(str(tmp_path / 'ops.db'))
+    store.add(RECORDS)
+    assert 0 == store.importLogs(str(tmp_path / 'operation_*.log'))
+    assert 3 == store.query('SELECT COUNT(*) AS n FROM operations')[0]['n']
+
+def test_import_reads_a_file_again_only_when_it_changed(tmp_path):
+    logName = str(tmp_path / 'operation_20231114.log')
+    write_log(logName, RECORDS)
+    store = OperationStore(str(tmp_path / 'ops.db'))
+    assert 3 == store.importLogs(str(tmp_path / 'operation_*.log'))
+    assert 0 == store.importLogs(str(tmp_path / 'operation_*.log'))
+    write_log(logName, [(1700000040.0, 'RF cmd', '', None, True, None)])
+    assert 1 == store.importLogs(str(tmp_path / 'operation_*.log'))
+    assert 4 == store.query('SELECT COUNT(*) AS n FROM operations')[0]['n']
+
+def test_last_seen_matches_both_number_forms(tmp_path):
+    store = OperationStore(str(tmp_path / 'ops.db'))
+    store.add(RECORDS)
+    assert 1700000000.123 == store.lastSeen('+972501234567')['ts']
+    assert None == store.lastSeen('0527654321')
+    assert 'SMS' == store.lastSeen('0527654321', granted=False)['channel']
@@ -0,0 +1,17 @@
+from rfcontrol import IntervalSet
+
+def test_single_pair_from_config():
+    ranges = IntervalSet((100, 200))
+    assert 100 in ranges
+    assert 200 in ranges
+    assert 99 not in ranges
+    assert 201 not in ranges
+
+def test_ranges_are_sorted_and_merged():
+    ranges = IntervalSet([(50, 40), (10, 20), (21, 25), (15, 18), (100, 100)])
+    assert [(10, 25), (40, 50), (100, 100)] == list(zip(ranges.starts, ranges.ends))
+    assert all(x in ranges for x in (10, 21, 25, 45, 100))
+    assert not any(x in ranges for x in (9, 26, 39, 51, 99, 101))
+
+def test_empty():
+    assert 1 not in IntervalSet([])
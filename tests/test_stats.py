@@ -0,0 +1,42 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from stats import new_columns, to_arrays, ACCESS_GRANTED, ACCESS_DENIED
+
+def make_columns(entries):
+    columns = new_columns()
+    for i, (action, sender) in enumerate(entries):
+        columns['timestamp'].append(1000.0 + i)
+        columns['action'].append(action)
+        columns['sender'].append(sender)
+        columns['msg'].append('open')
+        columns['gate_access'].append(ACCESS_GRANTED if i % 2 else ACCESS_DENIED)
+        columns['latency'].append(0.1)
+    return columns
+
+def test_channels_of_current_and_old_actions():
+    data = make_columns([
+            ('Call', '0501234567'),
+            ('Call:', '0501234567'),
+            ('SMS', '+972501234567'),
+            ('Telegram', 'bob'),
+            ('RF cmd', ''),
+            ('LocalTrigger', ''),
+            ('Something', 'x')])
+    _, _, _, channel = to_arrays(data)
+    assert ['Call', 'Call', 'SMS', 'Telegram', 'RF', 'Local', 'Other'] == list(channel)
+
+def test_old_msg_split_by_sender():
+    data = make_columns([('Msg:', '+972501234567'), ('Msg:', '0527654321'), ('Msg:', 'bob')])
+    _, _, sender, channel = to_arrays(data)
+    assert ['SMS', 'SMS', 'Telegram'] == list(channel)
+    assert ['0501234567', '0527654321', 'bob'] == list(sender)
+
+def test_phonebook_names_keep_sms_channel():
+    data = make_columns([('Msg:', '+972501234567'), ('Msg:', 'bob')])
+    timestamp, gate_access, sender, channel = to_arrays(data, {'0501234567' : 'Alice'})
+    assert ['Alice', 'bob'] == list(sender)
+    assert ['SMS', 'Telegram'] == list(channel)
+    assert [1000.0, 1001.0] == list(timestamp)
+    assert [ACCESS_DENIED, ACCESS_GRANTED] == list(gate_access)
@@ -0,0 +1,114 @@
+import os
+import time
+import collections
+
+from common import *
+
+LATENCY_METRICS_FILE = 'logs/latency.prom'
+LATENCY_PUBLISH_INTERVAL = 1
+# Gate should move within this many seconds of the event
+LATENCY_SLA = 2
+# Recent samples per channel used for the quantiles
+LATENCY_WINDOW = 1000
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+
+class Trace(object):
+    """ Stage timestamps of a single event, from the moment a module detected it until
+    the gate pin was activated. Travels with the event through the queues.
+    time.monotonic is CLOCK_MONOTONIC on Linux, so it is comparable between processes """
+    def __init__(self, channel, detectedAt=None):
+        self.channel = channel
+        if None == detectedAt:
+            detectedAt = time.monotonic()
+        self.stages = [('detected', detectedAt)]
+
+    def mark(self, stage):
+        self.stages.append((stage, time.monotonic()))
+        return self
+
+    def elapsed(self):
+        return self.stages[-1][1] - self.stages[0][1]
+
+    def __repr__(self):
+        start = self.stages[0][1]
+        return "<%s %s>" % (self.channel, ' '.join('%s+%.1fms' % (name, (t - start) * 1000) for name, t in self.stages))
+
+def quantile(sortedValues, q):
+    if not sortedValues:
+        return float('nan')
+    return sortedValues[min(len(sortedValues) - 1, int(q * len(sortedValues)))]
+
+class LatencyRecorder(object):
+    """ Per channel latency histograms, published as a Prometheus text file """
+    def __init__(self, metricsFile=LATENCY_METRICS_FILE, sla=LATENCY_SLA):
+        self.metricsFile = metricsFile
+        self.sla = sla
+        self.buckets = {}
+        self.counts = collections.Counter()
+        self.sums = collections.Counter()
+        self.slaViolations = collections.Counter()
+        self.recent = {}
+        self.isDirty = False
+        self.lastPublish = 0
+
+    def record(self, trace):
+        latency = trace.elapsed()
+        channel = trace.channel
+        if channel not in self.buckets:
+            self.buckets[channel] = [0] * len(LATENCY_BUCKETS)
+            self.recent[channel] = collections.deque(maxlen=LATENCY_WINDOW)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[channel][i] += 1
+        self.counts[channel] += 1
+        self.sums[channel] += latency
+        if self.sla < latency:
+            self.slaViolations[channel] += 1
+            logPrint(colors.red("Gate latency SLA missed: %r" % trace))
+        self.recent[channel].append(latency)
+        self.isDirty = True
+
+    def format(self):
+        lines = [
+            '# HELP gatectl_gate_latency_seconds Time from event detection to gate actuation',
+            '# TYPE gatectl_gate_latency_seconds histogram']
+        for channel in sorted(self.buckets.keys()):
+            for bound, count in zip(LATENCY_BUCKETS, self.buckets[channel]):
+                lines.append('gatectl_gate_latency_seconds_bucket{channel="%s",le="%g"} %d' % (channel, bound, count))
+            lines.append('gatectl_gate_latency_seconds_bucket{channel="%s",le="+Inf"} %d' % (channel, self.counts[channel]))
+            lines.append('gatectl_gate_latency_seconds_sum{channel="%s"} %f' % (channel, self.sums[channel]))
+            lines.append('gatectl_gate_latency_seconds_count{channel="%s"} %d' % (channel, self.counts[channel]))
+        lines.append('# HELP gatectl_gate_latency_recent_seconds Latency quantiles over the last %d events' % LATENCY_WINDOW)
+        lines.append('# TYPE gatectl_gate_latency_recent_seconds gauge')
+        for channel in sorted(self.recent.keys()):
+            values = sorted(self.recent[channel])
+            for q in LATENCY_QUANTILES:
+                lines.append('gatectl_gate_latency_recent_seconds{channel="%s",quantile="%g"} %f' % (channel, q, quantile(values, q)))
+        lines.append('# HELP gatectl_gate_latency_sla_violations_total Events slower than %g seconds' % self.sla)
+        lines.append('# TYPE gatectl_gate_latency_sla_violations_total counter')
+        for channel in sorted(self.buckets.keys()):
+            lines.append('gatectl_gate_latency_sla_violations_total{channel="%s"} %d' % (channel, self.slaViolations[channel]))
+        return '\n'.join(lines) + '\n'
+
+    def publish(self, force=False):
+        if not self.isDirty:
+            return
+        if not force and (time.monotonic() - self.lastPublish) < LATENCY_PUBLISH_INTERVAL:
+            return
+        self.lastPublish = time.monotonic()
+        self.isDirty = False
+        dirName = os.path.dirname(self.metricsFile)
+        if dirName:
+            os.makedirs(dirName, exist_ok=True)
+        with open(self.metricsFile + '.tmp', 'w') as metrics:
+            metrics.write(self.format())
+        os.replace(self.metricsFile + '.tmp', self.metricsFile)
+
+    def timeout(self):
+        """ Seconds until a pending publish is allowed, None if there is nothing to publish """
+        if not self.isDirty:
+            return None
+        return max(0, self.lastPublish + LATENCY_PUBLISH_INTERVAL - time.monotonic())
+
+colorama.init(strip=False)
@@ -0,0 +1,58 @@
+import os
+import time
+
+from common import *
+
+def canonicalUserId(userId, isPhone):
+    userId = userId.strip()
+    if not isPhone:
+        return userId
+    userId = userId.replace(b'-', b'').replace(b' ', b'').replace(b'.', b'')
+    if userId.startswith(b'+972'):
+        return b'0' + userId[4:]
+    if userId.startswith(b'972'):
+        return b'0' + userId[3:]
+    return userId
+
+class Whitelist(object):
+    def __init__(self, fileName, isPhone, checkInterval=1.0):
+        self.fileName = fileName
+        self.isPhone = isPhone
+        self.checkInterval = checkInterval
+        self.entries = frozenset()
+        self.fileId = None
+        self.nextCheck = 0
+        self.reloadIfNeeded()
+
+    def reloadIfNeeded(self):
+        now = time.monotonic()
+        if now < self.nextCheck:
+            return False
+        self.nextCheck = now + self.checkInterval
+        try:
+            st = os.stat(self.fileName)
+            fileId = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            fileId = None
+        if fileId == self.fileId:
+            return False
+        self.fileId = fileId
+        self.load()
+        return True
+
+    def load(self):
+        entries = set()
+        try:
+            with open(self.fileName, 'rb') as whiteListFile:
+                for userId in whiteListFile.read().split():
+                    entries.add(canonicalUserId(userId, self.isPhone))
+        except OSError:
+            logPrint(colors.red("Can't read whitelist %s" % self.fileName))
+        self.entries = frozenset(entries)
+        logPrint("Loaded %d entries from whitelist %s" % (len(self.entries), self.fileName))
+
+    def __contains__(self, userId):
+        self.reloadIfNeeded()
+        return canonicalUserId(userId, self.isPhone) in self.entries
+
+colorama.init(strip=False)